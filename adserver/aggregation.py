@@ -0,0 +1,548 @@
+"""Aggregate a day of offers into the impression indexes (eg. ``GeoImpression``) in one pass."""
+import datetime
+import logging
+import re
+from collections import defaultdict
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import models
+from django.db.models.functions import Coalesce
+from django.utils import timezone
+
+from .constants import CLICKS
+from .constants import DECISIONS
+from .constants import IMPRESSION_TYPES
+from .constants import OFFERS
+from .constants import VIEWS
+from .models import AdImpression
+from .models import Advertisement
+from .models import FlightImpression
+from .models import GeoImpression
+from .models import KeywordImpression
+from .models import Offer
+from .models import PlacementImpression
+from .models import Publisher
+from .models import PublisherMonthlyImpression
+from .models import Region
+from .models import RegionImpression
+from .models import RegionTopicImpression
+from .models import Topic
+from .models import UpliftImpression
+from .reports import BaseReport
+from .utils import get_day
+
+
+log = logging.getLogger(__name__)  # noqa
+
+
+class BaseAggregator:
+
+    """
+    Sums the offers for a day into the rows of one impression index.
+
+    Subclasses define the index ``model``, how an offer is keyed (:py:meth:`get_keys`)
+    and how the totals are written.
+    The totals of an offer are added to every key returned for it
+    (an offer can count towards multiple keywords or topics).
+
+    Normally the offers are a whole day and the totals replace the index for that day.
+    When ``incremental``, the offers are part of a day that hasn't been aggregated yet
+    and the totals are added to the index.
+    """
+
+    # The name of the index (eg. for ``./manage.py backfill_reports --index``)
+    name = None
+
+    # Model of the aggregated impression class
+    model = None
+
+    # The fields (in the order of the keys) that identify a row of the index
+    unique_fields = None
+
+    # The fields written for each row
+    update_fields = IMPRESSION_TYPES
+
+    # The rows are cumulative and are deleted and added to rather than replaced
+    cumulative = False
+
+    def __init__(self, start_date, end_date, incremental=False):
+        self.start_date = start_date
+        self.end_date = end_date
+        self.incremental = incremental
+
+        # The day of the offers (the date of the impressions)
+        self.day, _ = get_day(start_date)
+
+        # key -> {"decisions": 0, "offers": 0, "views": 0, "clicks": 0}
+        self.totals = defaultdict(lambda: dict.fromkeys(IMPRESSION_TYPES, 0))
+
+    def get_keys(self, offer):
+        """Get the keys of the rows an offer counts towards (if any)."""
+        raise NotImplementedError
+
+    def add(self, offer, counts):
+        """Add an offer's counts (eg. ``{"decisions": 1, "views": 0}``) to the totals."""
+        for key in self.get_keys(offer):
+            row = self.totals[key]
+            for field, count in counts.items():
+                row[field] += count
+
+    def get_rows(self):
+        for key, totals in self.totals.items():
+            yield {
+                "date": self.day,
+                **dict(zip(self.unique_fields, key)),
+                **totals,
+            }
+
+    def write(self):
+        """Write the totals to the writable database."""
+        log.info(
+            "Updating %s for %s-%s",
+            self.model._meta.verbose_name_plural,
+            self.start_date,
+            self.end_date,
+        )
+
+        if self.cumulative and not self.incremental:
+            # Remove all old impressions, because they are cumulative
+            self.model.objects.using("default").filter(date=self.day).delete()
+
+        self.model.bulk_upsert(
+            self.get_rows(),
+            unique_fields=("date", *self.unique_fields),
+            update_fields=self.update_fields,
+            increment=self.cumulative or self.incremental,
+            using="default",
+        )
+
+
+class ImpressionAggregator(BaseAggregator):
+
+    """Aggregates offers into ``AdImpression`` by publisher and ad."""
+
+    name = "impressions"
+    model = AdImpression
+    unique_fields = ("publisher_id", "advertisement_id")
+    update_fields = IMPRESSION_TYPES + ("view_time",)
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+
+        # The view time is NULL rather than 0 when no offer had a view time
+        self.view_times = {}
+
+    def get_keys(self, offer):
+        if offer.publisher_id:
+            yield (offer.publisher_id, offer.advertisement_id)
+
+    def add(self, offer, counts):
+        super().add(offer, counts)
+
+        key = (offer.publisher_id, offer.advertisement_id)
+        if offer.publisher_id and offer.view_time is not None:
+            self.view_times[key] = self.view_times.get(key, 0) + offer.view_time
+
+    def get_rows(self):
+        for row in super().get_rows():
+            key = (row["publisher_id"], row["advertisement_id"])
+            yield {**row, "view_time": self.view_times.get(key)}
+
+
+class PlacementAggregator(BaseAggregator):
+
+    """Aggregates offers into ``PlacementImpression`` for publishers recording placements."""
+
+    name = "placements"
+    model = PlacementImpression
+    unique_fields = ("publisher_id", "advertisement_id", "div_id", "ad_type_slug")
+
+    # Randomly generated div IDs from ethical-ad-client and Read the Docs
+    RANDOM_DIV_ID_RE = re.compile(r"(rtd-\w{4}|ad_\w{4}).*")
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+
+        self.publisher_ids = set(
+            Publisher.objects.using(settings.REPLICA_SLUG)
+            .filter(record_placements=True)
+            .values_list("pk", flat=True)
+        )
+
+    def get_keys(self, offer):
+        if (
+            offer.div_id is not None
+            and offer.publisher_id in self.publisher_ids
+            and not self.RANDOM_DIV_ID_RE.search(offer.div_id)
+        ):
+            yield (
+                offer.publisher_id,
+                offer.advertisement_id,
+                offer.div_id,
+                offer.ad_type_slug,
+            )
+
+
+class GeoAggregator(BaseAggregator):
+
+    """Aggregates offers into ``GeoImpression`` by country."""
+
+    name = "geos"
+    model = GeoImpression
+    unique_fields = ("publisher_id", "advertisement_id", "country")
+
+    def get_keys(self, offer):
+        if offer.country:
+            yield (offer.publisher_id, offer.advertisement_id, offer.country)
+
+
+class RegionAggregator(BaseAggregator):
+
+    """Aggregates offers into ``RegionImpression`` by the (non-overlapping) region of the country."""
+
+    name = "regions"
+    model = RegionImpression
+    unique_fields = ("publisher_id", "advertisement_id", "region")
+    cumulative = True
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+
+        # country -> region slug
+        self.regions = {}
+
+    def get_region(self, country):
+        if country not in self.regions:
+            self.regions[country] = Region.get_region_from_country_code(country)
+        return self.regions[country]
+
+    def get_keys(self, offer):
+        if offer.country:
+            yield (
+                offer.publisher_id,
+                offer.advertisement_id,
+                self.get_region(offer.country),
+            )
+
+
+class KeywordAggregator(BaseAggregator):
+
+    """Aggregates offers into ``KeywordImpression`` for keywords targeted by the ad's flight."""
+
+    name = "keywords"
+    model = KeywordImpression
+    unique_fields = ("publisher_id", "advertisement_id", "keyword")
+    cumulative = True
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+
+        self.all_topics = Topic.load_from_cache()
+
+        # advertisement ID -> keywords targeted by the ad's flight
+        self.flight_keywords = {}
+
+    def get_flight_keywords(self, advertisement_id):
+        if advertisement_id not in self.flight_keywords:
+            flight_targeting = (
+                Advertisement.objects.using(settings.REPLICA_SLUG)
+                .filter(pk=advertisement_id)
+                .values_list("flight__targeting_parameters", flat=True)
+                .first()
+            )
+
+            flight_keywords = set()
+            if flight_targeting:
+                flight_keywords.update(flight_targeting.get("include_keywords", {}))
+
+                # If this flight targeted topics, add those as well
+                for topic in flight_targeting.get("include_topics", {}):
+                    if topic in self.all_topics:
+                        flight_keywords.update(self.all_topics[topic])
+
+            self.flight_keywords[advertisement_id] = flight_keywords
+
+        return self.flight_keywords[advertisement_id]
+
+    def get_keys(self, offer):
+        if not (offer.keywords and offer.advertisement_id):
+            return
+
+        # Only store keywords where the advertiser targeting
+        # matched the keywords on the offer
+        flight_keywords = self.get_flight_keywords(offer.advertisement_id)
+        for keyword in set(offer.keywords) & flight_keywords:
+            yield (offer.publisher_id, offer.advertisement_id, keyword)
+
+
+class UpliftAggregator(BaseAggregator):
+
+    """Aggregates offers attributed to uplift into ``UpliftImpression``."""
+
+    name = "uplift"
+    model = UpliftImpression
+    unique_fields = ("publisher_id", "advertisement_id")
+
+    def get_keys(self, offer):
+        if offer.uplifted is not None:
+            yield (offer.publisher_id, offer.advertisement_id)
+
+
+class RegionTopicAggregator(BaseAggregator):
+
+    """
+    Aggregates offers into ``RegionTopicImpression`` by region and topic.
+
+    Each offer has one region, but multiple possible topics.
+    """
+
+    name = "regiontopics"
+    model = RegionTopicImpression
+    unique_fields = ("advertisement_id", "region", "topic")
+    cumulative = True
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+
+        self.all_topics = Topic.load_from_cache()
+        self.regions = {}
+
+        # keywords -> topics
+        self.topics = {}
+
+    def get_region(self, country):
+        if country not in self.regions:
+            self.regions[country] = Region.get_region_from_country_code(country)
+        return self.regions[country]
+
+    def get_topics(self, keywords):
+        keywords = frozenset(keywords)
+        if keywords not in self.topics:
+            topics = {
+                topic
+                for topic, topic_keywords in self.all_topics.items()
+                if keywords.intersection(topic_keywords)
+            }
+
+            # If nothing gets set as a topic, assign it other
+            self.topics[keywords] = topics or {"other"}
+
+        return self.topics[keywords]
+
+    def get_keys(self, offer):
+        if not (offer.keywords and offer.country):
+            return
+
+        region = self.get_region(offer.country)
+        for topic in self.get_topics(offer.keywords):
+            yield (offer.advertisement_id, region, topic)
+
+
+# The aggregators run by ``update_previous_day_reports``
+DAILY_AGGREGATORS = (
+    GeoAggregator,
+    RegionAggregator,
+    PlacementAggregator,
+    ImpressionAggregator,
+    KeywordAggregator,
+    UpliftAggregator,
+    RegionTopicAggregator,
+)
+
+
+# Index name -> aggregator
+AGGREGATORS_BY_NAME = {aggregator.name: aggregator for aggregator in DAILY_AGGREGATORS}
+
+# The aggregators run by ``update_today_reports``
+# AdImpressions are excluded since they are counted as the impressions happen
+INCREMENTAL_AGGREGATORS = tuple(
+    aggregator
+    for aggregator in DAILY_AGGREGATORS
+    if aggregator is not ImpressionAggregator
+)
+
+# The date of the last offer that was incrementally aggregated
+HIGH_WATER_MARK_CACHE_KEY = "aggregation-high-water-mark"
+HIGH_WATER_MARK_LOCK_CACHE_KEY = "aggregation-high-water-mark-lock"
+HIGH_WATER_MARK_LOCK_TIMEOUT = 60 * 60  # seconds
+
+
+def aggregate_offers(day=None, aggregators=DAILY_AGGREGATORS, chunk_size=10_000):
+    """
+    Aggregate a day of offers into one or more impression indexes with a single scan.
+
+    The offers are streamed from the replica (with a server-side cursor on PostgreSQL)
+    rather than grouped by the database once per index
+    which scanned the whole day of the offer table for every index.
+
+    This doesn't invalidate cached reports (see ``invalidate_report_cache``)
+    since that should happen once the rollups of the indexes are updated too.
+
+    :arg day: An optional datetime object representing a day
+    :arg aggregators: the :py:class:`BaseAggregator` classes to run
+    :arg chunk_size: the number of offers fetched from the database at a time
+    :returns: the number of offers aggregated
+    """
+    start_date, end_date = get_day(day)
+    return _aggregate_offers(start_date, end_date, aggregators, False, chunk_size)
+
+
+def aggregate_new_offers(aggregators=INCREMENTAL_AGGREGATORS, chunk_size=10_000):
+    """
+    Add the offers since the last time this ran to today's impression indexes.
+
+    Offers are aggregated up to ``ADSERVER_AGGREGATION_DELAY`` seconds ago
+    so most views and clicks on them have already happened.
+    Views, clicks and uplift on an offer after it is aggregated (and offers written late)
+    are only counted when the whole day is aggregated again by ``update_previous_day_reports``.
+
+    If there's no record of what was aggregated so far today (eg. the first run of the day),
+    today so far is aggregated again rather than risk counting offers twice.
+
+    :arg aggregators: the :py:class:`BaseAggregator` classes to run
+    :arg chunk_size: the number of offers fetched from the database at a time
+    :returns: the date up to which offers have been aggregated or ``None`` if already running
+    """
+    if not cache.add(
+        HIGH_WATER_MARK_LOCK_CACHE_KEY, True, HIGH_WATER_MARK_LOCK_TIMEOUT
+    ):
+        log.warning("Skipping aggregating new offers since it is already running")
+        return None
+
+    try:
+        until = timezone.now() - datetime.timedelta(
+            seconds=settings.ADSERVER_AGGREGATION_DELAY
+        )
+        start_date, _ = get_day(until)
+        high_water_mark = cache.get(HIGH_WATER_MARK_CACHE_KEY)
+
+        if high_water_mark is None or high_water_mark < start_date:
+            _aggregate_offers(start_date, until, aggregators, False, chunk_size)
+        elif high_water_mark < until:
+            _aggregate_offers(high_water_mark, until, aggregators, True, chunk_size)
+
+        cache.set(HIGH_WATER_MARK_CACHE_KEY, until, timeout=None)
+    finally:
+        cache.delete(HIGH_WATER_MARK_LOCK_CACHE_KEY)
+
+    return until
+
+
+def _aggregate_offers(start_date, end_date, aggregators, incremental, chunk_size):
+    aggregators = [
+        aggregator(start_date, end_date, incremental=incremental)
+        for aggregator in aggregators
+    ]
+
+    log.info("Aggregating offers for %s-%s", start_date, end_date)
+
+    offer_count = 0
+    queryset = Offer.objects.using(settings.REPLICA_SLUG).filter(
+        date__gte=start_date,
+        date__lt=end_date,  # Things at UTC midnight should count towards tomorrow
+    )
+    for offer in queryset.values_list(
+        "publisher_id",
+        "advertisement_id",
+        "country",
+        "div_id",
+        "ad_type_slug",
+        "keywords",
+        "viewed",
+        "clicked",
+        "uplifted",
+        "view_time",
+        named=True,
+    ).iterator(chunk_size=chunk_size):
+        counts = {
+            DECISIONS: 1,
+            OFFERS: int(offer.advertisement_id is not None),
+            VIEWS: int(offer.viewed),
+            CLICKS: int(offer.clicked),
+        }
+        for aggregator in aggregators:
+            aggregator.add(offer, counts)
+        offer_count += 1
+
+    for aggregator in aggregators:
+        aggregator.write()
+
+    return offer_count
+
+
+def update_rollups(day=None):
+    """
+    Recompute the rollups of ``AdImpression`` covering a day.
+
+    This is the ``PublisherMonthlyImpression`` rows for the day's month
+    and the ``FlightImpression`` rows for the day.
+    Each is recomputed from the ad impressions with one grouped query
+    so this can be run again for a day (eg. by a backfill) without counting anything twice.
+
+    :arg day: An optional datetime object representing a day
+    """
+    start_date, _ = get_day(day)
+    day = start_date.date()
+    month = day.replace(day=1)
+    next_month = (month + datetime.timedelta(days=32)).replace(day=1)
+
+    log.info("Updating impression rollups for %s", day)
+
+    sums = {
+        "decisions_sum": models.Sum("decisions"),
+        "offers_sum": models.Sum("offers"),
+        "views_sum": models.Sum("views"),
+        "clicks_sum": models.Sum("clicks"),
+        # There's no revenue for offers with no views/clicks
+        "revenue_sum": Coalesce(
+            models.Sum(BaseReport.get_revenue_expression()),
+            0.0,
+            output_field=models.FloatField(),
+        ),
+    }
+
+    # The ad impressions for the day were just written to the writable database
+    queryset = AdImpression.objects.using("default").order_by()
+
+    rows = (
+        queryset.filter(date__gte=month, date__lt=next_month, publisher__isnull=False)
+        .values(
+            "publisher_id",
+            campaign_type=models.F("advertisement__flight__campaign__campaign_type"),
+        )
+        .annotate(**sums)
+    )
+    PublisherMonthlyImpression.bulk_upsert(
+        (
+            {
+                "date": month,
+                "publisher_id": row["publisher_id"],
+                "campaign_type": row["campaign_type"],
+                **_get_rollup_fields(row),
+            }
+            for row in rows
+        ),
+        unique_fields=("publisher_id", "campaign_type", "date"),
+        update_fields=IMPRESSION_TYPES + ("revenue",),
+    )
+
+    rows = (
+        queryset.filter(date=day, advertisement__isnull=False)
+        .values(flight_id=models.F("advertisement__flight_id"))
+        .annotate(**sums)
+    )
+    FlightImpression.bulk_upsert(
+        (
+            {"date": day, "flight_id": row["flight_id"], **_get_rollup_fields(row)}
+            for row in rows
+        ),
+        unique_fields=("flight_id", "date"),
+        update_fields=IMPRESSION_TYPES + ("revenue",),
+    )
+
+
+def _get_rollup_fields(row):
+    fields = {field: row[f"{field}_sum"] for field in IMPRESSION_TYPES}
+    fields["revenue"] = row["revenue_sum"]
+    return fields
@@ -102,6 +102,16 @@ class AdDecisionSerializer(serializers.Serializer):
             return None
 
 
+class AdBatchDecisionSerializer(AdDecisionSerializer):
+
+    """De-serializes incoming placements to fill for the batch ad API."""
+
+    MAX_PLACEMENTS = 10
+
+    # Every placement is filled rather than being alternatives
+    placements = AdPlacementSerializer(many=True, max_length=MAX_PLACEMENTS)
+
+
 class PublisherSerializer(serializers.HyperlinkedModelSerializer):
     class Meta:
         model = Publisher
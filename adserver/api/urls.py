@@ -2,6 +2,7 @@
 from django.urls import path
 from rest_framework import routers
 
+from .views import AdBatchDecisionView
 from .views import AdDecisionView
 from .views import AdvertiserViewSet
 from .views import PublisherViewSet
@@ -9,7 +10,10 @@ from .views import PublisherViewSet
 
 app_name = "api"
 
-urlpatterns = [path(r"decision/", AdDecisionView.as_view(), name="decision")]
+urlpatterns = [
+    path(r"decision/", AdDecisionView.as_view(), name="decision"),
+    path(r"decision/batch/", AdBatchDecisionView.as_view(), name="decision-batch"),
+]
 
 router = routers.SimpleRouter()
 router.register(r"advertisers", AdvertiserViewSet, basename="advertisers")
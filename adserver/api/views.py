@@ -25,6 +25,7 @@ from ..utils import get_client_id
 from ..utils import parse_date_string
 from .mixins import GeoIpMixin
 from .permissions import AdDecisionPermission
+from .serializers import AdBatchDecisionSerializer
 from .serializers import AdDecisionSerializer
 from .serializers import AdvertisementSerializer
 from .serializers import AdvertiserSerializer
@@ -308,6 +309,142 @@ class AdDecisionView(GeoIpMixin, APIView):
         return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
 
 
+class AdBatchDecisionView(AdDecisionView):
+
+    """
+    Make decisions on ads to show in multiple placements on the same page.
+
+    .. http:get:: /api/v1/decision/batch/
+
+        Request an advertisement for each of multiple placements.
+
+        The parameters are the same as the single decision API
+        except that an ad is chosen for *every* placement (up to 10)
+        rather than treating the placements as alternatives.
+        A different ad is chosen for each placement when possible.
+
+        :>json array decisions: The decisions (see the single decision API)
+            in the same order as the placements.
+            A placement without an ad only contains the ``div_id``.
+
+        An example::
+
+            {
+                "ad_types": "image-v1|text-v1",
+                "div_ids": "image-div|text-div"
+            }
+
+    .. http:post:: /api/v1/decision/batch/
+
+        Authentication is required for this endpoint.
+        The POST version of the API is similar to the POST version of the single decision API.
+    """
+
+    def decision(self, request, data):
+        """
+        Makes a decision on an ad to display for each placement.
+
+        The backend (publisher, keywords, etc.) is shared by all the placements
+        and the resulting offers are written in bulk.
+        """
+        serializer = AdBatchDecisionSerializer(data=data)
+
+        if not serializer.is_valid():
+            return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+
+        publisher = serializer.validated_data["publisher"]
+        self.check_object_permissions(request, publisher)
+        url = serializer.validated_data.get("url")
+        forced = bool(
+            serializer.validated_data.get("force_ad")
+            or serializer.validated_data.get("force_campaign")
+        )
+        backend = get_ad_decision_backend()(
+            # Required parameters
+            request=request,
+            placements=serializer.validated_data["placements"],
+            publisher=publisher,
+            # Optional parameters
+            keywords=serializer.validated_data.get("keywords"),
+            campaign_types=serializer.validated_data.get("campaign_types"),
+            url=url,
+            # Debugging parameters
+            ad_slug=serializer.validated_data.get("force_ad"),
+            campaign_slug=serializer.validated_data.get("force_campaign"),
+        )
+        placements = serializer.validated_data["placements"]
+
+        decisions = [None] * len(placements)
+        if publisher.cache_ads:
+            # Check if this client should get sticky ad decisions
+            for i, placement in enumerate(placements):
+                decisions[i] = cache.get(
+                    self._sticky_placement_cache_key(publisher, placement)
+                )
+
+        # The other placements don't repeat the sticky ads
+        sticky_ad_slugs = [decision["id"] for decision in decisions if decision]
+        if sticky_ad_slugs:
+            backend.excluded_ads.update(
+                Advertisement.objects.filter(slug__in=sticky_ad_slugs).values_list(
+                    "pk", flat=True
+                )
+            )
+
+        # Only the placements without a sticky ad get new ads
+        unfilled = [i for i, decision in enumerate(decisions) if not decision]
+        offers = [
+            (i, ad, placement)  # Index into decisions, ad, placement
+            for i, (ad, placement) in zip(
+                unfilled,
+                backend.get_ads_for_placements([placements[i] for i in unfilled]),
+            )
+        ]
+
+        # Record all the offers (and decisions without an ad) at once
+        # We need backend.keywords here to get the combined publisher/user/analyzer keywords
+        offer_data = Advertisement.offer_ads(
+            request=request,
+            publisher=publisher,
+            placements=[
+                (ad, placement["ad_type"], placement["div_id"])
+                for _, ad, placement in offers
+            ],
+            keywords=backend.keywords,
+            url=url,
+            forced=forced,
+        )
+        for (i, ad, placement), data in zip(offers, offer_data):
+            decisions[i] = data
+            if ad and publisher.cache_ads:
+                duration = (
+                    publisher.cache_ads_duration
+                    or settings.ADSERVER_STICKY_DECISION_DURATION
+                )
+                cache.set(
+                    self._sticky_placement_cache_key(publisher, placement),
+                    data,
+                    duration,
+                )
+
+        for data, placement in zip(decisions, placements):
+            # The div where the ad is chosen to go is echoed back to the client
+            data.update({"div_id": placement["div_id"]})
+
+        log.debug(
+            "Offering ads in batch. publisher=%s placements=%s keywords=%s",
+            publisher,
+            len(decisions),
+            backend.keywords,
+        )
+        return Response({"decisions": decisions})
+
+    def _sticky_placement_cache_key(self, publisher, placement):
+        # Multiple placements can have the same ad type but should get different ads
+        ad_type = placement["ad_type"]
+        return f"{self._sticky_decision_cache_key(publisher, ad_type)}-{placement['div_id']}"
+
+
 class AdvertiserViewSet(viewsets.ReadOnlyModelViewSet):
 
     """
@@ -9,3 +9,4 @@ class AdserverConfig(AppConfig):
     def ready(self):
         import adserver.tasks  # noqa
         import adserver.hooks  # noqa
+        import adserver.signals  # noqa
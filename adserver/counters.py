@@ -0,0 +1,251 @@
+"""Coalesce impression counts in memory before writing them to the database."""
+import atexit
+import functools
+import logging
+import os
+import threading
+import time
+from collections import Counter
+
+from django.conf import settings
+from django.db import connections
+from django.db import models
+from django.db import transaction
+
+from .constants import CLICKS
+from .constants import IMPRESSION_TYPES
+from .constants import VIEWS
+
+
+log = logging.getLogger(__name__)  # noqa
+
+
+class ImpressionCounter:
+
+    """
+    Accumulates impression counts (decisions, offers, views, clicks) in this process.
+
+    Every count used to update the same few rows (the ``AdImpression`` for an ad/publisher/day
+    and the denormalized totals on the ``Flight``) and hot rows became a point of lock contention.
+    Instead, counts are summed in memory and written with a single statement per row
+    every ``ADSERVER_COUNTER_FLUSH_INTERVAL`` seconds.
+
+    Counts are flushed by a background thread in each process (started by the first count)
+    rather than during a request, so the writes are never part of a request's transaction
+    and don't hold row locks until a request finishes.
+    Counts that fail to be written are added back to be written with the next flush.
+
+    Counts are only added once the request's transaction commits
+    so impressions from requests that are rolled back aren't counted
+    (the same as when each impression was written in the request).
+
+    Counts that haven't been written yet (including those being written)
+    are available from :py:meth:`get_pending_flight_totals` and :py:meth:`get_pending_impressions`.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        # Only one flush writes at a time
+        self.flush_lock = threading.Lock()
+        self.reset()
+
+        # The counts being written by a flush (until they are committed)
+        self.flushing_impressions = Counter()
+        self.flushing_flights = Counter()
+
+        # The background flush thread and the process it was started in
+        # (threads don't survive a fork, eg. by gunicorn)
+        self.thread = None
+        self.thread_pid = None
+
+    def reset(self):
+        # (flight ID, ad ID, publisher ID, date, impression type) -> count
+        self.impressions = Counter()
+        # (flight ID, impression type) -> count
+        self.flights = Counter()
+        self.started = None
+
+    @staticmethod
+    def is_enabled():
+        return bool(settings.ADSERVER_COUNTER_FLUSH_INTERVAL)
+
+    def add(self, flight_id, advertisement_id, publisher_id, day, impression_types):
+        """Count the impressions for an ad (``None`` for decisions without an ad)."""
+        self.start()
+
+        # Outside of a transaction, this counts immediately
+        transaction.on_commit(
+            functools.partial(
+                self._add,
+                flight_id,
+                advertisement_id,
+                publisher_id,
+                day,
+                impression_types,
+            ),
+            using="default",
+        )
+
+    def _add(self, flight_id, advertisement_id, publisher_id, day, impression_types):
+        with self.lock:
+            if self.started is None:
+                self.started = time.monotonic()
+
+            for impression_type in impression_types:
+                self.impressions[
+                    (flight_id, advertisement_id, publisher_id, day, impression_type)
+                ] += 1
+                if flight_id and impression_type in (CLICKS, VIEWS):
+                    self.flights[(flight_id, impression_type)] += 1
+
+    def get_pending_flight_totals(self, flight_id):
+        """Get the clicks and views for a flight that haven't been written."""
+        return tuple(
+            self.flights.get((flight_id, impression_type), 0)
+            + self.flushing_flights.get((flight_id, impression_type), 0)
+            for impression_type in (CLICKS, VIEWS)
+        )
+
+    def get_pending_impressions(self, flight_id, day, impression_type):
+        """Get the impressions of a type for a flight on a day that haven't been written."""
+        # Copy the keys since another thread may be adding counts
+        return sum(
+            count
+            for impressions in (self.impressions, self.flushing_impressions)
+            for (key_flight_id, _, _, key_day, key_type), count in list(
+                impressions.items()
+            )
+            if key_flight_id == flight_id
+            and key_day == day
+            and key_type == impression_type
+        )
+
+    def start(self):
+        """Start the thread which flushes the counts in this process (if not running)."""
+        pid = os.getpid()
+        if self.thread_pid == pid and self.thread.is_alive():
+            return
+
+        with self.lock:
+            if self.thread_pid == pid and self.thread.is_alive():
+                return
+            self.thread = threading.Thread(
+                target=self.run, name="impression-counter-flush", daemon=True
+            )
+            self.thread_pid = pid
+            self.thread.start()
+
+    def run(self):
+        """Flush the counts every flush interval (the background thread)."""
+        while True:
+            time.sleep(settings.ADSERVER_COUNTER_FLUSH_INTERVAL or 1)
+            try:
+                self.flush_if_needed()
+            except Exception:  # noqa
+                log.exception("Failed to flush impression counts")
+            finally:
+                # This thread's connections aren't managed by a request
+                connections.close_all()
+
+    def flush_if_needed(self):
+        """Write the counts if they have been accumulating longer than the flush interval."""
+        started = self.started
+        if (
+            started is not None
+            and time.monotonic() - started >= settings.ADSERVER_COUNTER_FLUSH_INTERVAL
+        ):
+            self.flush()
+
+    def flush(self):
+        """
+        Write the summed counts to the database with one statement per row.
+
+        The pending counts are swapped out under the lock and written in their own transaction.
+        They are still included in the pending counts until the write is committed.
+        If writing fails, the counts are added back and the error is raised.
+        """
+        with self.flush_lock:
+            with self.lock:
+                impressions = self.impressions
+                flights = self.flights
+                self.reset()
+                self.flushing_impressions = impressions
+                self.flushing_flights = flights
+
+            written = False
+            try:
+                if impressions:
+                    with transaction.atomic(using="default"):
+                        self._write(impressions, flights)
+                written = True
+            finally:
+                with self.lock:
+                    if not written:
+                        # Add the counts back to be written with the next flush
+                        if self.started is None:
+                            self.started = time.monotonic()
+                        self.impressions.update(impressions)
+                        self.flights.update(flights)
+                    self.flushing_impressions = Counter()
+                    self.flushing_flights = Counter()
+
+    def _write(self, impressions, flights):
+        from .models import AdImpression  # noqa
+        from .models import Flight  # noqa
+
+        # Group the counts by the impression row they are for
+        rows = {}
+        for (
+            _,
+            ad_id,
+            publisher_id,
+            day,
+            impression_type,
+        ), count in impressions.items():
+            row = rows.setdefault(
+                (ad_id, publisher_id, day),
+                {
+                    "publisher_id": publisher_id,
+                    "advertisement_id": ad_id,
+                    "date": day,
+                    **{imp_type: 0 for imp_type in IMPRESSION_TYPES},
+                },
+            )
+            row[impression_type] += count
+
+        # Make sure to write to the writable DB
+        AdImpression.bulk_upsert(
+            rows.values(),
+            unique_fields=AdImpression.UNIQUE_FIELDS,
+            update_fields=IMPRESSION_TYPES,
+            increment=True,
+            using="default",
+        )
+
+        flight_totals = {}
+        for (flight_id, impression_type), count in flights.items():
+            flight_totals.setdefault(flight_id, {})[f"total_{impression_type}"] = count
+        for flight_id, totals in flight_totals.items():
+            Flight.objects.filter(pk=flight_id).update(
+                **{field: models.F(field) + count for field, count in totals.items()}
+            )
+
+        log.debug(
+            "Flushed impression counts. impressions=%s flights=%s",
+            len(rows),
+            len(flight_totals),
+        )
+
+
+# The counts for this process
+impression_counter = ImpressionCounter()
+
+
+@atexit.register
+def flush_at_exit():
+    """Don't lose counts that haven't been written when the process exits."""
+    if impression_counter.impressions:
+        try:
+            impression_counter.flush()
+        except Exception:
+            log.exception("Failed to flush impression counts on exit")
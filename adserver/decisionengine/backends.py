@@ -3,7 +3,6 @@ import logging
 import random
 
 from django.db import models
-from user_agents import parse
 
 from ..analyzer.models import AnalyzedUrl
 from ..analyzer.utils import normalize_url
@@ -15,7 +14,12 @@ from ..constants import PAID_CAMPAIGN
 from ..constants import PUBLISHER_HOUSE_CAMPAIGN
 from ..models import Flight
 from ..utils import get_ad_day
-from ..utils import get_client_user_agent
+from ..utils import get_client_parsed_user_agent
+from ..utils import get_domain_from_url
+from .index import FlightIndex
+from .pacing import FlightPacing
+from .pacing import PacingSnapshot
+from .sampling import WeightedSampler
 
 log = logging.getLogger(__name__)
 
@@ -33,7 +37,7 @@ class BaseAdDecisionBackend:
         :param kwargs: Any additional possible arguments for the backend
         """
         self.request = request
-        self.user_agent = parse(get_client_user_agent(request))
+        self.user_agent = get_client_parsed_user_agent(request)
         self.placements = placements
         self.publisher = publisher
 
@@ -107,6 +111,13 @@ class BaseAdDecisionBackend:
         self.ad_slug = kwargs.get("ad_slug")
         self.campaign_slug = kwargs.get("campaign_slug")
 
+        # Computed once per decision rather than once per candidate flight
+        self.keyword_set = frozenset(self.keywords)
+        self.domain = get_domain_from_url(self.url)
+
+        # Ads that shouldn't be chosen (already chosen for another placement)
+        self.excluded_ads = set()
+
     def get_analyzer_keywords(self):
         """Get keywords for this URL from the analyzer."""
         if not self.url:
@@ -143,6 +154,41 @@ class BaseAdDecisionBackend:
             "subclasses of BaseAdDecisionBackend must override get_ad_and_placement()"
         )
 
+    def get_ads_for_placements(self, placements=None):
+        """
+        Choose a different ad for each placement (eg. multiple ad slots on the same page).
+
+        Unlike :py:meth:`get_ad_and_placement` where the placements are alternatives
+        and a single ad is chosen, here every placement is filled if possible.
+        The backend (keywords, campaign types, etc.) is shared by all the placements.
+
+        :param placements: the placements to fill (eg. without those with a sticky ad)
+            or all of the placements by default
+        :return: A list of 2-tuples of the `Advertisement` object (or ``None``)
+            and the placement in the same order as the placements
+        """
+        if placements is None:
+            placements = self.placements
+
+        all_placements = self.placements
+        ad_types = self.ad_types
+        ads_and_placements = []
+
+        try:
+            for placement in placements:
+                self.placements = [placement]
+                self.ad_types = [placement["ad_type"]]
+
+                ad, _ = self.get_ad_and_placement()
+                if ad:
+                    self.excluded_ads.add(ad.pk)
+                ads_and_placements.append((ad, placement))
+        finally:
+            self.placements = all_placements
+            self.ad_types = ad_types
+
+        return ads_and_placements
+
     def get_placement(self, advertisement):
         """Gets the first matching placement for a given ad."""
         if not advertisement:
@@ -253,32 +299,39 @@ class AdvertisingEnabledBackend(BaseAdDecisionBackend):
             # Skip filtering if the ad or campaign are specified
             return True
 
+        # Targeting is compiled once per flight (see ``Flight.targeting``)
+        targeting = flight.targeting
+
         # Skip if we aren't meant to show to this country/state/dma
-        if not flight.show_to_geo(self.geolocation):
+        if not targeting.show_to_geo(self.geolocation):
             return False
 
         # Skip if we aren't meant to show to these keywords
-        if not flight.show_to_keywords(self.keywords):
+        if not targeting.show_to_keywords(self.keyword_set):
             return False
 
         # Skip if we aren't meant to show to this traffic because it is mobile or non-mobile
-        if not flight.show_to_mobile(self.user_agent.is_mobile):
+        if not targeting.show_to_mobile(self.user_agent.is_mobile):
             return False
 
         # Skip if this flight is ineligible for this publisher
-        if not flight.show_on_publisher(self.publisher):
+        if not targeting.show_on_publisher(self.publisher.slug):
             return False
 
         # Skip if we shouldn't show this flight on this domain
-        if not flight.show_on_domain(self.url):
+        if not targeting.show_on_domain(self.domain):
             return False
 
         # Skip if there are no clicks or views needed today (ad pacing)
-        if flight.weighted_clicks_needed_today() <= 0:
+        if self.get_flight_pacing(flight).weighted_clicks_needed() <= 0:
             return False
 
         return True
 
+    def get_flight_pacing(self, flight):
+        """Get the clicks and views a flight needs today."""
+        return FlightPacing(flight)
+
     def select_flight(self):
         """Naively select a flight from the candidates."""
         flights = self.get_candidate_flights()
@@ -298,6 +351,7 @@ class AdvertisingEnabledBackend(BaseAdDecisionBackend):
 
         return (
             flight.advertisements.filter(live=True, ad_types__slug__in=self.ad_types)
+            .exclude(pk__in=self.excluded_ads)
             .order_by("?")
             .first()
         )
@@ -316,8 +370,45 @@ class ProbabilisticFlightBackend(AdvertisingEnabledBackend):
     * Randomly select a paid ad based with random weights based on clicks needed
     * If no matching paid ads, randomly select a community ad
     * If no matching community ad, randomly select a house ad
+
+    Candidate flights and ads come from the in-memory :py:class:`~FlightIndex`
+    rather than querying the database on each decision.
     """
 
+    pacing_snapshot = None
+
+    def get_flight_index(self):
+        """Get this process' flight index, rebuilding it if it has changed."""
+        return FlightIndex.load()
+
+    def get_flight_pacing(self, flight):
+        """Get the clicks and views a flight needs today from the pacing snapshot."""
+        if self.ad_slug or self.campaign_slug:
+            return super().get_flight_pacing(flight)
+
+        if self.pacing_snapshot is None:
+            self.pacing_snapshot = PacingSnapshot.load(self.get_flight_index())
+        return self.pacing_snapshot.get_pacing(flight)
+
+    def get_candidate_flights(self):
+        """
+        Get all valid, live flights from the flight index.
+
+        Forcing a specific ad or campaign skips the index (and filtering by live or date).
+        """
+        if self.ad_slug or self.campaign_slug:
+            return super().get_candidate_flights()
+
+        if not self.should_display_ads():
+            return []
+
+        return self.get_flight_index().get_flights(
+            publisher=self.publisher,
+            ad_types=self.ad_types,
+            campaign_types=self.campaign_types,
+            day=get_ad_day().date(),
+        )
+
     def select_flight(self):
         """
         Select a flight from the candidates.
@@ -327,6 +418,9 @@ class ProbabilisticFlightBackend(AdvertisingEnabledBackend):
         """
         flights = self.get_candidate_flights()
 
+        # Pacing for all candidate flights comes from a single snapshot
+        self.pacing_snapshot = None
+
         paid_flights = []
         affiliate_flights = []
         community_flights = []
@@ -357,39 +451,31 @@ class ProbabilisticFlightBackend(AdvertisingEnabledBackend):
             house_flights,
         ):
             # Choose a flight based on the impressions needed
-            flight_range = []
-            total_clicks_needed = 0
+            weighted_flights = []
             for flight in possible_flights:
                 if not self.filter_flight(flight):
                     continue
 
+                # Skip if all this flight's ads were already chosen for another placement
+                if self.excluded_ads and not any(
+                    ad.pk not in self.excluded_ads
+                    for ad in self.get_flight_index().get_ads(flight, self.ad_types)
+                ):
+                    continue
+
                 # If any impressions/clicks are needed, add this flight
                 # to the possible list of flights
-                if any(
-                    (
-                        (flight.clicks_needed_today() > 0),
-                        (flight.views_needed_today() > 0),
-                    )
-                ):
+                pacing = self.get_flight_pacing(flight)
+                if pacing.clicks_needed > 0 or pacing.views_needed > 0:
                     # NOTE: takes into account views for CPM ads
                     # Takes eCPM (CTR * CPC for CPC ads) into account
-                    weighted_clicks_needed_today = flight.weighted_clicks_needed_today(
-                        self.publisher
-                    )
-
-                    flight_range.append(
-                        [
-                            total_clicks_needed,
-                            total_clicks_needed + weighted_clicks_needed_today,
-                            flight,
-                        ]
+                    weighted_flights.append(
+                        (flight, pacing.weighted_clicks_needed(self.publisher))
                     )
-                    total_clicks_needed += weighted_clicks_needed_today
 
-            choice = random.randint(0, total_clicks_needed)
-            for min_clicks, max_clicks, flight in flight_range:
-                if min_clicks <= choice <= max_clicks:
-                    return flight
+            flight = WeightedSampler(weighted_flights).choose()
+            if flight:
+                return flight
 
         return None
 
@@ -402,23 +488,28 @@ class ProbabilisticFlightBackend(AdvertisingEnabledBackend):
         if not flight:
             return None
 
-        chosen_ad = None
         max_priority = 10
-        weighted_ad_choices = []
+        weighted_ads = []
 
-        if self.ad_slug:
-            # Ignore live and adtype checks when forcing a specific ad
-            candidate_ads = flight.advertisements.filter(slug=self.ad_slug)
-        else:
-            candidate_ads = flight.advertisements.filter(
-                live=True, ad_types__slug__in=self.ad_types
-            )
+        if self.ad_slug or self.campaign_slug:
+            if self.ad_slug:
+                # Ignore live and adtype checks when forcing a specific ad
+                candidate_ads = flight.advertisements.filter(slug=self.ad_slug)
+            else:
+                candidate_ads = flight.advertisements.filter(
+                    live=True, ad_types__slug__in=self.ad_types
+                )
 
-        candidate_ads = candidate_ads.select_related("flight").prefetch_related(
-            "ad_types"
-        )
+            candidate_ads = candidate_ads.select_related("flight").prefetch_related(
+                "ad_types"
+            )
+        else:
+            candidate_ads = self.get_flight_index().get_ads(flight, self.ad_types)
 
         for advertisement in candidate_ads:
+            if advertisement.pk in self.excluded_ads:
+                continue
+
             placement = self.get_placement(advertisement)
             if not placement:
                 log.warning(
@@ -428,12 +519,10 @@ class ProbabilisticFlightBackend(AdvertisingEnabledBackend):
                 )
                 continue
             priority = placement.get("priority", 1)
-            for _ in range(max_priority + 1 - priority):
-                weighted_ad_choices.append(advertisement)
+            weighted_ads.append((advertisement, max_priority + 1 - priority))
 
-        if weighted_ad_choices:
-            chosen_ad = random.choice(weighted_ad_choices)
-        else:
+        chosen_ad = WeightedSampler(weighted_ads).choose()
+        if not chosen_ad:
             log.warning(
                 "Chosen flight has no matching live ads! flight=%s, ad_types=%s",
                 flight,
@@ -0,0 +1,206 @@
+"""An in-memory index of live flights used by the decision backends."""
+import logging
+import time
+import uuid
+from collections import defaultdict
+
+from django.core.cache import cache
+
+from ..models import Advertisement
+from ..models import Campaign
+from ..models import Flight
+from ..models import PublisherGroup
+from ..models import Region
+from ..models import Topic
+
+
+log = logging.getLogger(__name__)  # noqa
+
+
+class FlightIndex:
+
+    """
+    A compiled index of all live flights and their live ads.
+
+    Ad decisions are the hottest path on the ad server and the candidate flight query
+    (multiple joins across ads, ad types, campaigns and publishers) was run on every request.
+    Instead, the index is built once per process and kept in memory (``FlightIndex.current``)
+    and candidate selection becomes dictionary and set lookups.
+
+    The index is rebuilt when it expires (``CACHE_TIMEOUT``) or when it is invalidated
+    by saving or deleting a flight, ad or campaign (see ``adserver.signals``).
+    Invalidation works across processes by storing a version token in the shared cache
+    so checking the index is current is a single small cache lookup.
+
+    Denormalized totals on the indexed flights (``total_clicks``, ``total_views``)
+    may be up to ``CACHE_TIMEOUT`` seconds old.
+    Pacing uses fresher totals from :py:class:`~adserver.decisionengine.pacing.PacingSnapshot`.
+    """
+
+    CACHE_TIMEOUT = 60
+    VERSION_CACHE_KEY = "decision-flight-index-version"
+
+    # The index for this process
+    current = None
+
+    def __init__(self, flights, ads, version=None):
+        """
+        Compile the index from the live flights and ads.
+
+        :param flights: live flights with the campaign selected
+        :param ads: live ads for those flights with the ad types prefetched
+        :param version: the version token this index was built for
+        """
+        self.version = version
+        self.expires = time.monotonic() + self.CACHE_TIMEOUT
+
+        # Flights in the default (name) order
+        self.flights = []
+
+        # flight ID -> list of live ads
+        self.flight_ads = defaultdict(list)
+
+        # ad ID -> frozenset of ad type slugs
+        self.ad_type_slugs = {}
+
+        # ad type slug -> set of flight IDs with a live ad of that type
+        self.ad_type_flights = defaultdict(set)
+
+        # publisher ID -> set of flight IDs eligible on that publisher
+        self.publisher_flights = defaultdict(set)
+
+        flights_by_id = {flight.pk: flight for flight in flights}
+
+        for ad in ads:
+            # Share the same flight instance across all its ads
+            ad.flight = flights_by_id[ad.flight_id]
+            slugs = frozenset(ad_type.slug for ad_type in ad.ad_types.all())
+
+            self.flight_ads[ad.flight_id].append(ad)
+            self.ad_type_slugs[ad.pk] = slugs
+            for slug in slugs:
+                self.ad_type_flights[slug].add(ad.flight_id)
+
+        # Flights without any live ads can never be chosen
+        self.flights = [flight for flight in flights if flight.pk in self.flight_ads]
+
+        # Compile the targeting now so it is cached along with the index
+        for flight in self.flights:
+            flight.targeting  # noqa
+
+        self._index_publishers(self.flights)
+
+    def _index_publishers(self, flights):
+        """Compile which flights are eligible on each publisher from the campaign settings."""
+        campaign_flights = defaultdict(set)
+        for flight in flights:
+            campaign_flights[flight.campaign_id].add(flight.pk)
+
+        campaign_ids = list(campaign_flights)
+
+        # Deprecated: remove after publisher groups are rolled out and configured in production
+        for campaign_id, publisher_id in Campaign.publishers.through.objects.filter(
+            campaign_id__in=campaign_ids
+        ).values_list("campaign_id", "publisher_id"):
+            self.publisher_flights[publisher_id] |= campaign_flights[campaign_id]
+
+        group_campaigns = defaultdict(set)
+        for campaign_id, group_id in Campaign.publisher_groups.through.objects.filter(
+            campaign_id__in=campaign_ids
+        ).values_list("campaign_id", "publishergroup_id"):
+            group_campaigns[group_id].add(campaign_id)
+
+        for group_id, publisher_id in PublisherGroup.publishers.through.objects.filter(
+            publishergroup_id__in=list(group_campaigns)
+        ).values_list("publishergroup_id", "publisher_id"):
+            for campaign_id in group_campaigns[group_id]:
+                self.publisher_flights[publisher_id] |= campaign_flights[campaign_id]
+
+        # Exclusions take precedence over any inclusion
+        excluded = Campaign.exclude_publishers.through.objects.filter(
+            campaign_id__in=campaign_ids
+        ).values_list("campaign_id", "publisher_id")
+        for campaign_id, publisher_id in excluded:
+            self.publisher_flights[publisher_id] -= campaign_flights[campaign_id]
+
+    @classmethod
+    def load(cls):
+        """Get the flight index for this process, rebuilding it if it changed or expired."""
+        version = cls.get_version()
+        index = cls.current
+        if (
+            index is None
+            or index.version != version
+            or index.expires <= time.monotonic()
+        ):
+            index = cls._load_db(version)
+            cls.current = index
+        return index
+
+    @classmethod
+    def _load_db(cls, version=None):
+        """Build the flight index from the database."""
+        log.debug("Building the flight index. version=%s", version)
+
+        flights = list(Flight.objects.filter(live=True).select_related("campaign"))
+
+        # Reload the targeted regions and topics so the compiled targeting
+        # expands them with their current countries and keywords
+        if any(
+            flight.included_regions or flight.excluded_regions for flight in flights
+        ):
+            Region._load_db()
+        if any(flight.included_topics for flight in flights):
+            Topic._load_db()
+        ads = Advertisement.objects.filter(
+            live=True, flight__in=[flight.pk for flight in flights]
+        ).prefetch_related("ad_types")
+
+        return cls(flights, ads, version=version)
+
+    @classmethod
+    def get_version(cls):
+        """Get the current version of the index shared by all processes."""
+        version = cache.get(cls.VERSION_CACHE_KEY)
+        if not version:
+            version = cls.invalidate()
+        return version
+
+    @classmethod
+    def invalidate(cls):
+        """Invalidate the flight index in all processes."""
+        version = uuid.uuid4().hex
+        cache.set(cls.VERSION_CACHE_KEY, version, timeout=None)
+        return version
+
+    def get_flights(self, publisher, ad_types, campaign_types, day):
+        """
+        Get the candidate flights for a publisher, ad types and campaign types.
+
+        :param publisher: the publisher where the ad will be shown
+        :param ad_types: a list of acceptable ad type slugs
+        :param campaign_types: a list of acceptable campaign types
+        :param day: flights starting after this date are not candidates
+        :return: a list of flights in the default flight order
+        """
+        flight_ids = set()
+        for ad_type in ad_types:
+            flight_ids |= self.ad_type_flights.get(ad_type, set())
+        flight_ids &= self.publisher_flights.get(publisher.pk, set())
+
+        return [
+            flight
+            for flight in self.flights
+            if flight.pk in flight_ids
+            and flight.start_date <= day
+            and flight.campaign.campaign_type in campaign_types
+        ]
+
+    def get_ads(self, flight, ad_types):
+        """Get the live ads for a flight which match any of the ad types."""
+        ad_types = set(ad_types)
+        return [
+            ad
+            for ad in self.flight_ads.get(flight.pk, [])
+            if not self.ad_type_slugs[ad.pk].isdisjoint(ad_types)
+        ]
@@ -0,0 +1,153 @@
+"""A snapshot of how many clicks and views each live flight needs today."""
+import copy
+import logging
+import math
+import time
+
+from ..constants import CLICKS
+from ..constants import VIEWS
+from ..counters import impression_counter
+from ..models import Flight
+from ..utils import get_ad_day
+
+
+log = logging.getLogger(__name__)  # noqa
+
+
+class FlightPacing:
+
+    """
+    The pacing (clicks and views needed today) for a single flight.
+
+    This is computed once per flight rather than once per flight on each ad decision.
+    Only the price priority depends on the publisher and is calculated when requested.
+    """
+
+    def __init__(self, flight, sampled_ctrs=None):
+        """
+        Compute the pacing for a flight.
+
+        :param flight: a flight with up-to-date ``total_clicks`` and ``total_views``
+        :param sampled_ctrs: the recent CTRs of flights (see ``Flight.get_sampled_ctrs``)
+        """
+        self.flight = flight
+        self.sampled_ctrs = sampled_ctrs
+        self.clicks_needed = flight.clicks_needed_today()
+        self.views_needed = flight.views_needed_today()
+
+        # This is naive but we are counting a click as being worth 1,000 views
+        self.impressions_needed = (
+            math.ceil(self.views_needed / 1000.0) + self.clicks_needed
+        )
+
+    def weighted_clicks_needed(self, publisher=None):
+        """The same as ``Flight.weighted_clicks_needed_today`` but using the snapshot."""
+        if not self.impressions_needed:
+            return 0
+
+        return int(
+            self.impressions_needed
+            * self.flight.priority_multiplier
+            * self.flight.price_priority_value(publisher, self.sampled_ctrs)
+        )
+
+
+class PacingSnapshot:
+
+    """
+    The pacing of every flight in the flight index, shared by all decisions in a process.
+
+    Without this, pacing (days remaining, clicks and views remaining and needed today)
+    was recomputed multiple times for every candidate flight on every decision.
+
+    The snapshot reloads the flight totals from the database with a single query
+    at most every ``REFRESH_INTERVAL`` seconds and whenever the flight index changes.
+    In between, ``Advertisement.incr`` updates the pacing of the flight it counted against
+    (see :py:meth:`~PacingSnapshot.record`).
+    """
+
+    REFRESH_INTERVAL = 5
+
+    # The snapshot for this process
+    current = None
+
+    def __init__(self, flights, version=None):
+        """
+        Compute the pacing for the flights with their current totals from the database.
+
+        :param flights: the flights (from the flight index) to compute pacing for
+        :param version: the version of the flight index the flights came from
+        """
+        self.version = version
+        self.day = get_ad_day().date()
+        self.expires = time.monotonic() + self.REFRESH_INTERVAL
+        self.flights = {}
+
+        # Recent CTRs for the price priority of each flight (a cache lookup, no query)
+        self.sampled_ctrs = Flight.get_sampled_ctrs()
+
+        totals = {
+            pk: (total_clicks, total_views)
+            for pk, total_clicks, total_views in Flight.objects.filter(
+                pk__in=[flight.pk for flight in flights]
+            ).values_list("pk", "total_clicks", "total_views")
+        }
+        for flight in flights:
+            if flight.pk not in totals:
+                continue
+
+            # Don't change the flight from the index
+            # and include clicks and views in this process that haven't been written yet
+            flight = copy.copy(flight)
+            total_clicks, total_views = totals[flight.pk]
+            (
+                pending_clicks,
+                pending_views,
+            ) = impression_counter.get_pending_flight_totals(flight.pk)
+            flight.total_clicks = total_clicks + pending_clicks
+            flight.total_views = total_views + pending_views
+            self.flights[flight.pk] = FlightPacing(flight, self.sampled_ctrs)
+
+    @classmethod
+    def load(cls, flight_index):
+        """
+        Get the pacing snapshot for a flight index, computing it again if it is stale.
+
+        :param flight_index: the :py:class:`~adserver.decisionengine.index.FlightIndex`
+        """
+        snapshot = cls.current
+        if (
+            snapshot is None
+            or snapshot.version != flight_index.version
+            or snapshot.expires <= time.monotonic()
+            or snapshot.day != get_ad_day().date()
+        ):
+            log.debug("Computing the pacing snapshot. version=%s", flight_index.version)
+            snapshot = cls(flight_index.flights, version=flight_index.version)
+            cls.current = snapshot
+
+        return snapshot
+
+    @classmethod
+    def record(cls, flight_id, impression_type):
+        """Update the pacing of a flight in this process after a click or view."""
+        snapshot = cls.current
+        if snapshot is None or flight_id not in snapshot.flights:
+            return
+
+        flight = copy.copy(snapshot.flights[flight_id].flight)
+        if impression_type == VIEWS:
+            flight.total_views += 1
+        elif impression_type == CLICKS:
+            flight.total_clicks += 1
+        else:
+            return
+
+        snapshot.flights[flight_id] = FlightPacing(flight, snapshot.sampled_ctrs)
+
+    def get_pacing(self, flight):
+        """Get the pacing of a flight, computing it if the flight isn't in the snapshot."""
+        pacing = self.flights.get(flight.pk)
+        if pacing is None:
+            pacing = FlightPacing(flight, self.sampled_ctrs)
+        return pacing
@@ -0,0 +1,56 @@
+"""Weighted random selection used by the decision backends."""
+import bisect
+import itertools
+import random
+
+
+class WeightedSampler:
+
+    """
+    Randomly choose items with a probability proportional to their weights.
+
+    The cumulative weights are computed once so each choice is a binary search
+    (``O(log n)``) rather than a scan or choosing from a list with an item repeated
+    for each unit of weight.
+    Samplers don't change after they are built so they can be cached and reused.
+
+    Items with a weight of zero (or less) are never chosen.
+    """
+
+    def __init__(self, weighted_items):
+        """
+        Build the cumulative weights.
+
+        :param weighted_items: an iterable of ``(item, weight)`` pairs where weights are integers
+        """
+        self.items = []
+        weights = []
+        for item, weight in weighted_items:
+            self.items.append(item)
+            weights.append(max(0, weight))
+
+        self.cumulative_weights = list(itertools.accumulate(weights))
+        self.total_weight = (
+            self.cumulative_weights[-1] if self.cumulative_weights else 0
+        )
+
+    def __len__(self):
+        return len(self.items)
+
+    def get(self, value):
+        """
+        Get the item at a position in ``[0, total_weight)``.
+
+        Returns ``None`` if the value is outside that range.
+        """
+        if value < 0 or value >= self.total_weight:
+            return None
+
+        return self.items[bisect.bisect_right(self.cumulative_weights, value)]
+
+    def choose(self):
+        """Randomly choose an item or ``None`` if there are no items with any weight."""
+        if self.total_weight <= 0:
+            return None
+
+        return self.get(random.randrange(self.total_weight))
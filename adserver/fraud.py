@@ -0,0 +1,466 @@
+"""
+Rules to ignore invalid ad views and clicks (eg. from bots or blocked IPs).
+
+The view and click proxies check each impression against the rules in ``ADSERVER_FRAUD_RULES``
+and ignore it with the reason of the first rule in that order that matches.
+Rules run from the cheapest to the most expensive (see ``BaseFraudRule.cost``)
+and once a rule matches, only the rules configured before it are still checked
+so impressions from bot floods are usually rejected before the expensive checks run.
+Each process keeps the number of checks, hits and the time spent per rule
+which are logged periodically (see :py:meth:`FraudRulePipeline.get_stats`).
+"""
+import functools
+import logging
+import threading
+import time
+from collections import Counter
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.utils.functional import cached_property
+from django.utils.module_loading import import_string
+
+from .constants import CLICKS
+from .constants import VIEWS
+from .utils import get_blocklisted_referrer_pattern
+from .utils import get_blocklisted_user_agent_pattern
+from .utils import get_client_ip
+from .utils import get_client_parsed_user_agent
+from .utils import get_client_user_agent
+from .utils import get_geolocation
+from .utils import get_user_agent_cache_stats
+from .utils import is_blocklisted_ip
+from .utils import is_click_ratelimited
+from .utils import is_view_ratelimited
+
+
+log = logging.getLogger(__name__)  # noqa
+
+
+class FraudContext:
+
+    """
+    An ad view or click being checked by the fraud rules.
+
+    Request data that is expensive to compute (eg. the parsed user agent or the geolocation)
+    is only computed when a rule needs it and then shared by all the rules.
+    """
+
+    def __init__(self, request, advertisement, offer, impression_type):
+        self.request = request
+        self.advertisement = advertisement
+        self.offer = offer
+        self.impression_type = impression_type
+
+    @cached_property
+    def ip_address(self):
+        return get_client_ip(self.request)
+
+    @cached_property
+    def user_agent(self):
+        return get_client_user_agent(self.request)
+
+    @cached_property
+    def parsed_ua(self):
+        return get_client_parsed_user_agent(self.request)
+
+    @cached_property
+    def referrer(self):
+        return self.request.META.get("HTTP_REFERER")
+
+    @cached_property
+    def geo_data(self):
+        # One or more of country/region/etc. may be None which is OK
+        # Ads targeting countries/regions/metros will never match None
+        return get_geolocation(self.request)
+
+
+class BaseFraudRule:
+
+    """
+    A rule that an ad view or click is invalid and shouldn't be billed.
+
+    Subclasses *must* set a ``name`` and a ``reason`` and override ``is_fraud``.
+    """
+
+    name = None
+    reason = None
+
+    # The relative cost of checking the rule. Cheaper rules are checked first.
+    # Roughly 1 is an in-memory check, 10 a regex or parsing the user agent
+    # and 100+ a query or a cache round trip.
+    cost = 1
+
+    # The names of the rules that must pass before this rule is checked
+    # (eg. rules that use the offer depend on the offer being known)
+    depends_on = ()
+
+    # Log matches at the security level (eg. targeting mismatches) rather than the normal level
+    security = False
+
+    # The log message and its arguments (see ``get_log_args``)
+    message = None
+
+    def is_fraud(self, context):
+        """Returns ``True`` if the impression should be ignored."""
+        raise NotImplementedError
+
+    def get_log_args(self, context):
+        return ()
+
+
+class UnknownOfferRule(BaseFraudRule):
+    name = "unknown-offer"
+    reason = "Unknown offer"
+    cost = 0
+    message = "Ad impression for unknown offer"
+
+    def is_fraud(self, context):
+        return not context.offer
+
+
+class InvalidNonceRule(BaseFraudRule):
+    name = "invalid-nonce"
+    reason = "Old/Invalid nonce"
+    cost = 0
+    depends_on = ("unknown-offer",)
+    message = "Old or nonexistent impression nonce"
+
+    def is_fraud(self, context):
+        return not context.advertisement.is_valid_offer(
+            context.impression_type, context.offer
+        )
+
+
+class InternalIpRule(BaseFraudRule):
+    name = "internal-ip"
+    reason = "Internal IP"
+    message = "Internal IP impression. User Agent: [%s]"
+
+    def is_fraud(self, context):
+        # Ignore internal IPs except in DEBUG where all IPs are probably internal
+        return not settings.DEBUG and context.ip_address in settings.INTERNAL_IPS
+
+    def get_log_args(self, context):
+        return (context.user_agent,)
+
+
+class BotRule(BaseFraudRule):
+    name = "bot"
+    reason = "Bot impression"
+    cost = 10
+    message = "Bot impression. User Agent: [%s]"
+
+    def is_fraud(self, context):
+        return context.parsed_ua.is_bot
+
+    def get_log_args(self, context):
+        return (context.user_agent,)
+
+
+class UnknownUserAgentRule(BaseFraudRule):
+    name = "unknown-user-agent"
+    reason = "Unrecognized user agent"
+    cost = 10
+    message = "Unknown user agent impression [%s]"
+
+    def is_fraud(self, context):
+        # This is probably a bot/proxy server/prefetcher/etc.
+        parsed_ua = context.parsed_ua
+        return parsed_ua.os.family == "Other" or parsed_ua.browser.family == "Other"
+
+    def get_log_args(self, context):
+        return (context.user_agent,)
+
+
+class MismatchedOsRule(BaseFraudRule):
+    name = "mismatched-os"
+    reason = "Mismatched OS"
+    cost = 10
+    depends_on = ("unknown-offer",)
+    security = True
+    message = "Mismatched OS between offer and impression. Publisher: [%s], Offer OS: [%s], User agent: [%s]"
+
+    def is_fraud(self, context):
+        return context.offer.os_family != context.parsed_ua.os.family
+
+    def get_log_args(self, context):
+        return (context.offer.publisher, context.offer.os_family, context.user_agent)
+
+
+class MismatchedBrowserRule(BaseFraudRule):
+    name = "mismatched-browser"
+    reason = "Mismatched browser"
+    cost = 10
+    depends_on = ("unknown-offer",)
+    security = True
+    message = "Mismatched browser between offer and impression. Publisher: [%s], Offer Browser: [%s], User agent: [%s]"
+
+    def is_fraud(self, context):
+        return context.offer.browser_family != context.parsed_ua.browser.family
+
+    def get_log_args(self, context):
+        return (
+            context.offer.publisher,
+            context.offer.browser_family,
+            context.user_agent,
+        )
+
+
+class BlockedUserAgentRule(BaseFraudRule):
+    name = "blocked-user-agent"
+    reason = "Blocked UA impression"
+    cost = 20
+    message = "Blocked user agent impression [%s], Pattern: [%s]"
+
+    def is_fraud(self, context):
+        return get_blocklisted_user_agent_pattern(context.user_agent) is not None
+
+    def get_log_args(self, context):
+        return (
+            context.user_agent,
+            get_blocklisted_user_agent_pattern(context.user_agent),
+        )
+
+
+class BlockedReferrerRule(BaseFraudRule):
+    name = "blocked-referrer"
+    reason = "Blocked referrer impression"
+    cost = 20
+    depends_on = ("unknown-offer",)
+    message = "Blocklisted referrer [%s], Pattern: [%s], Publisher: [%s], UA: [%s]"
+
+    def is_fraud(self, context):
+        return get_blocklisted_referrer_pattern(context.referrer) is not None
+
+    def get_log_args(self, context):
+        return (
+            context.referrer,
+            get_blocklisted_referrer_pattern(context.referrer),
+            context.offer.publisher,
+            context.user_agent,
+        )
+
+
+class BlockedIpRule(BaseFraudRule):
+    name = "blocked-ip"
+    reason = "Blocked IP impression"
+    # Includes a lookup in the IP2Proxy database file
+    cost = 50
+    depends_on = ("unknown-offer",)
+    message = "Blocked IP impression, Publisher: [%s]"
+
+    def is_fraud(self, context):
+        return is_blocklisted_ip(context.ip_address)
+
+    def get_log_args(self, context):
+        return (context.offer.publisher,)
+
+
+class KnownUserRule(BaseFraudRule):
+    name = "known-user"
+    reason = "Known user impression"
+    # Loading the user queries the session and the user
+    cost = 100
+    message = "Ignored known user ad impression"
+
+    def is_fraud(self, context):
+        return not context.request.user.is_anonymous
+
+
+class UnknownPublisherRule(BaseFraudRule):
+    name = "unknown-publisher"
+    reason = "Unknown publisher"
+    cost = 100
+    depends_on = ("unknown-offer",)
+    message = "Ad impression for unknown publisher"
+
+    def is_fraud(self, context):
+        return not context.offer.publisher
+
+
+class InvalidTargetingRule(BaseFraudRule):
+    name = "invalid-targeting"
+    reason = "Invalid targeting impression"
+    cost = 20
+    security = True
+    message = (
+        "Invalid geo targeting for ad [%s]. Country: [%s], Region: [%s], Metro: [%s]"
+    )
+
+    def is_fraud(self, context):
+        # This is very rare but it is visible in ad reports
+        # I believe the most common cause for this is somebody uses a VPN and is served an ad
+        # Then they turn off their VPN and click on the ad
+        return not context.advertisement.flight.show_to_geo(context.geo_data)
+
+    def get_log_args(self, context):
+        return (
+            context.advertisement,
+            context.geo_data.country,
+            context.geo_data.region,
+            context.geo_data.metro,
+        )
+
+
+class ClickRatelimitRule(BaseFraudRule):
+    name = "click-ratelimit"
+    reason = "Ratelimited click impression"
+    # Increments the ratelimits in the cache so it should only run when all other rules pass
+    cost = 1000
+    depends_on = ("unknown-offer",)
+    message = "User has clicked too many ads recently, Publisher: [%s], UA: [%s]"
+
+    def is_fraud(self, context):
+        return context.impression_type == CLICKS and is_click_ratelimited(
+            context.request
+        )
+
+    def get_log_args(self, context):
+        return (context.offer.publisher, context.user_agent)
+
+
+class ViewRatelimitRule(BaseFraudRule):
+    name = "view-ratelimit"
+    reason = "Ratelimited view impression"
+    cost = 1000
+    depends_on = ("unknown-offer",)
+    message = "User has viewed too many ads recently, Publisher: [%s], UA: [%s]"
+
+    def is_fraud(self, context):
+        return context.impression_type == VIEWS and is_view_ratelimited(context.request)
+
+    def get_log_args(self, context):
+        return (context.offer.publisher, context.user_agent)
+
+
+class FraudRulePipeline:
+
+    """
+    Checks impressions against fraud rules from the cheapest to the most expensive.
+
+    The order the rules are passed in is their precedence.
+    When an impression matches more than one rule, the reason is from the earliest rule.
+    """
+
+    # Log the rule stats every X impressions checked in this process (0 to disable)
+    stats_log_interval = 10000
+
+    def __init__(self, rules):
+        self.precedence = {rule.name: index for index, rule in enumerate(rules)}
+        self.rules = self.sort_rules(rules)
+        self.lock = threading.Lock()
+        self.reset_stats()
+
+    @staticmethod
+    def sort_rules(rules):
+        """Sort rules by cost while making sure rules run after the rules they depend on."""
+        rules_by_name = {rule.name: rule for rule in rules}
+        order = {}
+
+        def get_order(rule, seen=()):
+            if rule.name in seen:
+                raise ImproperlyConfigured(f"Fraud rule {rule.name} depends on itself")
+            if rule.name not in order:
+                cost, depth = rule.cost, 0
+                for name in rule.depends_on:
+                    if name not in rules_by_name:
+                        raise ImproperlyConfigured(
+                            f"Fraud rule {rule.name} depends on {name} which isn't enabled"
+                        )
+                    dep_cost, dep_depth = get_order(
+                        rules_by_name[name], seen + (rule.name,)
+                    )
+                    cost = max(cost, dep_cost)
+                    depth = max(depth, dep_depth + 1)
+                order[rule.name] = (cost, depth)
+            return order[rule.name]
+
+        # Rules with the same cost keep the order they are configured in
+        return sorted(rules, key=get_order)
+
+    def reset_stats(self):
+        # (rule name, "checks"|"hits"|"seconds") -> count or total
+        self.stats = Counter()
+        self.impressions = 0
+
+    def get_stats(self):
+        """Get the checks, hits and seconds spent per rule (in the order they run)."""
+        with self.lock:
+            return {
+                rule.name: {
+                    "checks": self.stats[(rule.name, "checks")],
+                    "hits": self.stats[(rule.name, "hits")],
+                    "seconds": self.stats[(rule.name, "seconds")],
+                }
+                for rule in self.rules
+            }
+
+    def check(self, context, log_level=logging.DEBUG, log_security_level=None):
+        """
+        Check an impression against the rules and return the first that matches.
+
+        After a rule matches, only the rules that take precedence over it are checked.
+
+        :returns: the rule that matched or ``None`` if the impression should be tracked
+        """
+        matched = None
+        matched_names = set()
+        timings = []
+        for rule in self.rules:
+            if matched and self.precedence[rule.name] > self.precedence[matched.name]:
+                continue
+            if matched_names.intersection(rule.depends_on):
+                continue
+
+            started = time.perf_counter()
+            is_fraud = rule.is_fraud(context)
+            timings.append((rule, time.perf_counter() - started))
+
+            if is_fraud:
+                matched = rule
+                matched_names.add(rule.name)
+
+        if matched:
+            level = log_security_level if matched.security else log_level
+            log.log(level or log_level, matched.message, *matched.get_log_args(context))
+
+        with self.lock:
+            self.impressions += 1
+            for rule, seconds in timings:
+                self.stats[(rule.name, "checks")] += 1
+                self.stats[(rule.name, "seconds")] += seconds
+            if matched:
+                self.stats[(matched.name, "hits")] += 1
+            log_stats = (
+                self.stats_log_interval
+                and self.impressions % self.stats_log_interval == 0
+            )
+
+        if log_stats:
+            self.log_stats()
+
+        return matched
+
+    def log_stats(self):
+        for name, stats in self.get_stats().items():
+            log.info(
+                "Fraud rule stats. rule=%s checks=%s hits=%s seconds=%.3f",
+                name,
+                stats["checks"],
+                stats["hits"],
+                stats["seconds"],
+            )
+
+        # Most rules depend on the parsed user agent
+        log.info("User agent cache stats. %s", get_user_agent_cache_stats())
+
+
+@functools.lru_cache(maxsize=None)
+def _get_pipeline(rule_paths):
+    return FraudRulePipeline([import_string(path)() for path in rule_paths])
+
+
+def get_fraud_rule_pipeline():
+    """Get the pipeline of the rules in ``ADSERVER_FRAUD_RULES`` (shared in this process)."""
+    return _get_pipeline(tuple(settings.ADSERVER_FRAUD_RULES))
@@ -7,10 +7,28 @@ As a result, archiving old offers can have a good effect on performance.
 This management command archives old offers to CSV files, zips them,
 can copy them to remote storage (settings.BACKUPS_STORAGE)
 and with a passed flag can delete the archives from the DB.
+It also writes columnar rollups of the report indexes for each day to remote storage
+(see ``adserver.rollups``).
+
+With ``--stream``, the offers are compressed, counted and hashed as they are copied
+out of the database and uploaded to remote storage without writing them to the output dir
+rather than reading the CSV again for each step,
+and multiple days are archived at the same time.
+
+With ``--delete-batch-size``, offers are deleted in batches by primary key and date
+pausing between batches and while the replica is behind
+so the deletes don't hold long locks or stall the replica.
+With ``--drop-partitions``, whole months of offers in a partitioned offers table
+are removed by detaching and dropping their partition instead.
 """
+import bz2
+import collections
 import datetime
+import hashlib
 import subprocess
 import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 
 from django.conf import settings
@@ -21,6 +39,67 @@ from django.db import connections
 from django.utils import timezone
 from django.utils.translation import gettext_lazy as _
 
+from ...partitions import get_next_month
+from ...partitions import get_partition_name
+from ...partitions import get_partitions
+from ...rollups import RollupStore
+
+
+class StreamingCompressor:
+
+    """
+    A file-like object that compresses what is written to it with bzip2 using multiple threads.
+
+    The input is split into blocks which are compressed in parallel as separate bzip2 streams
+    and written in order (multi-stream files are supported by bzip2 and Python's ``bz2``).
+    Lines written and the MD5 of the compressed output are counted along the way.
+    """
+
+    BLOCK_SIZE = 4 * 1024 * 1024  # bytes
+
+    def __init__(self, fileobj, threads=4):
+        self.fileobj = fileobj
+        self.executor = ThreadPoolExecutor(max_workers=threads)
+        self.max_pending = threads * 2
+
+        self.buffer = bytearray()
+        self.pending = collections.deque()
+        self.lines = 0
+        self.md5 = hashlib.md5()
+
+    def write(self, data):
+        if isinstance(data, str):
+            data = data.encode("utf-8")
+
+        self.lines += data.count(b"\n")
+        self.buffer += data
+        while len(self.buffer) >= self.BLOCK_SIZE:
+            self._compress(bytes(self.buffer[: self.BLOCK_SIZE]))
+            del self.buffer[: self.BLOCK_SIZE]
+
+        return len(data)
+
+    def close(self):
+        """Compress and write anything remaining."""
+        if self.buffer:
+            self._compress(bytes(self.buffer))
+            self.buffer.clear()
+        while self.pending:
+            self._write_next()
+        self.executor.shutdown()
+
+    def _compress(self, block):
+        self.pending.append(self.executor.submit(bz2.compress, block))
+
+        # Don't hold too much in memory if compressing is slower than the database
+        while len(self.pending) > self.max_pending:
+            self._write_next()
+
+    def _write_next(self):
+        compressed = self.pending.popleft().result()
+        self.md5.update(compressed)
+        self.fileobj.write(compressed)
+
 
 class Command(BaseCommand):
 
@@ -34,6 +113,16 @@ class Command(BaseCommand):
 
     storage_output_dir = "offers/"
 
+    default_workers = 4
+    default_compression_threads = 4
+
+    # Streamed archives are kept in memory up to this size before spilling to a temporary file
+    spool_max_size = 64 * 1024 * 1024  # bytes
+
+    default_delete_batch_size = 0  # Delete a day at once
+    default_delete_sleep = 0.1  # seconds
+    default_max_replica_lag = 30  # seconds
+
     # This will be populated from the default or command line args
     output_dir = None
 
@@ -77,26 +166,126 @@ class Command(BaseCommand):
             type=self._from_isoformat,
             help=_("End date to dump offers (inclusive, defaults to yesterday)"),
         )
+        self.add_streaming_arguments(parser)
+        self.add_delete_arguments(parser)
 
-    def handle_archive_day(self, day):
-        """Archive a single day of offers to a file."""
-        output_file = self.output_dir / f"{day:%Y-%m-%d}-offers.csv"
-        zipped_output_file = Path(str(output_file) + ".bz2")
-        end_day = day + datetime.timedelta(days=1)
+    def add_streaming_arguments(self, parser):
+        parser.add_argument(
+            "--stream",
+            action="store_true",
+            default=False,
+            help=_("Compress, count and hash offers while copying them from the DB"),
+        )
+        parser.add_argument(
+            "-w",
+            "--workers",
+            default=self.default_workers,
+            type=int,
+            help=_("Days to archive at the same time (with --stream)"),
+        )
+        parser.add_argument(
+            "--compression-threads",
+            default=self.default_compression_threads,
+            type=int,
+            help=_("Threads compressing each day (with --stream)"),
+        )
 
-        self.stdout.write(_("Archiving %s to %s...") % (day, output_file))
+    def add_delete_arguments(self, parser):
+        parser.add_argument(
+            "--delete-batch-size",
+            default=self.default_delete_batch_size,
+            type=int,
+            help=_("Offers to delete at a time (0 to delete a day at once)"),
+        )
+        parser.add_argument(
+            "--delete-sleep",
+            default=self.default_delete_sleep,
+            type=float,
+            help=_("Seconds to wait between deleting batches of offers"),
+        )
+        parser.add_argument(
+            "--max-replica-lag",
+            default=self.default_max_replica_lag,
+            type=float,
+            help=_(
+                "Pause deleting while the replica is more than this many seconds behind"
+            ),
+        )
+        parser.add_argument(
+            "--drop-partitions",
+            action="store_true",
+            default=False,
+            help=_(
+                "Drop the partitions of whole months rather than deleting their offers"
+            ),
+        )
+
+    def get_archive_query(self, day):
+        end_day = day + datetime.timedelta(days=1)
 
         # Using the date params as an f-string is suboptimal but these are validated
-        query = f"""
+        return f"""
             COPY (
                 SELECT * FROM {settings.ADSERVER_OFFER_DB_TABLE}
                 WHERE date >= '{day:%Y-%m-%d}' AND date < '{end_day:%Y-%m-%d}'
                 ORDER BY date
             ) TO STDOUT WITH CSV HEADER"""
+
+    def handle_stream_archive_day(self, day, compression_threads):
+        """
+        Archive a single day of offers to settings.BACKUPS_STORAGE in a single pass.
+
+        The compressed offers are written to a spooled temporary file
+        (in memory up to ``spool_max_size``) which is uploaded without being written
+        to the output dir. Without backups storage, they are kept in the output dir instead.
+        """
+        archive_name = f"{day:%Y-%m-%d}-offers.csv.bz2"
+        storage = self.get_backups_storage()
+
+        if storage:
+            self.stdout.write(_("Archiving %s to backups...") % day)
+            fd = tempfile.SpooledTemporaryFile(max_size=self.spool_max_size)
+        else:
+            self.stdout.write(
+                _("Archiving %s to %s...") % (day, self.output_dir / archive_name)
+            )
+            fd = open(self.output_dir / archive_name, "wb")
+
+        with fd:
+            compressor = StreamingCompressor(fd, threads=compression_threads)
+            try:
+                with connections[settings.REPLICA_SLUG].cursor() as cursor:
+                    cursor.copy_expert(self.get_archive_query(day), compressor)
+                compressor.close()
+            finally:
+                # Each worker thread has its own database connection
+                connections.close_all()
+
+            # The header row is counted as a line (the same as `wc -l`)
+            self.stdout.write(
+                _("%s: %d lines, md5 %s")
+                % (archive_name, compressor.lines, compressor.md5.hexdigest())
+            )
+
+            if storage:
+                fd.seek(0)
+                self.save_offer_dump(storage, archive_name, fd)
+            else:
+                self.warn_skipped_copy()
+
+        self.stdout.write(self.style.SUCCESS(_("Successfully archived %s.") % day))
+
+    def handle_archive_day(self, day):
+        """Archive a single day of offers to a file."""
+        output_file = self.output_dir / f"{day:%Y-%m-%d}-offers.csv"
+        zipped_output_file = Path(str(output_file) + ".bz2")
+
+        self.stdout.write(_("Archiving %s to %s...") % (day, output_file))
+
         with connections[settings.REPLICA_SLUG].cursor() as cursor:
             with open(output_file, "wb") as fd:
                 # https://www.psycopg.org/docs/cursor.html#cursor.copy_expert
-                cursor.copy_expert(query, fd)
+                cursor.copy_expert(self.get_archive_query(day), fd)
 
         # This will be off by one because the CSV contains a header row
         self.stdout.write(_("Running `wc -l %s`...") % output_file)
@@ -133,36 +322,63 @@ class Command(BaseCommand):
 
         return zipped_output_file
 
-    def copy_offer_dump(self, archive_filepath):
-        """Copy offer CSV files to settings.BACKUPS_STORAGE."""
+    def get_backups_storage(self):
+        """Get the storage offers are copied to or ``None`` if BACKUPS_STORAGE is not defined."""
         if not hasattr(settings, "BACKUPS_STORAGE"):
-            self.stdout.write(
-                self.style.WARNING(
-                    _(
-                        "Skipping copying offers to backups (BACKUPS_STORAGE is not defined)..."
-                    )
+            return None
+        return get_storage_class(settings.BACKUPS_STORAGE)()
+
+    def warn_skipped_copy(self):
+        self.stdout.write(
+            self.style.WARNING(
+                _(
+                    "Skipping copying offers to backups (BACKUPS_STORAGE is not defined)..."
                 )
             )
-            return
+        )
 
-        storage = get_storage_class(settings.BACKUPS_STORAGE)()
+    def copy_offer_dump(self, archive_filepath):
+        """Copy offer CSV files to settings.BACKUPS_STORAGE."""
+        storage = self.get_backups_storage()
+        if not storage:
+            self.warn_skipped_copy()
+            return
 
-        storage_path = self.storage_output_dir + archive_filepath.name
         self.stdout.write(_("Copying offers (%s) to backups...") % archive_filepath)
+        with open(archive_filepath, "rb") as fd:
+            self.save_offer_dump(storage, archive_filepath.name, fd)
+
+    def save_offer_dump(self, storage, archive_name, fd):
+        """Save a compressed file of offers to the backups storage."""
+        storage_path = self.storage_output_dir + archive_name
         if storage.exists(storage_path):
             self.stdout.write(
                 self.style.WARNING(_("- %s already exists in backups") % storage_path)
             )
-        with open(archive_filepath, "rb") as fd:
-            storage.save(storage_path, fd)
+        storage.save(storage_path, fd)
 
         self.stdout.write(
-            self.style.SUCCESS(
-                _("Successfully copied %s to backups.") % archive_filepath
+            self.style.SUCCESS(_("Successfully copied %s to backups.") % archive_name)
+        )
+
+    def write_rollups(self, day):
+        """Write the daily rollups of the report indexes to settings.BACKUPS_STORAGE."""
+        if not hasattr(settings, "BACKUPS_STORAGE"):
+            self.stdout.write(
+                self.style.WARNING(
+                    _("Skipping writing rollups (BACKUPS_STORAGE is not defined)...")
+                )
             )
+            return
+
+        self.stdout.write(_("Writing report rollups for %s...") % day)
+        paths = RollupStore().write_day(day)
+
+        self.stdout.write(
+            self.style.SUCCESS(_("Successfully wrote %d report rollups.") % len(paths))
         )
 
-    def delete_offers(self, day):
+    def delete_offers(self, day, batch_size=0, sleep=0, max_replica_lag=None):
         """Deletes offers from the database (requires them to be copied to settings.BACKUPS_STORAGE)."""
         if not hasattr(settings, "BACKUPS_STORAGE"):
             self.stdout.write(
@@ -175,6 +391,12 @@ class Command(BaseCommand):
         self.stdout.write(_("Deleting archived offers for %s...") % day)
 
         end_day = day + datetime.timedelta(days=1)
+        if batch_size:
+            self.delete_offers_in_batches(
+                day, end_day, batch_size, sleep, max_replica_lag
+            )
+            return
+
         query = f"DELETE FROM {settings.ADSERVER_OFFER_DB_TABLE} WHERE date >= %s AND date < %s"
 
         self.stdout.write(_("- Executing SQL:"))
@@ -193,6 +415,144 @@ class Command(BaseCommand):
             self.style.SUCCESS(_("Successfully removed %d offers.") % deleted_offers)
         )
 
+    def delete_offers_in_batches(
+        self, day, end_day, batch_size, sleep, max_replica_lag
+    ):
+        """
+        Delete a day of offers by primary key a batch at a time.
+
+        The date range is kept on the delete (not just the batch)
+        so only the day's partition is scanned in a partitioned offers table.
+        Offers locked by another transaction are skipped rather than waited on (PostgreSQL)
+        so this continues until a batch deletes nothing.
+        """
+        table = settings.ADSERVER_OFFER_DB_TABLE
+        connection = connections["default"]
+        lock = ""
+        if connection.features.has_select_for_update_skip_locked:
+            lock = " FOR UPDATE SKIP LOCKED"
+        delete_query = (
+            f"DELETE FROM {table} WHERE date >= %s AND date < %s AND id IN ("
+            f"SELECT id FROM {table} WHERE date >= %s AND date < %s LIMIT %s{lock})"
+        )
+
+        started = time.monotonic()
+        deleted_offers = 0
+        while True:
+            self.wait_for_replica(max_replica_lag)
+
+            # Always delete from the default.
+            # Each batch is committed separately so locks are only held briefly
+            with connection.cursor() as cursor:
+                cursor.execute(delete_query, [day, end_day, day, end_day, batch_size])
+                deleted = cursor.rowcount
+
+            deleted_offers += deleted
+            if not deleted:
+                break
+            time.sleep(sleep)
+
+        # Anything left was locked by another transaction
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f"SELECT COUNT(*) FROM {table} WHERE date >= %s AND date < %s",
+                [day, end_day],
+            )
+            remaining = cursor.fetchone()[0]
+        if remaining:
+            self.stdout.write(
+                self.style.WARNING(
+                    _("- %d locked offers for %s were not deleted") % (remaining, day)
+                )
+            )
+
+        elapsed = time.monotonic() - started
+        self.stdout.write(
+            self.style.SUCCESS(
+                _("Successfully removed %d offers in %.1fs (%.0f offers/s).")
+                % (
+                    deleted_offers,
+                    elapsed,
+                    deleted_offers / elapsed if elapsed else 0,
+                )
+            )
+        )
+
+    def get_replica_lag(self):
+        """Get how many seconds the replica is behind the primary (PostgreSQL only)."""
+        if settings.REPLICA_SLUG == "default":
+            return 0
+
+        connection = connections[settings.REPLICA_SLUG]
+        if connection.vendor != "postgresql":
+            return 0
+
+        with connection.cursor() as cursor:
+            cursor.execute(
+                "SELECT COALESCE(EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp()), 0)"
+            )
+            return float(cursor.fetchone()[0])
+
+    def wait_for_replica(self, max_replica_lag):
+        if max_replica_lag is None:
+            return
+
+        while True:
+            lag = self.get_replica_lag()
+            if lag <= max_replica_lag:
+                return
+
+            self.stdout.write(
+                self.style.WARNING(
+                    _("- Replica is %.1fs behind, waiting to delete more offers...")
+                    % lag
+                )
+            )
+            time.sleep(max_replica_lag)
+
+    def get_partitions(self):
+        """Get the names of the partitions of the offers table (PostgreSQL only)."""
+        return get_partitions(settings.ADSERVER_OFFER_DB_TABLE)
+
+    def drop_partitions(self, days):
+        """
+        Drop the monthly partitions for any whole months in the days.
+
+        :returns: the days whose offers were dropped
+        """
+        if not hasattr(settings, "BACKUPS_STORAGE"):
+            # The message about skipping deleting offers is written later
+            return set()
+
+        partitions = self.get_partitions()
+        days = set(days)
+        dropped_days = set()
+        for day in sorted(days):
+            if day.day != 1:
+                continue
+
+            month_days = {
+                day + datetime.timedelta(days=i)
+                for i in range((get_next_month(day) - day).days)
+            }
+            partition = get_partition_name(settings.ADSERVER_OFFER_DB_TABLE, day)
+            if partition not in partitions or not month_days <= days:
+                continue
+
+            self.stdout.write(_("Dropping offers partition %s...") % partition)
+            with connections["default"].cursor() as cursor:
+                cursor.execute(
+                    f"ALTER TABLE {settings.ADSERVER_OFFER_DB_TABLE} DETACH PARTITION {partition}"
+                )
+                cursor.execute(f"DROP TABLE {partition}")
+
+            self.stdout.write(
+                self.style.SUCCESS(_("Successfully dropped %s.") % partition)
+            )
+            dropped_days |= month_days
+
+        return dropped_days
+
     def update_db_stats(self):
         """Updates DB stats after these changes."""
         self.stdout.write(_("Updating database statistics..."))
@@ -217,15 +577,43 @@ class Command(BaseCommand):
             self.style.SUCCESS(_("Archiving offers to %s...") % self.output_dir)
         )
 
+        days = []
         day = kwargs["start_date"]
         while day <= kwargs["end_date"]:
-            archive_filepath = self.handle_archive_day(day)
-            self.copy_offer_dump(archive_filepath)
-            if kwargs["delete_offers"]:
-                self.delete_offers(day)
-
+            days.append(day)
             day += datetime.timedelta(days=1)
 
+        if kwargs["stream"]:
+            if kwargs["workers"] < 1 or kwargs["compression_threads"] < 1:
+                raise CommandError(_("Workers and threads must be at least 1"))
+
+            def archive_day(day):
+                self.handle_stream_archive_day(day, kwargs["compression_threads"])
+
+            # Days are archived concurrently but are only deleted once they are all copied
+            with ThreadPoolExecutor(max_workers=kwargs["workers"]) as executor:
+                list(executor.map(archive_day, days))
+
+        for day in days:
+            if not kwargs["stream"]:
+                archive_filepath = self.handle_archive_day(day)
+                self.copy_offer_dump(archive_filepath)
+            self.write_rollups(day)
+
+        if kwargs["delete_offers"]:
+            dropped_days = set()
+            if kwargs["drop_partitions"]:
+                dropped_days = self.drop_partitions(days)
+
+            for day in days:
+                if day not in dropped_days:
+                    self.delete_offers(
+                        day,
+                        batch_size=kwargs["delete_batch_size"],
+                        sleep=kwargs["delete_sleep"],
+                        max_replica_lag=kwargs["max_replica_lag"],
+                    )
+
         if kwargs["delete_offers"]:
             # Update DB stats if we deleted anything
             self.update_db_stats()
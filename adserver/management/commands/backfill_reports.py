@@ -0,0 +1,142 @@
+"""
+Backfills the report indexes (eg. GeoImpression) for a range of days.
+
+After a refund or a change to the keyword/topic mappings,
+the report indexes for past days need to be aggregated again.
+Each day is aggregated by a Celery task (``adserver.tasks.backfill_reports_day``)
+which scans that day of offers once for all the indexes.
+The days are split into ``--concurrency`` chains of tasks
+so at most that many days are being aggregated (and scanned on the replica) at a time.
+"""
+import datetime
+import time
+
+from celery import chain
+from django.core.management import CommandError
+from django.core.management.base import BaseCommand
+from django.utils.translation import gettext_lazy as _
+
+from ...aggregation import AGGREGATORS_BY_NAME
+from ...tasks import backfill_reports_day
+
+
+class Command(BaseCommand):
+
+    """Management command to backfill the report indexes in parallel."""
+
+    help = "Aggregates offers into the report indexes for a range of days."
+
+    default_concurrency = 4
+    poll_interval = 5  # seconds
+
+    def _from_isoformat(self, date_str):
+        return datetime.datetime.strptime(date_str, "%Y-%m-%d").date()
+
+    def add_arguments(self, parser):
+        """Add command line args for this command."""
+        parser.add_argument(
+            "-s",
+            "--start-date",
+            required=True,
+            type=self._from_isoformat,
+            help=_("First day to backfill (YYYY-MM-DD)"),
+        )
+        parser.add_argument(
+            "-e",
+            "--end-date",
+            required=True,
+            type=self._from_isoformat,
+            help=_("Last day to backfill (inclusive, YYYY-MM-DD)"),
+        )
+        parser.add_argument(
+            "-i",
+            "--index",
+            action="append",
+            dest="indexes",
+            choices=sorted(AGGREGATORS_BY_NAME),
+            help=_("Index to backfill (can be repeated, defaults to all indexes)"),
+        )
+        parser.add_argument(
+            "-c",
+            "--concurrency",
+            default=self.default_concurrency,
+            type=int,
+            help=_("Maximum number of days aggregated at the same time"),
+        )
+
+    def handle(self, *args, **kwargs):
+        """Entrypoint to the command."""
+        start_date = kwargs["start_date"]
+        end_date = kwargs["end_date"]
+        concurrency = kwargs["concurrency"]
+        if end_date < start_date:
+            raise CommandError(_("The end date must not be before the start date"))
+        if concurrency < 1:
+            raise CommandError(_("The concurrency must be at least 1"))
+
+        days = []
+        day = start_date
+        while day <= end_date:
+            days.append(day.isoformat())
+            day += datetime.timedelta(days=1)
+
+        self.stdout.write(
+            _(
+                "Backfilling %(indexes)s for %(days)d days with %(concurrency)d workers..."
+            )
+            % {
+                "indexes": ", ".join(kwargs["indexes"] or ["all indexes"]),
+                "days": len(days),
+                "concurrency": concurrency,
+            }
+        )
+
+        started = time.monotonic()
+        pending = []
+        for shard in range(concurrency):
+            shard_days = days[shard::concurrency]
+            if not shard_days:
+                continue
+
+            # The days in a shard are aggregated one after another
+            result = chain(
+                backfill_reports_day.si(day, kwargs["indexes"]) for day in shard_days
+            ).apply_async()
+            while result is not None:
+                pending.append(result)
+                result = result.parent
+
+        total_offers = 0
+        completed = 0
+        while pending:
+            for result in [result for result in pending if result.ready()]:
+                pending.remove(result)
+                completed += 1
+
+                data = result.get()
+                total_offers += data["offers"]
+                self.stdout.write(
+                    _(
+                        "[%(completed)d/%(total)d] %(day)s: %(offers)d offers in %(seconds).1fs"
+                    )
+                    % {"completed": completed, "total": len(days), **data}
+                )
+
+            if pending:
+                time.sleep(self.poll_interval)
+
+        elapsed = time.monotonic() - started
+        self.stdout.write(
+            self.style.SUCCESS(
+                _(
+                    "Successfully backfilled %(days)d days (%(offers)d offers) "
+                    "in %(elapsed).1fs (%(throughput).0f offers/s)."
+                )
+                % {
+                    "days": len(days),
+                    "offers": total_offers,
+                    "elapsed": elapsed,
+                    "throughput": total_offers / elapsed if elapsed else 0,
+                }
+            )
+        )
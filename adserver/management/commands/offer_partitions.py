@@ -0,0 +1,109 @@
+"""
+Creates and maintains monthly partitions of the offers table (PostgreSQL only).
+
+Rather than manually rotating the offers table (``ADSERVER_OFFER_DB_TABLE``),
+the offers table can be partitioned by month on ``Offer.date``.
+Index sizes stay bounded, queries filtered by date only touch the relevant months
+and old months can be dropped after archiving (``archive_offers --drop-partitions``).
+
+To start partitioning offers:
+
+* Create a new partitioned table with the same columns as the current offers table:
+  ``./manage.py offer_partitions --table adserver_offer_partitioned --create-like adserver_offer``
+* Update the ADSERVER_OFFER_DB_TABLE env to the new table
+* Archive (and eventually drop) the old table with ``archive_offers``
+
+Future partitions are created daily by ``adserver.tasks.maintain_offer_partitions``.
+"""
+import datetime
+
+from django.core.management import CommandError
+from django.core.management.base import BaseCommand
+from django.db import connections
+from django.utils.translation import gettext_lazy as _
+
+from ...partitions import create_partitions
+from ...partitions import get_create_table_sql
+from ...partitions import get_offer_table
+from ...partitions import is_partitioned
+
+
+class Command(BaseCommand):
+
+    """Management command to create monthly partitions of the offers table."""
+
+    help = "Creates the monthly partitions of the offers table ahead of time."
+
+    default_months_ahead = 3
+
+    def _from_isoformat(self, date_str):
+        return datetime.datetime.strptime(date_str, "%Y-%m-%d").date()
+
+    def add_arguments(self, parser):
+        """Add command line args for this command."""
+        parser.add_argument(
+            "-t",
+            "--table",
+            default=None,
+            type=str,
+            help=_("Partitioned offers table (defaults to the offers table)"),
+        )
+        parser.add_argument(
+            "--create-like",
+            default=None,
+            type=str,
+            help=_("Create the partitioned table with the columns of this table"),
+        )
+        parser.add_argument(
+            "-s",
+            "--start-date",
+            default=datetime.date.today(),
+            type=self._from_isoformat,
+            help=_("Create partitions from this month (defaults to this month)"),
+        )
+        parser.add_argument(
+            "-m",
+            "--months-ahead",
+            default=self.default_months_ahead,
+            type=int,
+            help=_("Number of future months to create partitions for"),
+        )
+        parser.add_argument(
+            "--dry-run",
+            action="store_true",
+            default=False,
+            help=_("Print the SQL without running it"),
+        )
+
+    def handle(self, *args, **kwargs):
+        """Entrypoint to the command."""
+        table = kwargs["table"] or get_offer_table()
+        dry_run = kwargs["dry_run"]
+
+        if kwargs["create_like"]:
+            self.stdout.write(_("Creating partitioned table %s...") % table)
+            for sql in get_create_table_sql(table, kwargs["create_like"]):
+                self.stdout.write(sql)
+                if not dry_run:
+                    with connections["default"].cursor() as cursor:
+                        cursor.execute(sql)
+        elif not dry_run and not is_partitioned(table):
+            raise CommandError(
+                _("%s is not a partitioned table (see --create-like)") % table
+            )
+
+        created = create_partitions(
+            table, kwargs["start_date"], kwargs["months_ahead"], dry_run=dry_run
+        )
+        for name in created:
+            if dry_run:
+                self.stdout.write(_("Would create partition %s") % name)
+            else:
+                self.stdout.write(_("Created partition %s") % name)
+
+        self.stdout.write(
+            self.style.SUCCESS(
+                _("Successfully created %(partitions)d partitions of %(table)s.")
+                % {"partitions": len(created), "table": table}
+            )
+        )
@@ -0,0 +1,54 @@
+# Generated by Django 3.2.15 on 2022-10-18 03:51
+import django.db.models.deletion
+import django_extensions.db.fields
+from django.db import migrations
+from django.db import models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('adserver', '0074_publisher_custom_cache_duration'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PublisherMonthlyImpression',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('created', django_extensions.db.fields.CreationDateTimeField(auto_now_add=True, verbose_name='created')),
+                ('modified', django_extensions.db.fields.ModificationDateTimeField(auto_now=True, verbose_name='modified')),
+                ('date', models.DateField(db_index=True, verbose_name='Date')),
+                ('decisions', models.PositiveIntegerField(default=0, help_text="The number of times the Ad Decision API was called. The server might not respond with an ad if there isn't inventory.", verbose_name='Decisions')),
+                ('offers', models.PositiveIntegerField(default=0, help_text='The number of times an ad was proposed by the ad server. The client may not load the ad (a view) for a variety of reasons ', verbose_name='Offers')),
+                ('views', models.PositiveIntegerField(default=0, help_text='Number of times the ad was legitimately viewed', verbose_name='Views')),
+                ('clicks', models.PositiveIntegerField(default=0, help_text='Number of times the ad was legitimately clicked', verbose_name='Clicks')),
+                ('campaign_type', models.CharField(choices=[('paid', 'Paid'), ('affiliate', 'Affiliate'), ('community', 'Community'), ('publisher-house', 'Publisher House'), ('house', 'House')], max_length=20, null=True, verbose_name='Campaign Type')),
+                ('revenue', models.FloatField(default=0, help_text='Revenue from the views and clicks before the revenue share', verbose_name='Revenue')),
+                ('publisher', models.ForeignKey(on_delete=django.db.models.deletion.PROTECT, related_name='monthly_impressions', to='adserver.publisher')),
+            ],
+            options={
+                'ordering': ('-date',),
+                'unique_together': {('publisher', 'campaign_type', 'date')},
+            },
+        ),
+        migrations.CreateModel(
+            name='FlightImpression',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('created', django_extensions.db.fields.CreationDateTimeField(auto_now_add=True, verbose_name='created')),
+                ('modified', django_extensions.db.fields.ModificationDateTimeField(auto_now=True, verbose_name='modified')),
+                ('date', models.DateField(db_index=True, verbose_name='Date')),
+                ('decisions', models.PositiveIntegerField(default=0, help_text="The number of times the Ad Decision API was called. The server might not respond with an ad if there isn't inventory.", verbose_name='Decisions')),
+                ('offers', models.PositiveIntegerField(default=0, help_text='The number of times an ad was proposed by the ad server. The client may not load the ad (a view) for a variety of reasons ', verbose_name='Offers')),
+                ('views', models.PositiveIntegerField(default=0, help_text='Number of times the ad was legitimately viewed', verbose_name='Views')),
+                ('clicks', models.PositiveIntegerField(default=0, help_text='Number of times the ad was legitimately clicked', verbose_name='Clicks')),
+                ('revenue', models.FloatField(default=0, help_text='The cost of the views and clicks to the advertiser', verbose_name='Revenue')),
+                ('flight', models.ForeignKey(on_delete=django.db.models.deletion.PROTECT, related_name='daily_impressions', to='adserver.flight')),
+            ],
+            options={
+                'ordering': ('-date',),
+                'unique_together': {('flight', 'date')},
+            },
+        ),
+    ]
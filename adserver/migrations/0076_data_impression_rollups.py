@@ -0,0 +1,100 @@
+"""
+Fills the monthly publisher and daily flight rollups from the existing ad impressions.
+
+After this, the rollups are kept up to date by ``adserver.aggregation.update_rollups``.
+"""
+from django.db import migrations
+from django.db import models
+from django.db.models.functions import Cast
+from django.db.models.functions import Coalesce
+from django.db.models.functions import TruncMonth
+
+
+def get_sums():
+    # This is snapshotted from BaseReport.get_revenue_expression
+    revenue = models.ExpressionWrapper(
+        models.F("clicks") * Cast("advertisement__flight__cpc", models.FloatField())
+        + models.F("views")
+        * Cast("advertisement__flight__cpm", models.FloatField())
+        / 1000.0,
+        output_field=models.FloatField(),
+    )
+    return {
+        "decisions_sum": models.Sum("decisions"),
+        "offers_sum": models.Sum("offers"),
+        "views_sum": models.Sum("views"),
+        "clicks_sum": models.Sum("clicks"),
+        "revenue_sum": Coalesce(
+            models.Sum(revenue), 0.0, output_field=models.FloatField()
+        ),
+    }
+
+
+def forwards(apps, schema_editor):
+    """Roll up all ad impressions by publisher/campaign type/month and by flight/day."""
+    AdImpression = apps.get_model("adserver", "AdImpression")
+    PublisherMonthlyImpression = apps.get_model(
+        "adserver", "PublisherMonthlyImpression"
+    )
+    FlightImpression = apps.get_model("adserver", "FlightImpression")
+
+    rows = (
+        AdImpression.objects.filter(publisher__isnull=False)
+        .order_by()
+        .values(
+            "publisher_id",
+            campaign_type=models.F("advertisement__flight__campaign__campaign_type"),
+            month=TruncMonth("date"),
+        )
+        .annotate(**get_sums())
+    )
+    PublisherMonthlyImpression.objects.bulk_create(
+        (
+            PublisherMonthlyImpression(
+                publisher_id=row["publisher_id"],
+                campaign_type=row["campaign_type"],
+                date=row["month"],
+                decisions=row["decisions_sum"],
+                offers=row["offers_sum"],
+                views=row["views_sum"],
+                clicks=row["clicks_sum"],
+                revenue=row["revenue_sum"],
+            )
+            for row in rows.iterator()
+        ),
+        batch_size=1000,
+    )
+
+    rows = (
+        AdImpression.objects.filter(advertisement__isnull=False)
+        .order_by()
+        .values("date", flight_id=models.F("advertisement__flight_id"))
+        .annotate(**get_sums())
+    )
+    FlightImpression.objects.bulk_create(
+        (
+            FlightImpression(
+                flight_id=row["flight_id"],
+                date=row["date"],
+                decisions=row["decisions_sum"],
+                offers=row["offers_sum"],
+                views=row["views_sum"],
+                clicks=row["clicks_sum"],
+                revenue=row["revenue_sum"],
+            )
+            for row in rows.iterator()
+        ),
+        batch_size=1000,
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("adserver", "0075_impression_rollups"),
+    ]
+
+    operations = [
+        # The rollups are deleted going backwards
+        migrations.RunPython(forwards, reverse_code=migrations.RunPython.noop)
+    ]
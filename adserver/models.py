@@ -1,10 +1,13 @@
 """Core models for the ad server."""
+import copy
 import datetime
 import html
 import logging
 import math
 import uuid
 from collections import Counter
+from collections import defaultdict
+from itertools import islice
 
 import bleach
 import djstripe.models as djstripe_models
@@ -13,6 +16,7 @@ from django.core.cache import cache
 from django.core.cache import caches
 from django.core.validators import MaxValueValidator
 from django.core.validators import MinValueValidator
+from django.db import connections
 from django.db import IntegrityError
 from django.db import models
 from django.db import transaction
@@ -31,7 +35,6 @@ from django_extensions.db.models import TimeStampedModel
 from djstripe.enums import InvoiceStatus
 from jsonfield import JSONField
 from simple_history.models import HistoricalRecords
-from user_agents import parse
 
 from .constants import CAMPAIGN_TYPES
 from .constants import CLICKS
@@ -50,6 +53,7 @@ from .constants import PAYOUT_STRIPE
 from .constants import PENDING
 from .constants import PUBLISHER_PAYOUT_METHODS
 from .constants import VIEWS
+from .counters import impression_counter
 from .utils import anonymize_ip_address
 from .utils import calculate_ctr
 from .utils import COUNTRY_DICT
@@ -58,6 +62,7 @@ from .utils import get_ad_day
 from .utils import get_client_country
 from .utils import get_client_id
 from .utils import get_client_ip
+from .utils import get_client_parsed_user_agent
 from .utils import get_client_user_agent
 from .utils import get_domain_from_url
 from .validators import TargetingParametersValidator
@@ -130,7 +135,7 @@ class Topic(TimeStampedModel, models.Model):
         # topic -> list of keyword slugs
         topics = {}
 
-        for topic in Topic.objects.all().prefetch_related():
+        for topic in Topic.objects.all().prefetch_related("keywords"):
             topics[topic.slug] = [kw.slug for kw in topic.keywords.all()]
 
         caches[settings.CACHE_LOCAL_ALIAS].set(
@@ -659,6 +664,149 @@ class Campaign(TimeStampedModel, IndestructibleModel):
         return aggregation or 0.0
 
 
+class FlightTargeting:
+
+    """
+    Targeting parameters for a :py:class:`~Flight` compiled for fast evaluation.
+
+    Ad decisions check the targeting of every candidate flight.
+    Rather than re-reading the targeting parameters and reloading regions and topics
+    on each check, they are parsed once into frozensets
+    with regions expanded into countries and topics expanded into keywords.
+    """
+
+    def __init__(self, targeting_parameters):
+        """Compile the targeting parameters (``Flight.targeting_parameters``)."""
+        params = targeting_parameters or {}
+
+        self.included_countries = frozenset(params.get("include_countries", []))
+        self.excluded_countries = frozenset(params.get("exclude_countries", []))
+        self.included_state_provinces = frozenset(
+            params.get("include_state_provinces", [])
+        )
+        self.included_metro_codes = frozenset(params.get("include_metro_codes", []))
+
+        self.included_keywords = frozenset(params.get("include_keywords", []))
+        self.excluded_keywords = frozenset(params.get("exclude_keywords", []))
+
+        self.included_publishers = frozenset(params.get("include_publishers", []))
+        self.excluded_publishers = frozenset(params.get("exclude_publishers", []))
+        self.included_domains = frozenset(params.get("include_domains", []))
+        self.excluded_domains = frozenset(params.get("exclude_domains", []))
+
+        self.mobile_traffic = params.get("mobile_traffic")
+
+        # Regions expanded into the countries in them
+        # ``None`` means there is no region targeting
+        self.included_region_countries = None
+        self.excluded_region_countries = None
+        included_regions = params.get("include_regions", [])
+        excluded_regions = params.get("exclude_regions", [])
+        if included_regions or excluded_regions:
+            # Only load regions if we have to
+            regions = Region.load_from_cache()
+            if included_regions:
+                self.included_region_countries = frozenset(
+                    country
+                    for reg in included_regions
+                    if reg in regions
+                    for country in regions[reg]
+                )
+            if excluded_regions:
+                self.excluded_region_countries = frozenset(
+                    country
+                    for reg in excluded_regions
+                    if reg in regions
+                    for country in regions[reg]
+                )
+
+        # Topics expanded into the keywords in them
+        # ``None`` means there is no topic targeting
+        self.included_topic_keywords = None
+        included_topics = params.get("include_topics", [])
+        if included_topics:
+            topics = Topic.load_from_cache()
+            topic_keywords = set()
+            for topic_slug in included_topics:
+                # Be defensive in case the topic isn't in the cache
+                if topic_slug not in topics:
+                    log.warning("Unknown topic being targeted. Topic=%s", topic_slug)
+                    continue
+                topic_keywords.update(topics[topic_slug])
+            self.included_topic_keywords = frozenset(topic_keywords)
+
+    def show_to_geo(self, geo_data):
+        """Check if the geolocation (``GeolocationData``) matches the geo targeting."""
+        country = geo_data.country
+        if self.included_countries and country not in self.included_countries:
+            return False
+        if (
+            self.included_state_provinces
+            and geo_data.region not in self.included_state_provinces
+        ):
+            return False
+        if (
+            self.included_metro_codes
+            and geo_data.metro not in self.included_metro_codes
+        ):
+            return False
+        if country in self.excluded_countries:
+            return False
+        if (
+            self.included_region_countries is not None
+            and country not in self.included_region_countries
+        ):
+            return False
+        if (
+            self.excluded_region_countries is not None
+            and country in self.excluded_region_countries
+        ):
+            return False
+
+        return True
+
+    def show_to_keywords(self, keywords):
+        """Check if a set of page keywords matches the keyword and topic targeting."""
+        if self.included_keywords and self.included_keywords.isdisjoint(keywords):
+            return False
+        if not self.excluded_keywords.isdisjoint(keywords):
+            return False
+        if (
+            self.included_topic_keywords is not None
+            and self.included_topic_keywords.isdisjoint(keywords)
+        ):
+            return False
+
+        return True
+
+    def show_to_mobile(self, is_mobile):
+        """Check if mobile/non-mobile traffic matches the mobile targeting."""
+        if self.mobile_traffic == "exclude" and is_mobile:
+            return False
+        if self.mobile_traffic == "only" and not is_mobile:
+            return False
+
+        return True
+
+    def show_on_publisher(self, publisher_slug):
+        """Check if a publisher (by slug) matches the publisher targeting."""
+        if self.included_publishers:
+            return publisher_slug in self.included_publishers
+        if self.excluded_publishers:
+            return publisher_slug not in self.excluded_publishers
+
+        return True
+
+    def show_on_domain(self, domain):
+        """Check if a page domain matches the domain targeting."""
+        if self.included_domains:
+            return domain in self.included_domains
+        if self.excluded_domains:
+            return domain not in self.excluded_domains
+
+        return True
+
+
 class Flight(TimeStampedModel, IndestructibleModel):
 
     """
@@ -754,6 +902,9 @@ class Flight(TimeStampedModel, IndestructibleModel):
 
     history = HistoricalRecords()
 
+    # Recent CTRs of flights and of flights on each publisher (see ``get_sampled_ctrs``)
+    SAMPLED_CTRS_CACHE_KEY = "flight-sampled-ctrs"
+
     class Meta:
         ordering = ("name",)
 
@@ -761,6 +912,16 @@ class Flight(TimeStampedModel, IndestructibleModel):
         """Simple override."""
         return self.name
 
+    @classmethod
+    def get_sampled_ctrs(cls):
+        """
+        Get the recent CTRs of flights periodically calculated by ``calculate_publisher_ctrs``.
+
+        :returns: a dict of flight ID -> CTR and (publisher ID, flight ID) -> CTR
+            for flights (and flights on a publisher) with enough views to sample
+        """
+        return cache.get(cls.SAMPLED_CTRS_CACHE_KEY) or {}
+
     @property
     def included_countries(self):
         if not self.targeting_parameters:
@@ -893,6 +1054,22 @@ class Flight(TimeStampedModel, IndestructibleModel):
         excluded_country_codes = self.excluded_countries
         return [COUNTRY_DICT.get(cc, "Unknown") for cc in excluded_country_codes]
 
+    @property
+    def targeting(self):
+        """
+        The compiled targeting for this flight (see :py:class:`~FlightTargeting`).
+
+        This is cached on the flight and only recompiled when the targeting parameters change.
+        """
+        cached = getattr(self, "_targeting_cache", None)
+        if cached is None or cached[0] != self.targeting_parameters:
+            cached = (
+                copy.deepcopy(self.targeting_parameters),
+                FlightTargeting(self.targeting_parameters),
+            )
+            self._targeting_cache = cached
+        return cached[1]
+
     def show_to_geo(self, geo_data):
         """
         Check if a flight is valid for a given country code.
@@ -901,40 +1078,7 @@ class Flight(TimeStampedModel, IndestructibleModel):
         will not match a flight with any ``include_countries`` but wont be
         excluded from any ``exclude_countries``
         """
-        if self.included_countries and geo_data.country not in self.included_countries:
-            return False
-        if (
-            self.included_state_provinces
-            and geo_data.region not in self.included_state_provinces
-        ):
-            return False
-        if (
-            self.included_metro_codes
-            and geo_data.metro not in self.included_metro_codes
-        ):
-            return False
-        if self.excluded_countries and geo_data.country in self.excluded_countries:
-            return False
-
-        # Check region groupings as well
-        if self.included_regions or self.excluded_regions:
-            # Only load regions if we have to
-            regions = Region.load_from_cache()
-            if self.included_regions and not any(
-                geo_data.country in regions[reg]
-                for reg in self.included_regions
-                if reg in regions
-            ):
-                return False
-
-            if self.excluded_regions and any(
-                geo_data.country in regions[reg]
-                for reg in self.excluded_regions
-                if reg in regions
-            ):
-                return False
-
-        return True
+        return self.targeting.show_to_geo(geo_data)
 
     def show_to_keywords(self, keywords):
         """
@@ -943,71 +1087,17 @@ class Flight(TimeStampedModel, IndestructibleModel):
         If *any* keywords match the included list, it should be shown.
         If *any* keywords are in the excluded list, it should not be shown.
         """
-        keyword_set = set(keywords)
-        if self.included_keywords:
-            # If no keywords from the page in the include list, don't show this flight
-            if not keyword_set.intersection(self.included_keywords):
-                return False
-
-        if self.excluded_keywords:
-            # If any keyworks from the page in the exclude list, don't show this flight
-            if keyword_set.intersection(self.excluded_keywords):
-                return False
-
-        # Check topics (groupings of keywords)
-        if self.included_topics:
-            topics = Topic.load_from_cache()
-            topic_keyword_set = set()
-            for topic_slug in self.included_topics:
-                # Be defensive in case the topic isn't in the cache
-                if topic_slug not in topics:
-                    log.warning(
-                        "Unknown topic being targeted. Topic=%s, Flight=%s",
-                        topic_slug,
-                        self,
-                    )
-                    continue
-
-                for kw in topics[topic_slug]:
-                    topic_keyword_set.add(kw)
-
-            if not keyword_set.intersection(topic_keyword_set):
-                return False
-
-        return True
+        return self.targeting.show_to_keywords(frozenset(keywords))
 
     def show_to_mobile(self, is_mobile):
         """Check if a flight is valid for this traffic based on mobile/non-mobile."""
-        if not self.targeting_parameters:
-            return True
-
-        mobile_traffic_targeting = self.targeting_parameters.get("mobile_traffic")
-        if mobile_traffic_targeting == "exclude" and is_mobile:
-            return False
-        if mobile_traffic_targeting == "only" and not is_mobile:
-            return False
-
-        return True
+        return self.targeting.show_to_mobile(is_mobile)
 
     def show_on_publisher(self, publisher):
-        if self.included_publishers:
-            return publisher.slug in self.included_publishers
-
-        if self.excluded_publishers:
-            return publisher.slug not in self.excluded_publishers
-
-        return True
+        return self.targeting.show_on_publisher(publisher.slug)
 
     def show_on_domain(self, url):
-        domain = get_domain_from_url(url)
-
-        if self.included_domains:
-            return domain in self.included_domains
-
-        if self.excluded_domains:
-            return domain not in self.excluded_domains
-
-        return True
+        return self.targeting.show_on_domain(get_domain_from_url(url))
 
     def sold_days(self):
         # Add one to count both the start and end day
@@ -1022,24 +1112,32 @@ class Flight(TimeStampedModel, IndestructibleModel):
         if hasattr(self, "flight_views_today"):
             return self.flight_views_today or 0
 
+        day = get_ad_day().date()
         aggregation = AdImpression.objects.filter(
-            advertisement__in=self.advertisements.all(), date=get_ad_day().date()
+            advertisement__in=self.advertisements.all(), date=day
         ).aggregate(total_views=models.Sum("views"))["total_views"]
 
         # The aggregation can be `None` if there are no impressions
-        return aggregation or 0
+        # Include views in this process that haven't been written yet
+        return (aggregation or 0) + impression_counter.get_pending_impressions(
+            self.pk, day, VIEWS
+        )
 
     def clicks_today(self):
         # Check for a cached value that would come from an annotated queryset
         if hasattr(self, "flight_clicks_today"):
             return self.flight_clicks_today or 0
 
+        day = get_ad_day().date()
         aggregation = AdImpression.objects.filter(
-            advertisement__in=self.advertisements.all(), date=get_ad_day().date()
+            advertisement__in=self.advertisements.all(), date=day
         ).aggregate(total_clicks=models.Sum("clicks"))["total_clicks"]
 
         # The aggregation can be `None` if there are no impressions
-        return aggregation or 0
+        # Include clicks in this process that haven't been written yet
+        return (aggregation or 0) + impression_counter.get_pending_impressions(
+            self.pk, day, CLICKS
+        )
 
     def views_needed_today(self):
         if (
@@ -1049,8 +1147,9 @@ class Flight(TimeStampedModel, IndestructibleModel):
         ):
             return 0
 
-        if self.days_remaining() > 0:
-            flight_remaining_percentage = self.days_remaining() / self.sold_days()
+        days_remaining = self.days_remaining()
+        if days_remaining > 0:
+            flight_remaining_percentage = days_remaining / self.sold_days()
 
             # This is how many views should be remaining this far in the flight
             flight_views_pace = int(self.sold_impressions * flight_remaining_percentage)
@@ -1068,8 +1167,9 @@ class Flight(TimeStampedModel, IndestructibleModel):
         ):
             return 0
 
-        if self.days_remaining() > 0:
-            flight_remaining_percentage = self.days_remaining() / self.sold_days()
+        days_remaining = self.days_remaining()
+        if days_remaining > 0:
+            flight_remaining_percentage = days_remaining / self.sold_days()
 
             # This is how many clicks we should have remaining this far in the flight
             flight_clicks_pace = int(self.sold_clicks * flight_remaining_percentage)
@@ -1078,14 +1178,14 @@ class Flight(TimeStampedModel, IndestructibleModel):
 
         return self.clicks_remaining()
 
-    def weighted_clicks_needed_today(self, publisher=None):
+    def weighted_clicks_needed_today(self, publisher=None, sampled_ctrs=None):
         """
         Calculates clicks needed taking into account a flight's priority.
 
         For the purpose of clicks needed, 1000 impressions = 1 click (for CPM ads)
         Takes into account value of the flight,
         which causes higher paid and better CTR ads to be prioritized.
-        Uses the passed publisher for a better CTR estimate if passed.
+        Uses the passed publisher and sampled CTRs for a better CTR estimate if passed.
         """
         impressions_needed = 0
 
@@ -1093,12 +1193,31 @@ class Flight(TimeStampedModel, IndestructibleModel):
         impressions_needed += math.ceil(self.views_needed_today() / 1000.0)
         impressions_needed += self.clicks_needed_today()
 
+        return int(
+            impressions_needed
+            * self.priority_multiplier
+            * self.price_priority_value(publisher, sampled_ctrs)
+        )
+
+    def price_priority_value(self, publisher=None, sampled_ctrs=None):
+        """
+        The estimated eCPM of this flight used to prioritize higher value flights.
+
+        Uses the passed publisher for a better CTR estimate if passed.
+
+        :param publisher: the publisher the ad would be shown on
+        :param sampled_ctrs: the recent CTRs of flights from ``Flight.get_sampled_ctrs``
+        """
         if self.cpc:
-            # Use the publisher CTR if available
-            # Otherwise, use this flight's average CTR
-            estimated_ctr = float(self.ctr())
+            # Use the CTR of this flight on the publisher if it was sampled
+            # Otherwise, use the publisher CTR if available
+            # Otherwise, use this flight's recent CTR or its average CTR
+            sampled_ctrs = sampled_ctrs or {}
+            estimated_ctr = sampled_ctrs.get(self.pk, float(self.ctr()))
             if publisher and publisher.sampled_ctr > 0.01:
                 estimated_ctr = publisher.sampled_ctr
+            if publisher and (publisher.pk, self.pk) in sampled_ctrs:
+                estimated_ctr = sampled_ctrs[(publisher.pk, self.pk)]
 
             # Note: CTR is in percent (eg. 0.1 means 0.1% not 0.001)
             estimated_ecpm = float(self.cpc) * estimated_ctr * 10
@@ -1113,9 +1232,7 @@ class Flight(TimeStampedModel, IndestructibleModel):
         # Keep values between 1-10 so we don't penalize the value for lower performance
         # but add value for higher performance without overweighting
         price_priority_value = max(float(price_priority_value), 1.0)
-        price_priority_value = min(price_priority_value, 10.0)
-
-        return int(impressions_needed * self.priority_multiplier * price_priority_value)
+        return min(price_priority_value, 10.0)
 
     def clicks_remaining(self):
         return max(0, self.sold_clicks - self.total_clicks)
@@ -1384,6 +1501,8 @@ class Advertisement(TimeStampedModel, IndestructibleModel):
         TODO: Refactor this method, moving it off the Advertisement class since it can be called
               without an advertisement when we have a Decision and no Offer.
         """
+        from .decisionengine.pacing import PacingSnapshot  # noqa
+
         day = get_ad_day().date()
 
         if isinstance(impression_type, str):
@@ -1391,48 +1510,77 @@ class Advertisement(TimeStampedModel, IndestructibleModel):
         else:
             impression_types = impression_type
 
+        if impression_counter.is_enabled():
+            # Coalesce the counts in memory and write them periodically
+            for imp_type in impression_types:
+                assert imp_type in IMPRESSION_TYPES
+                if self and imp_type in (CLICKS, VIEWS):
+                    PacingSnapshot.record(self.flight_id, imp_type)
+
+            impression_counter.add(
+                flight_id=self.flight_id if self else None,
+                advertisement_id=self.pk if self else None,
+                publisher_id=publisher.pk if publisher else None,
+                day=day,
+                impression_types=impression_types,
+            )
+            return
+
         for imp_type in impression_types:
             assert imp_type in IMPRESSION_TYPES
 
             # Update the denormalized fields on the Flight
+            # and keep this process' pacing up-to-date between refreshes
             if imp_type == VIEWS:
                 Flight.objects.filter(pk=self.flight_id).update(
                     total_views=models.F("total_views") + 1
                 )
+                PacingSnapshot.record(self.flight_id, imp_type)
             elif imp_type == CLICKS:
                 Flight.objects.filter(pk=self.flight_id).update(
                     total_clicks=models.F("total_clicks") + 1
                 )
+                PacingSnapshot.record(self.flight_id, imp_type)
 
-        # Ensure that an impression object exists for today
+        # Create or update the impression object for today
         # and make sure to query the writable DB for this
-        impression, created = AdImpression.objects.using("default").get_or_create(
-            advertisement=self,
-            publisher=publisher,
-            date=day,
-            defaults={imp_type: 1 for imp_type in impression_types},
+        AdImpression.bulk_upsert(
+            [
+                {
+                    "publisher_id": publisher.pk if publisher else None,
+                    "advertisement_id": self.pk if self else None,
+                    "date": day,
+                    **{imp_type: 1 for imp_type in impression_types},
+                }
+            ],
+            unique_fields=AdImpression.UNIQUE_FIELDS,
+            update_fields=impression_types,
+            increment=True,
+            using="default",
         )
 
-        if not created:
-            # If the object was created above, we don't need to update
-            # since the defaults will have already done the update for us.
-            AdImpression.objects.using("default").filter(pk=impression.pk).update(
-                **{imp_type: models.F(imp_type) + 1 for imp_type in impression_types}
-            )
-
     def _record_base(
-        self, request, model, publisher, keywords, url, div_id, ad_type_slug
+        self,
+        request,
+        model,
+        publisher,
+        keywords,
+        url,
+        div_id,
+        ad_type_slug,
+        commit=True,
     ):
         """
         Save the actual AdBase model to the database.
 
         This is used for all subclasses,
         so we need to keep all the data passed in generic.
+        With ``commit=False``, the object is returned without saving it (eg. to bulk create it).
         """
         ip_address = get_client_ip(request)
         user_agent = get_client_user_agent(request)
         client_id = get_client_id(request)
-        parsed_ua = parse(user_agent)
+        parsed_ua = get_client_parsed_user_agent(request)
         country = get_client_country(request)
         url = url or request.META.get("HTTP_REFERER")
 
@@ -1451,7 +1599,7 @@ class Advertisement(TimeStampedModel, IndestructibleModel):
             # we only store the first 100 characters of it.
             div_id = div_id[: Offer.DIV_MAXLENGTH]
 
-        obj = model.objects.create(
+        obj = model(
             date=timezone.now(),
             publisher=publisher,
             ip=anonymize_ip_address(ip_address),
@@ -1471,6 +1619,8 @@ class Advertisement(TimeStampedModel, IndestructibleModel):
             # Page info
             advertisement=self,
         )
+        if commit:
+            obj.save(force_insert=True)
         return obj
 
     def track_impression(self, request, impression_type, publisher, offer):
@@ -1508,7 +1658,8 @@ class Advertisement(TimeStampedModel, IndestructibleModel):
 
         if request.GET.get("uplift"):
             # Don't overwrite Offer object here, since it might have changed prior to our writing
-            Offer.objects.filter(pk=offer.pk).update(uplifted=True)
+            # Filtering by date only touches the partition with the offer
+            Offer.objects.filter(pk=offer.pk, date=offer.date).update(uplifted=True)
 
         if settings.ADSERVER_RECORD_VIEWS or publisher.record_views:
             return self._record_base(
@@ -1537,7 +1688,10 @@ class Advertisement(TimeStampedModel, IndestructibleModel):
             and not offer.view_time
             and view_time > 0
         ):
-            Offer.objects.filter(pk=offer.pk).update(view_time=view_time)
+            Offer.objects.filter(pk=offer.pk, date=offer.date).update(
+                view_time=view_time
+            )
+            Offer.update_nonce(offer.pk, view_time=view_time)
             return True
 
         log.info("View time was for an invalid view")
@@ -1551,6 +1705,16 @@ class Advertisement(TimeStampedModel, IndestructibleModel):
 
         Tracks an offer in the database to save data about it and compare against view.
         """
+        if settings.ADSERVER_OFFER_WRITE_BEHIND:
+            return self.offer_ads(
+                request=request,
+                publisher=publisher,
+                placements=[(self, ad_type_slug, div_id)],
+                keywords=keywords,
+                url=url,
+                forced=forced,
+            )[0]
+
         ad_type = AdType.objects.filter(slug=ad_type_slug).first()
 
         self.incr(impression_type=(OFFERS, DECISIONS), publisher=publisher)
@@ -1563,7 +1727,133 @@ class Advertisement(TimeStampedModel, IndestructibleModel):
             div_id=div_id,
             ad_type_slug=ad_type_slug,
         )
+        Offer.cache_nonces([offer])
+
+        return self._get_offer_data(
+            offer=offer,
+            publisher=publisher,
+            ad_type=ad_type,
+            ad_type_slug=ad_type_slug,
+            keywords=keywords,
+            forced=forced,
+        )
 
+    @classmethod
+    def offer_ads(
+        cls, request, publisher, placements, keywords, url=None, forced=False
+    ):
+        """
+        Offer ads (or record null offers) for multiple placements on the same page.
+
+        This is the same as calling :py:meth:`offer_ad` or :py:meth:`record_null_offer`
+        for each placement but the offers and impression counts are written in bulk.
+
+        :param placements: a list of 3-tuples of the ad (``None`` for a null offer),
+            the ad type slug and the div ID
+        :return: a list of the offer data (see ``offer_ad``) in the same order as the placements
+            with an empty dict for null offers
+        """
+        ad_types = AdType.objects.in_bulk(
+            {ad_type_slug for _, ad_type_slug, _ in placements}, field_name="slug"
+        )
+
+        offers = [
+            cls._record_base(
+                self=ad,
+                request=request,
+                model=Offer,
+                publisher=publisher,
+                keywords=keywords,
+                url=url,
+                div_id=div_id,
+                ad_type_slug=ad_type_slug,
+                commit=False,
+            )
+            for ad, ad_type_slug, div_id in placements
+        ]
+        if settings.ADSERVER_OFFER_WRITE_BEHIND:
+            Offer.record_later(offers)
+        elif impression_counter.is_enabled():
+            Offer.objects.bulk_create(offers)
+            Offer.cache_nonces(offers)
+            day = get_ad_day().date()
+            for ad, _, _ in placements:
+                impression_counter.add(
+                    flight_id=ad.flight_id if ad else None,
+                    advertisement_id=ad.pk if ad else None,
+                    publisher_id=publisher.pk,
+                    day=day,
+                    impression_types=(DECISIONS, OFFERS) if ad else (DECISIONS,),
+                )
+        else:
+            Offer.objects.bulk_create(offers)
+            Offer.cache_nonces(offers)
+            cls.incr_offers(
+                [offer.advertisement_id for offer in offers],
+                publisher_id=publisher.pk,
+            )
+
+        return [
+            ad._get_offer_data(
+                offer=offer,
+                publisher=publisher,
+                ad_type=ad_types.get(ad_type_slug),
+                ad_type_slug=ad_type_slug,
+                keywords=keywords,
+                forced=forced,
+            )
+            if ad
+            else {}
+            for offer, (ad, ad_type_slug, _) in zip(offers, placements)
+        ]
+
+    @staticmethod
+    def incr_offers(advertisement_ids, publisher_id, day=None):
+        """
+        Count the decisions and offers for multiple ads with as few queries as possible.
+
+        Each ad counts as a decision and an offer and each ``None`` counts as a decision only.
+        """
+        if not day:
+            day = get_ad_day().date()
+        ad_counts = Counter(ad_id for ad_id in advertisement_ids if ad_id)
+        null_offers = len(advertisement_ids) - sum(ad_counts.values())
+
+        # Create or update the impression objects for today
+        # and make sure to query the writable DB for this
+        rows = [
+            {
+                "publisher_id": publisher_id,
+                "advertisement_id": ad_id,
+                "date": day,
+                DECISIONS: count,
+                OFFERS: count,
+            }
+            for ad_id, count in ad_counts.items()
+        ]
+        if null_offers:
+            rows.append(
+                {
+                    "publisher_id": publisher_id,
+                    "advertisement_id": None,
+                    "date": day,
+                    DECISIONS: null_offers,
+                    OFFERS: 0,
+                }
+            )
+
+        AdImpression.bulk_upsert(
+            rows,
+            unique_fields=AdImpression.UNIQUE_FIELDS,
+            update_fields=(DECISIONS, OFFERS),
+            increment=True,
+            using="default",
+        )
+
+    def _get_offer_data(
+        self, offer, publisher, ad_type, ad_type_slug, keywords, forced
+    ):
+        """Get the data returned to the client when offering this ad (see ``offer_ad``)."""
         if forced and self.flight.campaign.campaign_type == PAID_CAMPAIGN:
             # Ad offers forced to a specific ad or campaign should never be billed.
             # By discarding the nonce, the ad view/click will never count.
@@ -1633,6 +1923,16 @@ class Advertisement(TimeStampedModel, IndestructibleModel):
         Without this, when we don't offer an ad and a user doesn't have house ads on,
         we don't have any way to track how many requests for an ad there have been.
         """
+        if settings.ADSERVER_OFFER_WRITE_BEHIND:
+            cls.offer_ads(
+                request=request,
+                publisher=publisher,
+                placements=[(None, ad_type_slug, div_id)],
+                keywords=keywords,
+                url=url,
+            )
+            return
+
         cls.incr(self=None, impression_type=DECISIONS, publisher=publisher)
         cls._record_base(
             self=None,
@@ -1663,10 +1963,34 @@ class Advertisement(TimeStampedModel, IndestructibleModel):
         return False
 
     def invalidate_nonce(self, impression_type, nonce):
+        """
+        Mark a nonce as used for an impression type if it is still valid.
+
+        This is a single conditional update so when concurrent requests use the same nonce,
+        only one of them invalidates it (see ``is_valid_offer``).
+
+        :returns: ``True`` if the nonce was invalidated by this call
+        """
         if impression_type == VIEWS:
-            Offer.objects.filter(id=nonce).update(viewed=True)
+            invalidated = (
+                Offer.objects.recent()
+                .filter(id=nonce, viewed=False)
+                .update(viewed=True)
+            )
+            if invalidated:
+                Offer.update_nonce(nonce, viewed=True)
+            return bool(invalidated)
         if impression_type == CLICKS:
-            Offer.objects.filter(id=nonce).update(clicked=True)
+            invalidated = (
+                Offer.objects.recent()
+                .filter(id=nonce, viewed=True, clicked=False)
+                .update(clicked=True)
+            )
+            if invalidated:
+                Offer.update_nonce(nonce, clicked=True)
+            return bool(invalidated)
+
+        return False
 
     def view_ratio(self, day=None):
         if not day:
@@ -1833,6 +2157,190 @@ class BaseImpression(TimeStampedModel, models.Model):
     class Meta:
         abstract = True
 
+    # Databases that support ``INSERT ... ON CONFLICT DO UPDATE``
+    UPSERT_VENDORS = ("postgresql", "sqlite")
+
+    @classmethod
+    def bulk_upsert(
+        cls,
+        rows,
+        unique_fields,
+        update_fields,
+        increment=False,
+        using="default",
+        batch_size=1000,
+    ):
+        """
+        Insert impressions or update them if they already exist with one query per batch.
+
+        This replaces ``get_or_create()`` followed by ``filter(pk=...).update(...)``
+        which takes two or three queries per impression and races under concurrency.
+
+        :param rows: an iterable of dicts of field values (eg. ``publisher_id``, ``date``, ``views``)
+        :param unique_fields: the fields which identify an impression (a unique constraint)
+        :param update_fields: the fields set (or incremented) when the impression exists
+        :param increment: add to the existing values rather than replacing them
+        :param using: the database to write to
+        :param batch_size: the maximum number of impressions written per query
+        """
+        # Stay under the database's limit on parameters in a single query
+        max_query_params = connections[using].features.max_query_params
+        if max_query_params:
+            num_fields = len(cls._meta.concrete_fields)
+            batch_size = max(1, min(batch_size, max_query_params // num_fields))
+
+        rows = iter(rows)
+        while True:
+            batch = list(islice(rows, batch_size))
+            if not batch:
+                break
+
+            # The same impression can't be upserted twice in the same query
+            merged = {}
+            for row in batch:
+                key = tuple(row[field] for field in unique_fields)
+                if increment and key in merged:
+                    for field in update_fields:
+                        merged[key][field] += row[field]
+                else:
+                    merged[key] = dict(row)
+
+            # Impressions are grouped by their NULL fields
+            # since each group conflicts on a different unique constraint
+            upserts = defaultdict(list)
+            for key, row in merged.items():
+                null_fields = tuple(
+                    field for field, value in zip(unique_fields, key) if value is None
+                )
+                if connections[using].vendor in cls.UPSERT_VENDORS and (
+                    not null_fields
+                    or cls._has_null_constraint(unique_fields, null_fields)
+                ):
+                    upserts[null_fields].append(row)
+                else:
+                    cls._upsert_row(row, unique_fields, update_fields, increment, using)
+
+            for null_fields, upsert_rows in upserts.items():
+                cls._upsert_rows(
+                    upsert_rows,
+                    unique_fields,
+                    update_fields,
+                    increment,
+                    using,
+                    null_fields=null_fields,
+                )
+
+    @classmethod
+    def _has_null_constraint(cls, unique_fields, null_fields):
+        """
+        Check for a unique constraint on the other fields when the null fields are NULL.
+
+        Unique constraints don't apply when any of the fields are NULL
+        so these impressions need a partial unique constraint
+        like ``AdImpression``'s ``null_offer_unique``.
+        """
+        other_fields = {
+            cls._meta.get_field(field).name
+            for field in unique_fields
+            if field not in null_fields
+        }
+        null_fields = {cls._meta.get_field(field).name for field in null_fields}
+        for constraint in cls._meta.constraints:
+            if not isinstance(constraint, UniqueConstraint) or not constraint.condition:
+                continue
+            condition = constraint.condition
+            if (
+                set(constraint.fields) == other_fields
+                and condition.connector == models.Q.AND
+                and not condition.negated
+                and set(condition.children) == {(name, None) for name in null_fields}
+            ):
+                return True
+        return False
+
+    @classmethod
+    def _upsert_rows(
+        cls, rows, unique_fields, update_fields, increment, using, null_fields=()
+    ):
+        connection = connections[using]
+        quote_name = connection.ops.quote_name
+        now = timezone.now()
+
+        fields = [
+            cls._meta.get_field(name)
+            for name in ("created", "modified", *unique_fields, *update_fields)
+        ]
+        # New impressions get the defaults for any other counts
+        fields.extend(
+            field
+            for field in cls._meta.concrete_fields
+            if field.has_default() and field not in fields
+        )
+        columns = [quote_name(field.column) for field in fields]
+        table = quote_name(cls._meta.db_table)
+
+        params = []
+        for row in rows:
+            values = dict(row, created=now, modified=now)
+            params.extend(
+                field.get_db_prep_save(
+                    values[field.attname]
+                    if field.attname in values
+                    else field.get_default(),
+                    connection,
+                )
+                for field in fields
+            )
+
+        # Impressions with NULL fields conflict on the partial unique constraint
+        # on the other fields (see ``_has_null_constraint``)
+        conflict_columns = [
+            quote_name(cls._meta.get_field(field).column)
+            for field in unique_fields
+            if field not in null_fields
+        ]
+        conflict_target = f"({', '.join(conflict_columns)})"
+        if null_fields:
+            conflict_target += " WHERE " + " AND ".join(
+                f"{quote_name(cls._meta.get_field(field).column)} IS NULL"
+                for field in null_fields
+            )
+        updates = [f"{quote_name('modified')} = EXCLUDED.{quote_name('modified')}"]
+        for column in columns[
+            2 + len(unique_fields) : 2 + len(unique_fields) + len(update_fields)
+        ]:
+            if increment:
+                updates.append(f"{column} = {table}.{column} + EXCLUDED.{column}")
+            else:
+                updates.append(f"{column} = EXCLUDED.{column}")
+
+        placeholders = "(" + ", ".join(["%s"] * len(columns)) + ")"
+        sql = (
+            f"INSERT INTO {table} ({', '.join(columns)}) "
+            f"VALUES {', '.join([placeholders] * len(rows))} "
+            f"ON CONFLICT {conflict_target} "
+            f"DO UPDATE SET {', '.join(updates)}"
+        )
+        with connection.cursor() as cursor:
+            cursor.execute(sql, params)
+
+    @classmethod
+    def _upsert_row(cls, row, unique_fields, update_fields, increment, using):
+        """Upsert a single impression without ``ON CONFLICT`` (eg. for NULL fields)."""
+        impression, _ = cls.objects.using(using).get_or_create(
+            **{field: row[field] for field in unique_fields}
+        )
+        if increment:
+            updates = {
+                field: models.F(field) + row[field]
+                for field in update_fields
+                if row[field]
+            }
+        else:
+            updates = {field: row[field] for field in update_fields}
+        if updates:
+            cls.objects.using(using).filter(pk=impression.pk).update(**updates)
+
     @property
     def view_ratio(self):
         if self.offers == 0:
@@ -1865,6 +2373,9 @@ class AdImpression(BaseImpression):
         null=True,
     )
 
+    # Fields which identify an impression (for ``bulk_upsert``)
+    UNIQUE_FIELDS = ("publisher_id", "advertisement_id", "date")
+
     class Meta:
         # We must also constrain when the `advertisement` is null
         constraints = (
@@ -2062,6 +2573,67 @@ class RegionTopicImpression(BaseImpression):
         return f"RegionTopic Impression ({self.region}:{self.topic}) on {self.date}"
 
 
+class PublisherMonthlyImpression(BaseImpression):
+
+    """
+    A rollup of a publisher's ad impressions for a month.
+
+    Indexed one per publisher/campaign type per month (``date`` is the first of the month).
+    The campaign type is null for decisions where no ad was offered.
+    This is recomputed from AdImpressions by ``adserver.aggregation.update_rollups``.
+    """
+
+    publisher = models.ForeignKey(
+        Publisher, related_name="monthly_impressions", on_delete=models.PROTECT
+    )
+    campaign_type = models.CharField(
+        _("Campaign Type"),
+        max_length=20,
+        choices=CAMPAIGN_TYPES,
+        null=True,
+    )
+    revenue = models.FloatField(
+        _("Revenue"),
+        default=0,
+        help_text=_("Revenue from the views and clicks before the revenue share"),
+    )
+
+    class Meta:
+        ordering = ("-date",)
+        unique_together = ("publisher", "campaign_type", "date")
+
+    def __str__(self):
+        """Simple override."""
+        return f"Monthly impressions of {self.publisher} ({self.campaign_type}) for {self.date:%Y-%m}"
+
+
+class FlightImpression(BaseImpression):
+
+    """
+    A rollup of a flight's ad impressions for a day.
+
+    Indexed one per flight per day.
+    This is recomputed from AdImpressions by ``adserver.aggregation.update_rollups``.
+    """
+
+    flight = models.ForeignKey(
+        Flight, related_name="daily_impressions", on_delete=models.PROTECT
+    )
+    revenue = models.FloatField(
+        _("Revenue"),
+        default=0,
+        help_text=_("The cost of the views and clicks to the advertiser"),
+    )
+
+    class Meta:
+        ordering = ("-date",)
+        unique_together = ("flight", "date")
+
+    def __str__(self):
+        """Simple override."""
+        return f"Impressions of {self.flight} on {self.date}"
+
+
 class AdBase(TimeStampedModel, IndestructibleModel):
 
     """A base class for data on ad views and clicks."""
@@ -2150,12 +2722,50 @@ class View(AdBase):
     impression_type = VIEWS
 
 
+class OfferQuerySet(IndestructibleQuerySet):
+
+    """Queries for offers."""
+
+    def recent(self):
+        """
+        Offers that aren't too old to be viewed or clicked (see ``Offer.is_old``).
+
+        When the offers table is partitioned by date, this only touches the latest partitions.
+        """
+        return self.filter(date__gte=timezone.now() - Offer.MAX_AGE)
+
+
 class Offer(AdBase):
 
     """Contains data on ad views."""
 
     MAX_VIEW_TIME = 5 * 60  # seconds
 
+    # Offers older than this can't be viewed or clicked
+    MAX_AGE = datetime.timedelta(hours=4)
+
+    # Offers waiting to be written (``ADSERVER_OFFER_WRITE_BEHIND``)
+    PENDING_CACHE_KEY = "pending-offer::{}"
+    PENDING_CACHE_TIMEOUT = 60 * 15  # seconds
+
+    # Recent offers cached by nonce to validate views and clicks (``ADSERVER_NONCE_CACHE``)
+    NONCE_CACHE_KEY = "offer-nonce::{}"
+    NONCE_CACHE_FIELDS = (
+        "date",
+        "publisher_id",
+        "advertisement_id",
+        "ip",
+        "os_family",
+        "browser_family",
+        "keywords",
+        "url",
+        "div_id",
+        "ad_type_slug",
+        "viewed",
+        "clicked",
+        "view_time",
+    )
+
     # Use an ok user-facing pk value
     id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
 
@@ -2168,6 +2778,8 @@ class Offer(AdBase):
     )
     impression_type = OFFERS
 
+    objects = OfferQuerySet.as_manager()
+
     # Invalidation logic
     viewed = models.BooleanField(_("Offer was viewed"), default=False)
     clicked = models.BooleanField(_("Offer was clicked"), default=False)
@@ -2191,7 +2803,7 @@ class Offer(AdBase):
         Refund this offer and any clicks/views derived from it.
 
         This does not modify any denormalized index records (eg. GeoImpression, PlacementImpression)
-        except for AdImpression itself.
+        except for AdImpression itself and its rollups (eg. PublisherMonthlyImpression).
         """
         if self.is_refunded:
             # Prevent double refunding
@@ -2223,15 +2835,156 @@ class Offer(AdBase):
                     **{CLICKS: models.F(CLICKS) - 1}
                 )
 
+            # Update the rollups of the AdImpressions (if they've been rolled up yet)
+            flight = self.advertisement.flight
+            rollup_updates = {self.impression_type: models.F(self.impression_type) - 1}
+            if self.viewed:
+                rollup_updates[VIEWS] = models.F(VIEWS) - 1
+                rollup_updates["revenue"] = (
+                    models.F("revenue") - float(flight.cpm) / 1000.0
+                )
+            if self.clicked:
+                rollup_updates[CLICKS] = models.F(CLICKS) - 1
+                rollup_updates["revenue"] = rollup_updates.get(
+                    "revenue", models.F("revenue")
+                ) - float(flight.cpc)
+            if self.publisher_id:
+                PublisherMonthlyImpression.objects.filter(
+                    publisher_id=self.publisher_id,
+                    campaign_type=flight.campaign.campaign_type,
+                    date=self.date.date().replace(day=1),
+                ).update(**rollup_updates)
+            FlightImpression.objects.filter(
+                flight=flight, date=self.date.date()
+            ).update(**rollup_updates)
+
         self.is_refunded = True
         self.save()
 
+        # The refunded impressions may be in cached reports for past days
+        # Invalidate them once the impressions and their rollups are committed
+        from .reports import invalidate_report_cache  # noqa
+
+        transaction.on_commit(invalidate_report_cache)
+
         return True
 
+    @classmethod
+    def record_later(cls, offers):
+        """
+        Write offers and count them asynchronously (``ADSERVER_OFFER_WRITE_BEHIND``).
+
+        The offers are also cached by nonce until they are written
+        so views and clicks that arrive first can still be validated
+        (see :py:meth:`~Offer.load_pending`).
+        """
+        from .tasks import record_offers  # noqa
+
+        offers_data = [
+            {
+                field.attname: field.value_from_object(offer)
+                for field in cls._meta.fields
+            }
+            for offer in offers
+        ]
+        cache.set_many(
+            {
+                cls.PENDING_CACHE_KEY.format(data["id"]): data
+                for data in offers_data
+                if data["advertisement_id"]
+            },
+            timeout=cls.PENDING_CACHE_TIMEOUT,
+        )
+
+        # Count the offers on the day they were made even if they are written later
+        record_offers.delay(offers_data, day=f"{get_ad_day():%Y-%m-%d}")
+
+    @classmethod
+    def load_pending(cls, nonce):
+        """
+        Write a pending offer immediately and return it or ``None`` if it isn't pending.
+
+        Writing the offer early doesn't count it twice.
+        It is counted when the rest of the offers are written.
+        """
+        data = cache.get(cls.PENDING_CACHE_KEY.format(nonce))
+        if not data:
+            return None
+
+        data = data.copy()
+        offer, _ = cls.objects.get_or_create(id=data.pop("id"), defaults=data)
+        cls.cache_nonces([offer])
+        return offer
+
+    @classmethod
+    def cache_nonces(cls, offers):
+        """
+        Cache the fields needed to validate views and clicks of offers (``ADSERVER_NONCE_CACHE``).
+
+        The cached offers expire when they are too old to be viewed or clicked.
+        The publisher is cached with them so views and clicks don't have to query it.
+        """
+        if not settings.ADSERVER_NONCE_CACHE:
+            return
+
+        cache.set_many(
+            {
+                cls.NONCE_CACHE_KEY.format(offer.pk): {
+                    "publisher": offer.publisher,
+                    **{
+                        field: getattr(offer, field) for field in cls.NONCE_CACHE_FIELDS
+                    },
+                }
+                for offer in offers
+                if offer.advertisement_id
+            },
+            timeout=cls.MAX_AGE.total_seconds(),
+        )
+
+    @classmethod
+    def load_nonce(cls, nonce):
+        """
+        Get an offer from the nonce cache or ``None`` if it isn't cached.
+
+        Only the fields in ``NONCE_CACHE_FIELDS`` and the publisher are set on the returned offer.
+        It can be used to update the offer but it should never be saved.
+        """
+        if not settings.ADSERVER_NONCE_CACHE:
+            return None
+
+        data = cache.get(cls.NONCE_CACHE_KEY.format(nonce))
+        if not data:
+            return None
+
+        publisher = data.pop("publisher", None)
+        offer = cls(id=nonce, **data)
+        if publisher:
+            offer.publisher = publisher
+        offer._state.adding = False
+        offer._state.db = "default"
+        return offer
+
+    @classmethod
+    def update_nonce(cls, nonce, **fields):
+        """Update the fields of an offer in the nonce cache (if it is cached)."""
+        if not settings.ADSERVER_NONCE_CACHE:
+            return
+
+        cache_key = cls.NONCE_CACHE_KEY.format(nonce)
+        data = cache.get(cache_key)
+        if not data:
+            return
+
+        # Keep the original expiry of the cached offer
+        timeout = (data["date"] + cls.MAX_AGE - timezone.now()).total_seconds()
+        if timeout > 0:
+            cache.set(cache_key, {**data, **fields}, timeout=timeout)
+        else:
+            cache.delete(cache_key)
+
     def is_old(self):
         """Checks if this offer is "old" meaning not for a currently running ad."""
-        four_hours_ago = timezone.now() - datetime.timedelta(hours=4)
-        if four_hours_ago > self.date:
+        if timezone.now() - self.MAX_AGE > self.date:
             return True
         return False
 
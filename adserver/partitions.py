@@ -0,0 +1,127 @@
+"""
+Monthly PostgreSQL range partitions of the offers table on ``Offer.date``.
+
+Partitions are named after the partitioned table and the month (eg. ``adserver_offer_2022_07``).
+Queries filtered by ``date`` (the nightly aggregations and ``Offer.objects.recent()``)
+only touch the partitions for those months.
+"""
+import datetime
+import logging
+
+from django.db import connections
+
+from .models import Offer
+
+
+log = logging.getLogger(__name__)  # noqa
+
+
+def get_offer_table():
+    """Get the name of the offers table (``ADSERVER_OFFER_DB_TABLE`` if set)."""
+    return Offer._meta.db_table
+
+
+def get_month(day):
+    """Get the first day of the month of a date."""
+    return datetime.date(day.year, day.month, 1)
+
+
+def get_next_month(month):
+    """Get the first day of the month after a date."""
+    return get_month(month + datetime.timedelta(days=32))
+
+
+def get_partition_name(table, month):
+    """Get the name of the partition of a table for a month (eg. ``adserver_offer_2022_03``)."""
+    return f"{table}_{month:%Y_%m}"
+
+
+def is_partitioned(table, using="default"):
+    """Whether a table is a partitioned table (always ``False`` except on PostgreSQL)."""
+    connection = connections[using]
+    if connection.vendor != "postgresql":
+        return False
+
+    with connection.cursor() as cursor:
+        cursor.execute(
+            """
+            SELECT 1 FROM pg_partitioned_table
+            JOIN pg_class ON pg_partitioned_table.partrelid = pg_class.oid
+            WHERE pg_class.relname = %s""",
+            [table],
+        )
+        return cursor.fetchone() is not None
+
+
+def get_partitions(table, using="default"):
+    """Get the names of the partitions of a table (PostgreSQL only)."""
+    connection = connections[using]
+    if connection.vendor != "postgresql":
+        return set()
+
+    with connection.cursor() as cursor:
+        cursor.execute(
+            """
+            SELECT child.relname FROM pg_inherits
+            JOIN pg_class parent ON pg_inherits.inhparent = parent.oid
+            JOIN pg_class child ON pg_inherits.inhrelid = child.oid
+            WHERE parent.relname = %s""",
+            [table],
+        )
+        return {row[0] for row in cursor.fetchall()}
+
+
+def get_create_table_sql(table, like_table):
+    """
+    Get the SQL to create a partitioned offers table with the same columns as another.
+
+    The primary key of a partitioned table has to include the partition key (``date``).
+    """
+    return [
+        f"CREATE TABLE {table} (LIKE {like_table} INCLUDING DEFAULTS INCLUDING CONSTRAINTS) "
+        f"PARTITION BY RANGE (date)",
+        f"ALTER TABLE {table} ADD PRIMARY KEY (id, date)",
+        f"ALTER TABLE {table} ADD FOREIGN KEY (advertisement_id) "
+        f"REFERENCES adserver_advertisement (id) DEFERRABLE INITIALLY DEFERRED",
+        f"ALTER TABLE {table} ADD FOREIGN KEY (publisher_id) "
+        f"REFERENCES adserver_publisher (id) DEFERRABLE INITIALLY DEFERRED",
+        f"CREATE INDEX {table}_date ON {table} (date)",
+        f"CREATE INDEX {table}_advertisement_id ON {table} (advertisement_id)",
+        f"CREATE INDEX {table}_publisher_id ON {table} (publisher_id)",
+    ]
+
+
+def get_create_partition_sql(table, month):
+    """Get the SQL to create the partition of a table for a month (indexes are inherited)."""
+    return (
+        f"CREATE TABLE IF NOT EXISTS {get_partition_name(table, month)} "
+        f"PARTITION OF {table} "
+        f"FOR VALUES FROM ('{month:%Y-%m-%d}') TO ('{get_next_month(month):%Y-%m-%d}')"
+    )
+
+
+def create_partitions(table, start_date, months_ahead, using="default", dry_run=False):
+    """
+    Create any missing monthly partitions from a date until a number of months ahead.
+
+    :returns: the names of the partitions created (or that would be created)
+    """
+    existing = get_partitions(table, using=using)
+
+    created = []
+    month = get_month(start_date)
+    last_month = get_month(datetime.date.today())
+    for _ in range(months_ahead):
+        last_month = get_next_month(last_month)
+
+    while month <= last_month:
+        name = get_partition_name(table, month)
+        if name not in existing:
+            if not dry_run:
+                log.info("Creating offer partition %s", name)
+                with connections[using].cursor() as cursor:
+                    cursor.execute(get_create_partition_sql(table, month))
+            created.append(name)
+        month = get_next_month(month)
+
+    return created
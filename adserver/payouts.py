@@ -0,0 +1,223 @@
+"""Payout data (the balance due and the current balance) for publishers."""
+import logging
+from collections import defaultdict
+from datetime import timedelta
+
+from django.core.cache import cache
+from django.db import models
+from django.urls import reverse
+from django.utils import timezone
+from django.utils.http import urlencode
+
+from .constants import PAID
+from .constants import PAID_CAMPAIGN
+from .models import AdImpression
+from .models import PublisherPayout
+from .reports import PublisherReport
+from .utils import generate_absolute_url
+
+
+log = logging.getLogger(__name__)  # noqa
+
+# The balances due on the staff payouts page are cached for 24 hours so we can finish payouts
+PAYOUT_CACHE_KEY = "payout-due-{year}-{month}-{publisher_id}"
+PAYOUT_CACHE_TIMEOUT = 60 * 60 * 24
+
+
+def get_payout_period(publisher, last_payout, today):
+    """
+    Get whether this is a publisher's first payout and the period of the balance due.
+
+    :returns: a tuple of (first, start_date, end_date)
+    """
+    end_date = today.replace(day=1) - timedelta(days=1)
+
+    if last_payout:
+        # First of the month of the month the payout was for.
+        # TODO: Store this data on the model, instead of hacking it.
+        return False, last_payout.date.replace(day=1), end_date
+
+    # Fake a payout to make the logic work.
+    return True, publisher.created, end_date
+
+
+def has_balance_due(start_date, today):
+    # Handle cases where a publisher has just joined this month
+    return start_date < today.replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+
+
+def get_report_url(publisher, start_date, end_date):
+    """Get the URL of a publisher's report of paid campaigns between two dates."""
+    report_url = generate_absolute_url(
+        reverse("publisher_report", kwargs={"publisher_slug": publisher.slug})
+    )
+    return (
+        report_url
+        + "?"
+        + urlencode(
+            {
+                "start_date": start_date.strftime("%Y-%m-%d"),
+                "end_date": end_date.strftime("%Y-%m-%d"),
+                "campaign_type": PAID_CAMPAIGN,
+            }
+        )
+    )
+
+
+def get_payout_data(
+    publisher, first, start_date, end_date, today, due_report, current_report
+):
+    """Get the payout data of a publisher (see ``generate_publisher_payout_data``)."""
+    return dict(
+        first=first,
+        start_date=start_date,
+        end_date=end_date,
+        today=today,
+        due_report={
+            "total": due_report.total,
+            "results": due_report.results,
+        }
+        if due_report
+        else None,
+        due_report_url=get_report_url(publisher, start_date, end_date)
+        if due_report
+        else None,
+        current_report={
+            "total": current_report.total,
+            "results": current_report.results,
+        }
+        if current_report
+        else None,
+        current_report_url=get_report_url(publisher, today.replace(day=1), today)
+        if current_report
+        else None,
+        payouts_url=generate_absolute_url(
+            reverse("publisher_payouts", kwargs={"publisher_slug": publisher.slug})
+        ),
+        settings_url=generate_absolute_url(
+            reverse("publisher_settings", kwargs={"publisher_slug": publisher.slug})
+        ),
+        publisher=publisher,
+    )
+
+
+def generate_publisher_payout_data(
+    publisher, include_current_report=True, include_due_report=True
+):
+    """Generate the amount due at next payout and current month payout data."""
+    today = timezone.now()
+    last_payout = publisher.payouts.filter(status=PAID).last()
+    first, start_date, end_date = get_payout_period(publisher, last_payout, today)
+
+    current_report = None
+    due_report = None
+
+    if include_current_report:
+        current_queryset = publisher.adimpression_set.filter(
+            date__gte=today.replace(day=1),
+            date__lte=today,
+            advertisement__flight__campaign__campaign_type=PAID_CAMPAIGN,
+        )
+        current_report = PublisherReport(current_queryset)
+        current_report.generate()
+
+    if include_due_report and has_balance_due(start_date, today):
+        due_queryset = publisher.adimpression_set.filter(
+            date__gte=start_date,
+            date__lte=end_date,
+            advertisement__flight__campaign__campaign_type=PAID_CAMPAIGN,
+        )
+        due_report = PublisherReport(due_queryset)
+        due_report.generate()
+
+    return get_payout_data(
+        publisher, first, start_date, end_date, today, due_report, current_report
+    )
+
+
+def generate_publishers_payout_data(publishers):
+    """
+    Generate the balance due of many publishers at once (eg. for the staff payouts page).
+
+    This is the same data as ``generate_publisher_payout_data`` without the current month
+    but the last payouts and the balances due of all the publishers
+    are each fetched with a single query rather than several queries per publisher.
+    The data of each publisher is cached for the month (``PAYOUT_CACHE_TIMEOUT``)
+    so payouts can be finished without it changing.
+
+    :returns: a dict of publisher -> payout data
+    """
+    publishers = list(publishers)
+    today = timezone.now()
+
+    cache_keys = {
+        publisher: PAYOUT_CACHE_KEY.format(
+            year=today.year, month=today.month, publisher_id=publisher.pk
+        )
+        for publisher in publishers
+    }
+    cached = cache.get_many(cache_keys.values())
+    uncached = [
+        publisher for publisher in publishers if cache_keys[publisher] not in cached
+    ]
+
+    last_payouts = {}
+    for payout in PublisherPayout.objects.filter(
+        publisher__in=uncached, status=PAID
+    ).order_by("date"):
+        last_payouts[payout.publisher_id] = payout
+
+    periods = {}
+    publishers_by_start = defaultdict(list)
+    for publisher in uncached:
+        first, start_date, end_date = get_payout_period(
+            publisher, last_payouts.get(publisher.pk), today
+        )
+        periods[publisher] = (first, start_date, end_date)
+        if has_balance_due(start_date, today):
+            publishers_by_start[start_date].append(publisher)
+
+    due_reports = {}
+    if publishers_by_start:
+        # Publishers are grouped by the start of their balance due
+        # which keeps the filter small since most were last paid in the same month
+        period_filter = models.Q()
+        for start_date, start_publishers in publishers_by_start.items():
+            period_filter |= models.Q(
+                date__gte=start_date, publisher__in=start_publishers
+            )
+
+        end_date = today.replace(day=1) - timedelta(days=1)
+        due_queryset = AdImpression.objects.filter(
+            period_filter,
+            date__lte=end_date,
+            advertisement__flight__campaign__campaign_type=PAID_CAMPAIGN,
+        )
+        due_reports = PublisherReport.generate_by(due_queryset, "publisher")
+
+    data = {}
+    for publisher in uncached:
+        first, start_date, end_date = periods[publisher]
+        due_report = None
+        if has_balance_due(start_date, today):
+            due_report = due_reports.get(publisher)
+            if due_report is None:
+                # No impressions in the period
+                due_report = PublisherReport(AdImpression.objects.none())
+                due_report.generate()
+
+        data[publisher] = get_payout_data(
+            publisher, first, start_date, end_date, today, due_report, None
+        )
+
+    cache.set_many(
+        {cache_keys[publisher]: data[publisher] for publisher in uncached},
+        PAYOUT_CACHE_TIMEOUT,
+    )
+
+    return {
+        publisher: data[publisher]
+        if publisher in data
+        else cached[cache_keys[publisher]]
+        for publisher in publishers
+    }
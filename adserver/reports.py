@@ -1,24 +1,58 @@
 """Advertising performance reports displayed to advertisers, publishers, and staff."""
 import collections
 import datetime
+import hashlib
 import logging
-import operator
+import uuid
+
+from django.conf import settings
+from django.core.cache import cache
+from django.core.exceptions import EmptyResultSet
+from django.core.exceptions import FieldDoesNotExist
+from django.db import models
+from django.db.models.functions import Cast
+from django.db.models.functions import Coalesce
 
 from .constants import PAID_CAMPAIGN
 from .models import AdImpression
 from .models import GeoImpression
 from .models import KeywordImpression
 from .models import PlacementImpression
+from .models import Publisher
+from .models import PublisherMonthlyImpression
 from .models import RegionImpression
 from .models import RegionTopicImpression
 from .models import UpliftImpression
 from .utils import calculate_ctr
 from .utils import calculate_ecpm
+from .utils import get_ad_day
 from .utils import get_country_name
 
 
 log = logging.getLogger(__name__)  # noqa
 
+REPORT_CACHE_VERSION_KEY = "report-cache-version"
+
+
+def invalidate_report_cache():
+    """
+    Invalidate all cached report results (``ADSERVER_REPORT_CACHE_TIMEOUT``).
+
+    This should be called whenever past days of the impression indexes are changed
+    (eg. when a day is aggregated or an offer is refunded).
+    """
+    # A random version can't collide with an old version if the version is evicted
+    cache.set(REPORT_CACHE_VERSION_KEY, uuid.uuid4().hex, timeout=None)
+
+
+def get_report_cache_version():
+    version = cache.get(REPORT_CACHE_VERSION_KEY)
+    if version is None:
+        version = uuid.uuid4().hex
+        if not cache.add(REPORT_CACHE_VERSION_KEY, version, timeout=None):
+            version = cache.get(REPORT_CACHE_VERSION_KEY, version)
+    return version
+
 
 class BaseReport:
 
@@ -37,8 +71,9 @@ class BaseReport:
 
     DEFAULT_MAX_RESULTS = 65535
 
-    # Fields to apply select_related on the queryset
-    select_related_fields = ("advertisement", "advertisement__flight")
+    # Cached results that include today are only cached this long (in seconds)
+    # since the indexes for today are still being updated
+    CACHE_TIMEOUT_TODAY = 5 * 60
 
     def __init__(
         self, queryset, index=None, order=None, max_results=None, export=False, **kwargs
@@ -74,6 +109,9 @@ class BaseReport:
         self.total = {}
         self.results = []
 
+        # The grouped rows if they were already fetched (see ``generate_by``)
+        self.grouped_rows = None
+
         if self.queryset.model is not self.model:
             raise RuntimeError(
                 f"Report queryset (type {self.queryset.model}) is not type {self.model}"
@@ -83,6 +121,131 @@ class BaseReport:
         """Used to add display logic the index field."""
         return index
 
+    def get_group_fields(self):
+        """
+        The fields the impressions are grouped by in the database to get the report index.
+
+        The dotted index is converted to a lookup (eg. ``publisher.name`` -> ``publisher__name``).
+        """
+        return [self.index.replace(".", "__")]
+
+    def get_index(self, row):
+        """Get the report index from a grouped row (see ``get_grouped_rows``)."""
+        return row[self.get_group_fields()[0]]
+
+    def get_aggregates(self):
+        """The sums (name -> aggregate expression) calculated for each index in the database."""
+        raise NotImplementedError("Subclasses implement this method")
+
+    def get_grouped_rows(self):
+        """
+        Sum the impressions by index in the database.
+
+        Indexes which are relations (eg. ``publisher``) are replaced by the related objects
+        so the results are the same as getting the index from each impression.
+        """
+        if self.grouped_rows is not None:
+            return self.grouped_rows
+
+        return self._get_grouped_rows(self.get_group_fields())
+
+    def _get_grouped_rows(self, group_fields):
+        queryset = (
+            # Any ordering would be added to the GROUP BY
+            self.queryset.order_by()
+            .values(*group_fields)
+            .annotate(report_max_date=models.Max("date"), **self.get_aggregates())
+        )
+        rows = self.get_cached_rows(queryset)
+
+        for field_name in group_fields:
+            field = self._get_field(field_name)
+            if field.is_relation:
+                objects = field.related_model.objects.in_bulk(
+                    {row[field_name] for row in rows if row[field_name] is not None}
+                )
+                for row in rows:
+                    row[field_name] = objects.get(row[field_name])
+
+        return rows
+
+    @classmethod
+    def generate_by(cls, queryset, field, **kwargs):
+        """
+        Generate a report for each value of a field (eg. ``publisher``) with one grouped query.
+
+        This is the same as filtering the queryset by each value and generating a report for each
+        but without a query per value.
+
+        :param queryset: A filtered queryset to use with the reports.
+        :param field: The field (or lookup) to split the reports by
+        :param kwargs: Any other arguments for the reports (eg. ``index``)
+        :returns: A dict of the field values (related objects for relations) to generated reports
+        """
+        report = cls(queryset, **kwargs)
+        rows_by_value = collections.defaultdict(list)
+        for row in report._get_grouped_rows([field, *report.get_group_fields()]):
+            rows_by_value[row.pop(field)].append(row)
+
+        reports = {}
+        for value, rows in rows_by_value.items():
+            reports[value] = cls(queryset, **kwargs)
+            reports[value].grouped_rows = rows
+            reports[value].generate()
+        return reports
+
+    def get_cached_rows(self, queryset):
+        """
+        Get the grouped rows from the cache or the database (``ADSERVER_REPORT_CACHE_TIMEOUT``).
+
+        The rows are cached by the SQL of the grouped query
+        which covers the report type, the filters, the date range, the index and the revshare.
+        Results that include today are only cached briefly (``CACHE_TIMEOUT_TODAY``).
+        """
+        timeout = settings.ADSERVER_REPORT_CACHE_TIMEOUT
+        if not timeout:
+            return list(queryset)
+
+        try:
+            sql, params = queryset.query.sql_with_params()
+        except EmptyResultSet:
+            # The filters can never match anything (eg. ``publisher__in=[]``)
+            return []
+
+        fingerprint = hashlib.md5(repr((sql, params)).encode("utf-8")).hexdigest()
+        cache_key = f"report-rows::{get_report_cache_version()}::{fingerprint}"
+        rows = cache.get(cache_key)
+        if rows is None:
+            rows = list(queryset)
+            today = get_ad_day().date()
+            if not rows or any(
+                row["report_max_date"] is None or row["report_max_date"] >= today
+                for row in rows
+            ):
+                timeout = min(timeout, self.CACHE_TIMEOUT_TODAY)
+            cache.set(cache_key, rows, timeout)
+
+        return rows
+
+    def _get_field(self, lookup):
+        """Get the model field for a lookup which may span relations."""
+        model = self.model
+        for field_name in lookup.split("__"):
+            field = model._meta.get_field(field_name)
+            model = field.related_model
+        return field
+
+    @staticmethod
+    def get_revenue_expression():
+        """The revenue (or advertiser cost) of an impression row (or ``NULL`` for null offers)."""
+        return models.ExpressionWrapper(
+            models.F("clicks") * Cast("advertisement__flight__cpc", models.FloatField())
+            + models.F("views")
+            * Cast("advertisement__flight__cpm", models.FloatField())
+            / 1000.0,
+            output_field=models.FloatField(),
+        )
+
     def generate(self):
         raise NotImplementedError("Subclasses implement this method")
 
@@ -95,36 +258,33 @@ class AdvertiserReport(BaseReport):
     index = "date"
     order = "-date"
 
+    def get_aggregates(self):
+        return {
+            "views_sum": models.Sum("views"),
+            "clicks_sum": models.Sum("clicks"),
+            # There's no cost for offers with no views/clicks
+            "cost_sum": Coalesce(
+                models.Sum(self.get_revenue_expression()),
+                0.0,
+                output_field=models.FloatField(),
+            ),
+        }
+
     def generate(self):
         """Generate/calculate the report from the queryset by the index."""
-        queryset = self.queryset.select_related(*self.select_related_fields)
-
-        # This allows us to use `.` in the report_index to span relations
-        getter = operator.attrgetter(self.index)
-
         results = {}
 
-        for impression in queryset:
-            index = getter(impression)
+        for row in self.get_grouped_rows():
+            index = self.get_index(row)
 
             if index not in results:
                 results[index] = collections.defaultdict(int)
 
             results[index]["index"] = self.get_index_display(index)
             results[index][self.index] = self.get_index_display(index)
-            results[index]["views"] += impression.views
-            results[index]["clicks"] += impression.clicks
-
-            # Calculate advertiser cost if the offer resulted in an ad impression
-            # There's no revenue for offers with no views/clicks
-            if impression.advertisement:
-                results[index]["cost"] += (
-                    impression.clicks * float(impression.advertisement.flight.cpc)
-                ) + (
-                    impression.views
-                    * float(impression.advertisement.flight.cpm)
-                    / 1000.0
-                )
+            results[index]["views"] += row["views_sum"]
+            results[index]["clicks"] += row["clicks_sum"]
+            results[index]["cost"] += row["cost_sum"]
 
             # These fields must be calculated from the fields above
             results[index]["ctr"] = calculate_ctr(
@@ -174,7 +334,6 @@ class AdvertiserPublisherReport(AdvertiserReport):
     model = AdImpression
     index = "publisher"
     order = "-views"
-    select_related_fields = ("advertisement", "advertisement__flight", "publisher")
 
 
 class PublisherReport(BaseReport):
@@ -184,67 +343,95 @@ class PublisherReport(BaseReport):
     model = AdImpression
     index = "date"
     order = "-date"
-    select_related_fields = (
-        "publisher",
-        "advertisement",
-        "advertisement__flight",
-        "advertisement__flight__campaign",
-    )
+
+    # The lookup for the campaign type of the impressions
+    campaign_type_field = "advertisement__flight__campaign__campaign_type"
+
+    def get_aggregates(self):
+        aggregates = {
+            "decisions_sum": models.Sum("decisions"),
+            "offers_sum": models.Sum("offers"),
+            "views_sum": models.Sum("views"),
+            "clicks_sum": models.Sum("clicks"),
+            # Count offers for all paid campaigns
+            # This is required to get an accurate fill rate when house ads are on
+            "paid_offers_sum": Coalesce(
+                models.Sum(
+                    "offers",
+                    filter=models.Q(**{self.campaign_type_field: PAID_CAMPAIGN}),
+                ),
+                0,
+            ),
+            # There's no revenue for offers with no views/clicks
+            "revenue_sum": Coalesce(
+                models.Sum(self.get_revenue_expression()),
+                0.0,
+                output_field=models.FloatField(),
+            ),
+        }
+
+        # Support arbitrary revshare numbers on reporting
+        if not self.get_force_revshare():
+            aggregates["revenue_share_sum"] = Coalesce(
+                models.Sum(
+                    self.get_revenue_expression()
+                    * models.F("publisher__revenue_share_percentage")
+                    / 100.0,
+                    output_field=models.FloatField(),
+                ),
+                0.0,
+                output_field=models.FloatField(),
+            )
+
+        return aggregates
+
+    def get_force_revshare(self):
+        """
+        Get the revshare applied to all revenue (or ``None`` for each publisher's revshare).
+
+        Indexes without a publisher (eg. ``RegionTopicImpression``) use the default revshare.
+        """
+        force_revshare = self.kwargs.get("force_revshare")
+        if not force_revshare:
+            try:
+                self.model._meta.get_field("publisher")
+            except FieldDoesNotExist:
+                force_revshare = Publisher._meta.get_field(
+                    "revenue_share_percentage"
+                ).default
+        return force_revshare
 
     def generate(self):
         """Generate/calculate the report from the queryset by the index."""
-        # Allow more custom getter functions for multi-dimensional indexes
-        if not hasattr(self, "getter"):
-            # This allows us to use `.` in the report_index to span relations
-            self.getter = operator.attrgetter(self.index)
-
-        queryset = self.queryset.select_related(*self.select_related_fields)
+        force_revshare = self.get_force_revshare()
 
         results = {}
 
-        for impression in queryset:
-            index = self.getter(impression)
+        for row in self.get_grouped_rows():
+            index = self.get_index(row)
 
             if index not in results:
                 results[index] = collections.defaultdict(int)
 
-            # Count offers for all paid campaigns
-            # This is required to get an accurate fill rate when house ads are on
-            if (
-                getattr(impression, "advertisement", None)
-                and impression.advertisement.flight.campaign.campaign_type
-                == PAID_CAMPAIGN
-            ):
-                results[index]["paid_offers"] += impression.offers
+            if row["paid_offers_sum"]:
+                results[index]["paid_offers"] += row["paid_offers_sum"]
 
             results[index]["index"] = self.get_index_display(index)
             results[index][self.index] = index
-            results[index]["decisions"] += impression.decisions
-            results[index]["offers"] += impression.offers
-            results[index]["views"] += impression.views
-            results[index]["clicks"] += impression.clicks
-
-            # Calculate our revenue if the offer resulted in an ad impression
-            # There's no revenue for offers with no views/clicks
-            if getattr(impression, "advertisement", None):
-                results[index]["revenue"] += (
-                    impression.clicks * float(impression.advertisement.flight.cpc)
-                ) + (
-                    impression.views
-                    * float(impression.advertisement.flight.cpm)
-                    / 1000.0
-                )
-                # Support arbitrary revshare numbers on reporting
-                applied_rev_share = float(
-                    self.kwargs.get("force_revshare")
-                    or impression.publisher.revenue_share_percentage
-                )
-                results[index]["revenue_share"] = results[index]["revenue"] * (
-                    applied_rev_share / 100.0
-                )
-                results[index]["our_revenue"] = (
-                    results[index]["revenue"] - results[index]["revenue_share"]
-                )
+            results[index]["decisions"] += row["decisions_sum"]
+            results[index]["offers"] += row["offers_sum"]
+            results[index]["views"] += row["views_sum"]
+            results[index]["clicks"] += row["clicks_sum"]
+
+            results[index]["revenue"] += row["revenue_sum"]
+            if force_revshare:
+                revenue_share = row["revenue_sum"] * (float(force_revshare) / 100.0)
+            else:
+                revenue_share = row["revenue_share_sum"]
+            results[index]["revenue_share"] += revenue_share
+            results[index]["our_revenue"] = (
+                results[index]["revenue"] - results[index]["revenue_share"]
+            )
 
             # These fields must be calculated from the fields above
             results[index]["ctr"] = calculate_ctr(
@@ -302,6 +489,30 @@ class PublisherReport(BaseReport):
         return super().get_index_display(index)
 
 
+class PublisherMonthlyReport(PublisherReport):
+
+    """
+    Report for showing monthly ad performance for a publisher.
+
+    This reads the monthly rollups (``PublisherMonthlyImpression``) rather than daily impressions
+    so it only covers whole months which have been aggregated (up to yesterday).
+    """
+
+    model = PublisherMonthlyImpression
+    campaign_type_field = "campaign_type"
+
+    @staticmethod
+    def get_revenue_expression():
+        """The revenue is rolled up with the impressions."""
+        return models.F("revenue")
+
+    def get_index_display(self, index):
+        if isinstance(index, datetime.date):
+            return index.strftime("%B %Y")
+
+        return super().get_index_display(index)
+
+
 class PublisherGeoReport(PublisherReport):
 
     """Report to breakdown publisher performance by country."""
@@ -324,11 +535,6 @@ class PublisherRegionReport(PublisherReport):
     model = RegionImpression
     index = "region"
     order = "-views"
-    select_related_fields = (
-        "advertisement",
-        "advertisement__flight",
-        "advertisement__flight__campaign",
-    )
 
 
 class PublisherPlacementReport(PublisherReport):
@@ -347,13 +553,6 @@ class PublisherAdvertiserReport(PublisherReport):
     model = AdImpression
     index = "advertisement.flight.campaign.advertiser"
     order = "-views"
-    select_related_fields = (
-        "publisher",
-        "advertisement",
-        "advertisement__flight",
-        "advertisement__flight__campaign",
-        "advertisement__flight__campaign__advertiser",
-    )
 
 
 class PublisherKeywordReport(PublisherReport):
@@ -381,16 +580,15 @@ class PublisherRegionTopicReport(PublisherReport):
     model = RegionTopicImpression
     index = "topic"
     order = "-views"
-    select_related_fields = (
-        "advertisement",
-        "advertisement__flight",
-        "advertisement__flight__campaign",
-        "advertisement__flight__campaign__advertiser",
-    )
-
-    def getter(self, data):  # pylint: disable=method-hidden
+
+    def get_group_fields(self):
         """Show both region & topic in the index."""
         if self.index != "date":
-            return f"{data.region}:{data.topic}"
+            return ["region", "topic"]
         # Fallback if not used
-        return operator.attrgetter(self.index)(data)
+        return super().get_group_fields()
+
+    def get_index(self, row):
+        if self.index != "date":
+            return f"{row['region']}:{row['topic']}"
+        return super().get_index(row)
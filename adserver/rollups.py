@@ -0,0 +1,87 @@
+"""
+Columnar daily rollups of the report indexes for historical reporting.
+
+When old offers are archived (``./manage.py archive_offers``),
+each report index (eg. ``GeoImpression``) for the day is also written to a file
+in ``settings.BACKUPS_STORAGE`` with one list of values per column.
+These keep the report data for the day alongside the archived offers.
+"""
+import gzip
+import json
+import logging
+
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.core.files.storage import get_storage_class
+
+from .aggregation import AGGREGATORS_BY_NAME
+
+
+log = logging.getLogger(__name__)  # noqa
+
+
+class RollupStore:
+
+    """
+    Reads and writes the daily rollup files of the report indexes.
+
+    Files are named ``rollups/<index>/<YYYY-MM-DD>.json.gz`` (eg. ``rollups/geos/2022-01-31.json.gz``)
+    and contain ``{"columns": {"publisher_id": [...], "views": [...], ...}}``.
+    """
+
+    storage_output_dir = "rollups/"
+
+    def __init__(self, storage=None):
+        if storage is None:
+            storage = get_storage_class(settings.BACKUPS_STORAGE)()
+        self.storage = storage
+
+    @staticmethod
+    def get_columns(index):
+        aggregator = AGGREGATORS_BY_NAME[index]
+        return aggregator.unique_fields + aggregator.update_fields
+
+    def get_path(self, index, day):
+        return f"{self.storage_output_dir}{index}/{day:%Y-%m-%d}.json.gz"
+
+    def write_day(self, day, indexes=None):
+        """
+        Write the rollups of the report indexes (or some of them) for a day.
+
+        :param day: a date
+        :param indexes: the names of the indexes (eg. ``geos``) or all indexes
+        :returns: the paths written
+        """
+        paths = []
+        for index in indexes or AGGREGATORS_BY_NAME:
+            model = AGGREGATORS_BY_NAME[index].model
+            columns = self.get_columns(index)
+
+            rows = model.objects.using(settings.REPLICA_SLUG).filter(date=day)
+            data = {
+                column: list(values)
+                for column, values in zip(
+                    columns, zip(*rows.values_list(*columns).iterator())
+                )
+            }
+            # There were no impressions that day
+            if not data:
+                data = {column: [] for column in columns}
+
+            path = self.get_path(index, day)
+            if self.storage.exists(path):
+                self.storage.delete(path)
+            self.storage.save(
+                path,
+                ContentFile(
+                    gzip.compress(json.dumps({"columns": data}).encode("utf-8"))
+                ),
+            )
+            paths.append(path)
+
+        return paths
+
+    def read_day(self, index, day):
+        """Get the columns (column -> list of values) of an index for a day."""
+        with self.storage.open(self.get_path(index, day), "rb") as fd:
+            return json.loads(gzip.decompress(fd.read()))["columns"]
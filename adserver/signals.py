@@ -0,0 +1,108 @@
+"""Signal handlers for the ad server."""
+import logging
+
+from django.db import transaction
+from django.db.models.signals import m2m_changed
+from django.db.models.signals import post_delete
+from django.db.models.signals import post_save
+from django.dispatch import receiver
+
+from .decisionengine.index import FlightIndex
+from .models import Advertisement
+from .models import Campaign
+from .models import CountryRegion
+from .models import Flight
+from .models import Keyword
+from .models import PublisherGroup
+from .models import Region
+from .models import Topic
+
+
+log = logging.getLogger(__name__)  # noqa
+
+
+def invalidate_flight_index():
+    """Invalidate the flight index in every process (see ``FlightIndex``)."""
+    # Invalidate immediately for this process and again after the transaction commits
+    # so other processes don't rebuild the index from uncommitted data
+    FlightIndex.invalidate()
+    transaction.on_commit(FlightIndex.invalidate)
+
+
+@receiver(post_save, sender=Flight, dispatch_uid="flight_index_flight")
+@receiver(post_save, sender=Advertisement, dispatch_uid="flight_index_advertisement")
+@receiver(post_save, sender=Campaign, dispatch_uid="flight_index_campaign")
+@receiver(post_delete, sender=Flight, dispatch_uid="flight_index_flight_delete")
+@receiver(
+    post_delete, sender=Advertisement, dispatch_uid="flight_index_advertisement_delete"
+)
+@receiver(post_delete, sender=Campaign, dispatch_uid="flight_index_campaign_delete")
+def handle_flight_index_save(sender, **kwargs):
+    """Rebuild the flight index when anything in it changes."""
+    log.debug("Invalidating the flight index. sender=%s", sender.__name__)
+    invalidate_flight_index()
+
+
+@receiver(
+    m2m_changed,
+    sender=Advertisement.ad_types.through,
+    dispatch_uid="flight_index_ad_types",
+)
+@receiver(
+    m2m_changed,
+    sender=Campaign.publishers.through,
+    dispatch_uid="flight_index_campaign_publishers",
+)
+@receiver(
+    m2m_changed,
+    sender=Campaign.publisher_groups.through,
+    dispatch_uid="flight_index_campaign_publisher_groups",
+)
+@receiver(
+    m2m_changed,
+    sender=Campaign.exclude_publishers.through,
+    dispatch_uid="flight_index_campaign_exclude_publishers",
+)
+@receiver(
+    m2m_changed,
+    sender=PublisherGroup.publishers.through,
+    dispatch_uid="flight_index_publisher_group_publishers",
+)
+def handle_flight_index_m2m_changed(sender, action, **kwargs):
+    """Rebuild the flight index when ad types or campaign publishers change."""
+    if action in ("post_add", "post_remove", "post_clear"):
+        log.debug("Invalidating the flight index. sender=%s", sender.__name__)
+        invalidate_flight_index()
+
+
+@receiver(post_save, sender=Region, dispatch_uid="flight_index_region")
+@receiver(post_save, sender=CountryRegion, dispatch_uid="flight_index_country_region")
+@receiver(post_save, sender=Topic, dispatch_uid="flight_index_topic")
+@receiver(post_delete, sender=Region, dispatch_uid="flight_index_region_delete")
+@receiver(
+    post_delete,
+    sender=CountryRegion,
+    dispatch_uid="flight_index_country_region_delete",
+)
+@receiver(post_delete, sender=Topic, dispatch_uid="flight_index_topic_delete")
+def handle_flight_index_targeting_save(sender, **kwargs):
+    """
+    Rebuild the flight index when a region's countries or a topic's keywords change.
+
+    The flights' targeting is compiled with the expanded regions and topics
+    when the index is built so it would otherwise keep targeting the old ones.
+    """
+    log.debug("Invalidating the flight index. sender=%s", sender.__name__)
+    invalidate_flight_index()
+
+
+@receiver(
+    m2m_changed,
+    sender=Keyword.topics.through,
+    dispatch_uid="flight_index_keyword_topics",
+)
+def handle_flight_index_keywords_changed(sender, action, **kwargs):
+    """Rebuild the flight index when a topic's keywords change."""
+    if action in ("post_add", "post_remove", "post_clear"):
+        log.debug("Invalidating the flight index. sender=%s", sender.__name__)
+        invalidate_flight_index()
@@ -4,7 +4,6 @@ import logging
 
 from django.conf import settings
 from django.contrib import messages
-from django.core.cache import cache
 from django.http import Http404
 from django.shortcuts import get_object_or_404
 from django.shortcuts import redirect
@@ -20,10 +19,12 @@ from ..constants import PAID
 from ..mixins import StaffUserMixin
 from ..models import Advertiser
 from ..models import Publisher
+from ..models import PublisherPayout
+from ..payouts import generate_publisher_payout_data
+from ..payouts import generate_publishers_payout_data
 from .forms import CreateAdvertiserForm
 from .forms import CreatePublisherForm
 from .forms import StartPublisherPayoutForm
-from adserver.utils import generate_publisher_payout_data
 
 
 log = logging.getLogger(__name__)  # noqa
@@ -87,8 +88,6 @@ class PublisherPayoutView(StaffUserMixin, TemplateView):
     """
 
     template_name = "adserver/staff/publisher-payout-list.html"
-    # Cache for 24 hours so we can finish payouts
-    CACHE_SECONDS = 3600 * 24
 
     def get_context_data(self, **kwargs):
         context = super().get_context_data(**kwargs)
@@ -104,23 +103,22 @@ class PublisherPayoutView(StaffUserMixin, TemplateView):
         payouts = {}
 
         today = timezone.now()
+        last_month = today.replace(day=1) - datetime.timedelta(days=1)
 
-        for publisher in queryset:
-
-            current_payout = publisher.payouts.filter(
-                date__month=today.month,
-                date__year=today.year,
-            ).first()
-
-            # Cache payout data to make running payouts faster
-            cache_key = f"payout-due-{today.year}-{today.month}-{publisher.pk}"
-            data = cache.get(cache_key)
-            if not data:
-                data = generate_publisher_payout_data(
-                    publisher, include_current_report=False
-                )
-                cache.set(cache_key, data, self.CACHE_SECONDS)
+        # The balances and payouts of all the publishers are fetched at once
+        payout_data = generate_publishers_payout_data(queryset)
+        current_payouts = self.get_payouts_by_publisher(
+            queryset, date__month=today.month, date__year=today.year
+        )
+        last_payouts = self.get_payouts_by_publisher(
+            queryset,
+            status=PAID,
+            date__month=last_month.month,
+            date__year=last_month.year,
+        )
 
+        for publisher, data in payout_data.items():
+            current_payout = current_payouts.get(publisher.pk)
             report = data.get("due_report")
 
             if not report and not current_payout:
@@ -161,14 +159,7 @@ class PublisherPayoutView(StaffUserMixin, TemplateView):
             if current_payout:
                 payout_context["payout"] = current_payout
 
-            last_payout = publisher.payouts.filter(
-                status=PAID,
-                # Janky way to find last month..
-                date__month=(
-                    timezone.now().replace(day=1) - datetime.timedelta(days=1)
-                ).month,
-                date__year=timezone.now().year,
-            ).first()
+            last_payout = last_payouts.get(publisher.pk)
             if last_payout:
                 change_percent = (
                     (float(due_balance) - float(last_payout.amount))
@@ -186,6 +177,15 @@ class PublisherPayoutView(StaffUserMixin, TemplateView):
         context["boolean_options"] = [["", "---"], ["True", "True"], ["False", "False"]]
         return context
 
+    def get_payouts_by_publisher(self, publishers, **filters):
+        """Get the first payout (by date) matching some filters of each publisher."""
+        payouts = {}
+        for payout in PublisherPayout.objects.filter(
+            publisher__in=publishers, **filters
+        ).order_by("-date"):
+            payouts[payout.publisher_id] = payout
+        return payouts
+
 
 class PublisherStartPayoutView(StaffUserMixin, FormView):
 
@@ -1,41 +1,53 @@
 """Celery tasks for the ad server."""
 import datetime
 import logging
+import time
 from collections import defaultdict
 
 from django.conf import settings
 from django.contrib.sites.shortcuts import get_current_site
 from django.core import mail
-from django.db.models import Count
+from django.core.cache import cache
 from django.db.models import F
-from django.db.models import Q
 from django.db.models import Sum
 from django.template.loader import render_to_string
 from django.utils.translation import gettext_lazy as _
 from django_slack import slack_message
-
+from simple_history.utils import bulk_update_with_history
+
+from .aggregation import aggregate_new_offers
+from .aggregation import aggregate_offers
+from .aggregation import AGGREGATORS_BY_NAME
+from .aggregation import DAILY_AGGREGATORS
+from .aggregation import GeoAggregator
+from .aggregation import ImpressionAggregator
+from .aggregation import KeywordAggregator
+from .aggregation import PlacementAggregator
+from .aggregation import RegionAggregator
+from .aggregation import RegionTopicAggregator
+from .aggregation import update_rollups
+from .aggregation import UpliftAggregator
 from .constants import FLIGHT_STATE_CURRENT
 from .constants import FLIGHT_STATE_UPCOMING
 from .constants import PAID_CAMPAIGN
 from .importers import psf
 from .models import AdImpression
+from .models import Advertisement
 from .models import Advertiser
 from .models import Flight
-from .models import GeoImpression
-from .models import KeywordImpression
 from .models import Offer
-from .models import PlacementImpression
 from .models import Publisher
-from .models import Region
-from .models import RegionImpression
-from .models import RegionTopicImpression
-from .models import Topic
-from .models import UpliftImpression
+from .partitions import create_partitions
+from .partitions import get_offer_table
+from .partitions import is_partitioned
+from .reports import invalidate_report_cache
 from .reports import PublisherReport
+from .utils import calculate_ctr
 from .utils import calculate_percent_diff
 from .utils import generate_absolute_url
 from .utils import get_ad_day
 from .utils import get_day
+from .utils import parse_date_string
 from config.celery_app import app
 
 log = logging.getLogger(__name__)  # noqa
@@ -48,99 +60,19 @@ def daily_update_geos(day=None, geo=True, region=True):
 
     :arg day: An optional datetime object representing a day
     """
-    start_date, end_date = get_day(day)
-
     if not geo and not region:
         log.error("geo or region required, please pass one as True")
         return
 
+    aggregators = []
     # TODO: Delete the GeoImpression, once we're happy with RegionImpression's
     if geo:
-        log.info("Updating GeoImpressions for %s-%s", start_date, end_date)
-
+        aggregators.append(GeoAggregator)
     if region:
-        log.info("Updating RegionImpressions for %s-%s", start_date, end_date)
-        # Delete all previous Region impressions
-        RegionImpression.objects.using("default").filter(
-            date__gte=start_date,
-            date__lt=end_date,  # Things at UTC midnight should count towards tomorrow
-        ).delete()
-
-    topic_mapping = defaultdict(
-        lambda: {
-            "decisions": 0,
-            "offers": 0,
-            "views": 0,
-            "clicks": 0,
-        }
-    )
-    queryset = Offer.objects.using(settings.REPLICA_SLUG).filter(
-        date__gte=start_date,
-        date__lt=end_date,  # Things at UTC midnight should count towards tomorrow
-    )
-    for values in (
-        queryset.values("advertisement", "country", "publisher")
-        .annotate(
-            total_decisions=Count("country"),
-            total_offers=Count("country", filter=Q(advertisement__isnull=False)),
-            total_views=Count("country", filter=Q(viewed=True)),
-            total_clicks=Count("country", filter=Q(clicked=True)),
-        )
-        .filter(total_decisions__gt=0)
-        .order_by("-total_decisions")
-        .iterator()
-    ):
-        country = values["country"]
-        if geo:
-            impression, _ = GeoImpression.objects.using("default").get_or_create(
-                publisher_id=values["publisher"],
-                advertisement_id=values["advertisement"],
-                country=country,
-                date=start_date,
-            )
-            GeoImpression.objects.using("default").filter(pk=impression.pk).update(
-                decisions=values["total_decisions"],
-                offers=values["total_offers"],
-                views=values["total_views"],
-                clicks=values["total_clicks"],
-            )
-
-        if region:
-            _region = Region.get_region_from_country_code(country)
-
-            publisher = values["publisher"]
-            advertisement = values["advertisement"]
-            topic_mapping[f"{advertisement}:{publisher}:{_region}"][
-                "decisions"
-            ] += values["total_decisions"]
-            topic_mapping[f"{advertisement}:{publisher}:{_region}"]["offers"] += values[
-                "total_offers"
-            ]
-            topic_mapping[f"{advertisement}:{publisher}:{_region}"]["views"] += values[
-                "total_views"
-            ]
-            topic_mapping[f"{advertisement}:{publisher}:{_region}"]["clicks"] += values[
-                "total_clicks"
-            ]
+        aggregators.append(RegionAggregator)
 
-    if region:
-        for data, value in topic_mapping.items():
-            ad, publisher, _region = data.split(":")
-            # Handle the conversion of None
-            if ad == "None":
-                ad = None
-            impression, _ = RegionImpression.objects.using("default").get_or_create(
-                publisher_id=publisher,
-                advertisement_id=ad,
-                region=_region,
-                date=start_date,
-            )
-            RegionImpression.objects.using("default").filter(pk=impression.pk).update(
-                decisions=F("decisions") + value["decisions"],
-                offers=F("offers") + value["offers"],
-                views=F("views") + value["views"],
-                clicks=F("clicks") + value["clicks"],
-            )
+    aggregate_offers(day, aggregators)
+    invalidate_report_cache()
 
 
 @app.task()
@@ -150,88 +82,22 @@ def daily_update_placements(day=None):
 
     :arg day: An optional datetime object representing a day
     """
-    start_date, end_date = get_day(day)
-
-    log.info("Updating PlacementImpressions for %s-%s", start_date, end_date)
-
-    queryset = Offer.objects.using(settings.REPLICA_SLUG).filter(
-        date__gte=start_date,
-        date__lt=end_date,  # Things at UTC midnight should count towards tomorrow
-    )
-
-    for values in (
-        queryset.values("publisher", "advertisement", "div_id", "ad_type_slug")
-        .annotate(
-            total_decisions=Count("div_id"),
-            total_offers=Count("div_id", filter=Q(advertisement__isnull=False)),
-            total_views=Count("div_id", filter=Q(viewed=True)),
-            total_clicks=Count("div_id", filter=Q(clicked=True)),
-        )
-        .filter(total_decisions__gt=0)
-        .filter(publisher__record_placements=True)
-        .exclude(div_id__regex=r"(rtd-\w{4}|ad_\w{4}).*")
-        .order_by("-total_decisions")
-        .iterator()
-    ):
-
-        impression, _ = PlacementImpression.objects.using("default").get_or_create(
-            publisher_id=values["publisher"],
-            advertisement_id=values["advertisement"],
-            div_id=values["div_id"],
-            ad_type_slug=values["ad_type_slug"],
-            date=start_date,
-        )
-        PlacementImpression.objects.using("default").filter(pk=impression.pk).update(
-            decisions=values["total_decisions"],
-            offers=values["total_offers"],
-            views=values["total_views"],
-            clicks=values["total_clicks"],
-        )
+    aggregate_offers(day, [PlacementAggregator])
+    invalidate_report_cache()
 
 
 @app.task()
 def daily_update_impressions(day=None):
     """
-    Update the AdImpression index each day.
+    Update the AdImpression index (and its rollups) each day.
 
     :arg day: An optional datetime object representing a day
     """
-    start_date, end_date = get_day(day)
-
-    log.info("Updating AdImpressions for %s-%s", start_date, end_date)
-
-    queryset = Offer.objects.using(settings.REPLICA_SLUG).filter(
-        date__gte=start_date,
-        date__lt=end_date,  # Things at UTC midnight should count towards tomorrow
-    )
-
-    for values in (
-        queryset.values("publisher", "advertisement")
-        # This needs to be publisher and not advertisement to gets decisions properly
-        .annotate(
-            total_decisions=Count("publisher"),
-            total_offers=Count("publisher", filter=Q(advertisement__isnull=False)),
-            total_views=Count("publisher", filter=Q(viewed=True)),
-            total_clicks=Count("publisher", filter=Q(clicked=True)),
-            view_time=Sum("view_time"),
-        )
-        .filter(total_decisions__gt=0)
-        .order_by("-total_decisions")
-        .iterator()
-    ):
+    aggregate_offers(day, [ImpressionAggregator])
+    update_rollups(day)
 
-        impression, _ = AdImpression.objects.using("default").get_or_create(
-            publisher_id=values["publisher"],
-            advertisement_id=values["advertisement"],
-            date=start_date,
-        )
-        AdImpression.objects.using("default").filter(pk=impression.pk).update(
-            decisions=values["total_decisions"],
-            offers=values["total_offers"],
-            views=values["total_views"],
-            clicks=values["total_clicks"],
-            view_time=values["view_time"],
-        )
+    # Past days of the index and the rollups changed so cached reports are stale
+    invalidate_report_cache()
 
 
 @app.task()
@@ -241,101 +107,8 @@ def daily_update_keywords(day=None):
 
     :arg day: An optional datetime object representing a day
     """
-    start_date, end_date = get_day(day)
-
-    log.info("Updating KeywordImpression for %s-%s", start_date, end_date)
-
-    # Remove all old keyword impressions, because they are cumulative
-    KeywordImpression.objects.using("default").filter(
-        date__gte=start_date,
-        date__lt=end_date,  # Things at UTC midnight should count towards tomorrow
-    ).delete()
-
-    keyword_mapping = defaultdict(
-        lambda: {
-            "decisions": 0,
-            "offers": 0,
-            "views": 0,
-            "clicks": 0,
-        }
-    )
-
-    queryset = Offer.objects.using(settings.REPLICA_SLUG).filter(
-        date__gte=start_date,
-        date__lt=end_date,  # Things at UTC midnight should count towards tomorrow
-    )
-
-    all_topics = Topic.load_from_cache()
-
-    for values in (
-        queryset.values("publisher", "advertisement", "keywords", "viewed", "clicked")
-        .annotate(
-            total_decisions=Count("keywords"),
-            total_offers=Count("keywords", filter=Q(advertisement__isnull=False)),
-            total_views=Count("keywords", filter=Q(viewed=True)),
-            total_clicks=Count("keywords", filter=Q(clicked=True)),
-        )
-        .order_by("-total_decisions")
-        .values(
-            "publisher",
-            "advertisement",
-            "keywords",
-            "advertisement__flight__targeting_parameters",
-            "total_decisions",
-            "total_offers",
-            "total_views",
-            "total_clicks",
-        )
-        .iterator()
-    ):
-        if not (
-            values["keywords"] and values["advertisement__flight__targeting_parameters"]
-        ):
-            continue
-
-        page_keywords = set(values["keywords"])
-        flight_targeting = values["advertisement__flight__targeting_parameters"]
-
-        flight_keywords = set(flight_targeting.get("include_keywords", {}))
-        flight_topics = set(flight_targeting.get("include_topics", {}))
-
-        # If this flight targeted topics, add those as well
-        for topic in flight_topics:
-            if topic in all_topics:
-                for kw in all_topics[topic]:
-                    flight_keywords.add(kw)
-
-        # Only store keywords where the advertiser targeting
-        # matched the keywords on the offer
-        matched_keywords = page_keywords & flight_keywords
-
-        for keyword in matched_keywords:
-            advertisement_id = values["advertisement"]
-            publisher_id = values["publisher"]
-            index = f"{advertisement_id}:{publisher_id}:{keyword}"
-
-            keyword_mapping[index]["decisions"] += values["total_decisions"]
-            keyword_mapping[index]["offers"] += values["total_offers"]
-            keyword_mapping[index]["views"] += values["total_views"]
-            keyword_mapping[index]["clicks"] += values["total_clicks"]
-
-    for data, value in keyword_mapping.items():
-        ad, publisher, keyword = data.split(":")
-        if ad == "None":
-            ad = None
-
-        impression, _ = KeywordImpression.objects.using("default").get_or_create(
-            date=start_date,
-            publisher_id=publisher,
-            advertisement_id=ad,
-            keyword=keyword,
-        )
-        KeywordImpression.objects.using("default").filter(pk=impression.pk).update(
-            decisions=F("decisions") + value["decisions"],
-            offers=F("offers") + value["offers"],
-            views=F("views") + value["views"],
-            clicks=F("clicks") + value["clicks"],
-        )
+    aggregate_offers(day, [KeywordAggregator])
+    invalidate_report_cache()
 
 
 @app.task()
@@ -347,98 +120,8 @@ def daily_update_regiontopic(day=None):
 
     :arg day: An optional datetime object representing a day
     """
-    start_date, end_date = get_day(day)
-
-    log.info("Updating RegionTopic's for %s-%s", start_date, end_date)
-
-    # Remove all old impressions, because they are cumulative
-    RegionTopicImpression.objects.using("default").filter(
-        date__gte=start_date, date__lt=end_date
-    ).delete()
-
-    all_topics = Topic.load_from_cache()
-
-    topic_mapping = defaultdict(
-        lambda: {
-            "decisions": 0,
-            "offers": 0,
-            "views": 0,
-            "clicks": 0,
-        }
-    )
-    queryset = Offer.objects.using(settings.REPLICA_SLUG).filter(
-        date__gte=start_date,
-        date__lt=end_date,  # Things at UTC midnight should count towards tomorrow
-    )
-    for values in (
-        queryset.values("advertisement", "keywords", "country")
-        .annotate(
-            total_decisions=Count("country"),
-            total_offers=Count("country", filter=Q(advertisement__isnull=False)),
-            total_views=Count("country", filter=Q(viewed=True)),
-            total_clicks=Count("country", filter=Q(clicked=True)),
-        )
-        .filter(total_decisions__gt=0)
-        .order_by("-total_decisions")
-        .values(
-            "keywords",
-            "advertisement",
-            "country",
-            "total_decisions",
-            "total_offers",
-            "total_views",
-            "total_clicks",
-        )
-        .iterator()
-    ):
-        if not (values["keywords"] and values["country"]):
-            continue
-
-        keywords = values["keywords"]
-        country = values["country"]
-        ad = values["advertisement"]
-        publisher_keywords = set(keywords)
-
-        topics = set()
-        for keyword in publisher_keywords:
-            for topic in all_topics:
-                if keyword in all_topics[topic]:
-                    topics.add(topic)
-
-        # If nothing gets set as a topic, assign it other
-        if not topics:
-            topics.add("other")
-
-        region = Region.get_region_from_country_code(country)
-
-        # Aggregate data into topic_mapping to save doing queries until we have everything counted
-        # This is important because we can't query on keywords, so we have a lot of records that increment
-        # the total count on the region & topic.
-        for topic in topics:
-            topic_mapping[f"{ad}:{region}:{topic}"]["decisions"] += values[
-                "total_decisions"
-            ]
-            topic_mapping[f"{ad}:{region}:{topic}"]["offers"] += values["total_offers"]
-            topic_mapping[f"{ad}:{region}:{topic}"]["views"] += values["total_views"]
-            topic_mapping[f"{ad}:{region}:{topic}"]["clicks"] += values["total_clicks"]
-
-    for data, value in topic_mapping.items():
-        ad, region, topic = data.split(":")
-        # Handle the conversion of
-        if ad == "None":
-            ad = None
-        impression, _ = RegionTopicImpression.objects.using("default").get_or_create(
-            date=start_date, advertisement_id=ad, region=region, topic=topic
-        )
-        # these are a sum because we can't query for specific keywords from postgres,
-        # so a specific publisher and advertisement set could return the same keyword:
-        # ['python', 'django'] and ['python, 'flask'] both are `python` in this case.
-        RegionTopicImpression.objects.using("default").filter(pk=impression.pk).update(
-            decisions=F("decisions") + value["decisions"],
-            offers=F("offers") + value["offers"],
-            views=F("views") + value["views"],
-            clicks=F("clicks") + value["clicks"],
-        )
+    aggregate_offers(day, [RegionTopicAggregator])
+    invalidate_report_cache()
 
 
 @app.task()
@@ -448,46 +131,8 @@ def daily_update_uplift(day=None):
 
     :arg day: An optional datetime object representing a day
     """
-    start_date, end_date = get_day(day)
-
-    log.info("Updating uplift for %s-%s", start_date, end_date)
-
-    queryset = Offer.objects.using(settings.REPLICA_SLUG).filter(
-        date__gte=start_date,
-        date__lt=end_date,  # Things at UTC midnight should count towards tomorrow
-    )
-
-    for values in (
-        queryset.values("publisher", "advertisement")
-        .annotate(
-            total_decisions=Count("uplifted"),
-            total_offers=Count("uplifted", filter=Q(advertisement__isnull=False)),
-            total_views=Count("uplifted", filter=Q(viewed=True)),
-            total_clicks=Count("uplifted", filter=Q(clicked=True)),
-        )
-        .filter(total_decisions__gt=0)
-        .order_by("-total_decisions")
-        .values(
-            "publisher",
-            "advertisement",
-            "total_decisions",
-            "total_offers",
-            "total_views",
-            "total_clicks",
-        )
-        .iterator()
-    ):
-        impression, _ = UpliftImpression.objects.using("default").get_or_create(
-            publisher_id=values["publisher"],
-            advertisement_id=values["advertisement"],
-            date=start_date,
-        )
-        UpliftImpression.objects.using("default").filter(pk=impression.pk).update(
-            decisions=values["total_decisions"],
-            offers=values["total_offers"],
-            views=values["total_views"],
-            clicks=values["total_clicks"],
-        )
+    aggregate_offers(day, [UpliftAggregator])
+    invalidate_report_cache()
 
 
 @app.task(time_limit=60 * 60 * 4)
@@ -504,13 +149,14 @@ def update_previous_day_reports(day=None):
         # do the previous day now that the day is complete
         start_date -= datetime.timedelta(days=1)
 
-    # Do all reports
-    daily_update_geos(start_date)
-    daily_update_placements(start_date)
-    daily_update_impressions(start_date)
-    daily_update_keywords(start_date)
-    daily_update_uplift(start_date)
-    daily_update_regiontopic(start_date)
+    # Do all reports with a single pass over the day's offers
+    aggregate_offers(start_date, DAILY_AGGREGATORS)
+
+    # Roll up the completed day of ad impressions into the month and the flights
+    update_rollups(start_date)
+
+    # Invalidate cached reports once both the indexes and the rollups are written
+    invalidate_report_cache()
 
     if not day:
         # Send notification to Slack about previous day's reports
@@ -523,6 +169,55 @@ def update_previous_day_reports(day=None):
         )
 
 
+@app.task(time_limit=60 * 60 * 4)
+def backfill_reports_day(day, indexes=None):
+    """
+    Aggregate a day of offers into some (or all) report indexes for a backfill.
+
+    See ``./manage.py backfill_reports`` which runs this for a range of days.
+
+    :arg day: A day as an iso8601 string
+    :arg indexes: The names of the indexes to aggregate (eg. ``geos``) or all indexes
+    :returns: a dict with the day, the number of offers aggregated and the time taken
+    """
+    aggregators = DAILY_AGGREGATORS
+    if indexes:
+        aggregators = [AGGREGATORS_BY_NAME[name] for name in indexes]
+
+    start = time.monotonic()
+    offers = aggregate_offers(day, aggregators)
+    if ImpressionAggregator in aggregators:
+        update_rollups(day)
+    invalidate_report_cache()
+    seconds = time.monotonic() - start
+
+    log.info("Backfilled reports for %s. offers=%s seconds=%.1f", day, offers, seconds)
+    return {"day": day, "offers": offers, "seconds": seconds}
+
+
+@app.task(time_limit=60 * 30)
+def update_today_reports():
+    """
+    Add the offers since the last run to today's report data.
+
+    ``update_previous_day_reports`` aggregates the whole day again once it is complete
+    which counts any views and clicks that happened after an offer was aggregated here.
+    """
+    aggregate_new_offers()
+
+
+@app.task()
+def maintain_offer_partitions(months_ahead=3):
+    """Create the offer table partitions for the next few months (if it is partitioned)."""
+    table = get_offer_table()
+    if not is_partitioned(table):
+        log.debug("Offer table %s is not partitioned. Skipping.", table)
+        return
+
+    created = create_partitions(table, datetime.date.today(), months_ahead)
+    log.info("Created offer partitions: %s", created)
+
+
 @app.task()
 def remove_old_client_ids(days=90):
     """Remove old Client IDs which are used for short periods for fraud prevention."""
@@ -537,21 +232,110 @@ def remove_old_client_ids(days=90):
 
 
 @app.task()
-def calculate_publisher_ctrs(days=7):
-    """Calculate average CTRs for paid ads on a publisher for the last X days."""
+def record_offers(offers, day=None):
+    """
+    Write offers and count their decisions and offers (``ADSERVER_OFFER_WRITE_BEHIND``).
+
+    :arg offers: a list of offer field values from ``Offer.record_later``
+    :arg day: the day (YYYY-MM-DD) the offers were made
+    """
+    day = parse_date_string(day)
+    if day:
+        day = day.date()
+
+    # Offers that were already written to validate a view or click are skipped
+    Offer.objects.bulk_create([Offer(**data) for data in offers], ignore_conflicts=True)
+
+    publisher_ads = defaultdict(list)
+    for data in offers:
+        publisher_ads[data["publisher_id"]].append(data["advertisement_id"])
+    for publisher_id, advertisement_ids in publisher_ads.items():
+        Advertisement.incr_offers(advertisement_ids, publisher_id=publisher_id, day=day)
+
+    log.debug("Recorded offers. offers=%s", len(offers))
+
+
+@app.task()
+def calculate_publisher_ctrs(days=7, min_views=1000, record_history=False):
+    """
+    Calculate average CTRs for paid ads on a publisher for the last X days.
+
+    The CTRs of flights and of flights on each publisher are calculated
+    from the same grouped query and cached for the ad decision engine
+    (see ``Flight.get_sampled_ctrs``).
+
+    :param days: The number of days to sample
+    :param min_views: Don't cache flight CTRs with fewer views than this in the sample
+    :param record_history: Create history records for the publishers' ``sampled_ctr``
+    """
     sample_cutoff = get_ad_day() - datetime.timedelta(days=days)
 
-    for publisher in Publisher.objects.all():
-        queryset = AdImpression.objects.filter(
+    # publisher/flight ID -> [clicks, views]
+    publisher_totals = defaultdict(lambda: [0, 0])
+    flight_totals = defaultdict(lambda: [0, 0])
+    sampled_ctrs = {}
+
+    for row in (
+        AdImpression.objects.filter(
             date__gte=sample_cutoff,
-            publisher=publisher,
+            publisher__isnull=False,
             advertisement__flight__campaign__campaign_type=PAID_CAMPAIGN,
         )
-        report = PublisherReport(queryset)
-        report.generate()
+        .order_by()
+        .values("publisher_id", flight_id=F("advertisement__flight_id"))
+        .annotate(clicks_sum=Sum("clicks"), views_sum=Sum("views"))
+    ):
+        for totals in (
+            publisher_totals[row["publisher_id"]],
+            flight_totals[row["flight_id"]],
+        ):
+            totals[0] += row["clicks_sum"]
+            totals[1] += row["views_sum"]
 
-        publisher.sampled_ctr = report.total["ctr"]
-        publisher.save()
+        if row["views_sum"] >= min_views:
+            sampled_ctrs[(row["publisher_id"], row["flight_id"])] = calculate_ctr(
+                row["clicks_sum"], row["views_sum"]
+            )
+
+    for flight_id, (clicks, views) in flight_totals.items():
+        if views >= min_views:
+            sampled_ctrs[flight_id] = calculate_ctr(clicks, views)
+
+    # Keep them if this task doesn't run for a day but not indefinitely
+    cache.set(Flight.SAMPLED_CTRS_CACHE_KEY, sampled_ctrs, timeout=60 * 60 * 48)
+
+    # Only write the publishers whose CTR changed and only their ``sampled_ctr``
+    publishers = []
+    for publisher in Publisher.objects.all():
+        clicks, views = publisher_totals.get(publisher.pk, (0, 0))
+        sampled_ctr = calculate_ctr(clicks, views)
+        if publisher.sampled_ctr != sampled_ctr:
+            publisher.sampled_ctr = sampled_ctr
+            publishers.append(publisher)
+
+    if record_history:
+        bulk_update_with_history(
+            publishers, Publisher, ["sampled_ctr"], batch_size=1000
+        )
+    else:
+        Publisher.objects.bulk_update(publishers, ["sampled_ctr"], batch_size=1000)
+
+    log.info(
+        "Calculated CTRs. publishers_updated=%s sampled_ctrs=%s",
+        len(publishers),
+        len(sampled_ctrs),
+    )
+
+
+def _get_publisher_results(queryset):
+    """Get the ``PublisherReport`` results for a queryset of impressions by publisher ID."""
+    report = PublisherReport(queryset, index="publisher")
+    report.generate()
+    return {
+        result["publisher"].pk: result
+        for result in report.results
+        if result["publisher"] is not None
+    }
 
 
 @app.task()
@@ -650,32 +434,33 @@ def notify_of_publisher_changes(difference_threshold=0.25, min_views=10_000):
     a_week_ago = get_ad_day() - datetime.timedelta(days=7)
     two_weeks_ago = a_week_ago - datetime.timedelta(days=7)
 
+    # Generate a report for the last week for all publishers
+    queryset = AdImpression.objects.filter(
+        date__gte=a_week_ago,
+        publisher__allow_paid_campaigns=True,
+        advertisement__flight__campaign__campaign_type=PAID_CAMPAIGN,
+    )
+    last_week_results = _get_publisher_results(queryset)
+
+    # Generate the previous week for comparison
+    queryset = AdImpression.objects.filter(
+        date__gte=two_weeks_ago,
+        date__lte=a_week_ago,
+        publisher__allow_paid_campaigns=True,
+        advertisement__flight__campaign__campaign_type=PAID_CAMPAIGN,
+    )
+    previous_week_results = _get_publisher_results(queryset)
+
     for publisher in Publisher.objects.filter(allow_paid_campaigns=True):
-        # Generate a report for the last week
-        queryset = AdImpression.objects.filter(
-            date__gte=a_week_ago,
-            publisher=publisher,
-            advertisement__flight__campaign__campaign_type=PAID_CAMPAIGN,
-        )
-        last_week_report = PublisherReport(queryset)
-        last_week_report.generate()
-
-        # Generate the previous week for comparison
-        queryset = AdImpression.objects.filter(
-            date__gte=two_weeks_ago,
-            date__lte=a_week_ago,
-            publisher=publisher,
-            advertisement__flight__campaign__campaign_type=PAID_CAMPAIGN,
-        )
-        previous_week_report = PublisherReport(queryset)
-        previous_week_report.generate()
+        last_week_total = last_week_results.get(publisher.pk)
+        previous_week_total = previous_week_results.get(publisher.pk)
+        if not last_week_total or not previous_week_total:
+            continue
 
         for metric in ("views",):
-            total_views = (
-                last_week_report.total["views"] + previous_week_report.total["views"]
-            )
-            last_week_value = last_week_report.total[metric]
-            previous_week_value = previous_week_report.total[metric]
+            total_views = last_week_total["views"] + previous_week_total["views"]
+            last_week_value = last_week_total[metric]
+            previous_week_value = previous_week_total[metric]
             if last_week_value > 0 and previous_week_value > 0:
                 metric_diff = abs((last_week_value / previous_week_value) - 1)
                 perc_diff = calculate_percent_diff(last_week_value, previous_week_value)
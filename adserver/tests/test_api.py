@@ -8,10 +8,12 @@ from django.conf import settings
 from django.contrib.auth import get_user_model
 from django.contrib.auth.models import AnonymousUser
 from django.core.cache import cache
+from django.db import connection
 from django.test import Client
 from django.test import override_settings
 from django.test import TestCase
 from django.test.client import RequestFactory
+from django.test.utils import CaptureQueriesContext
 from django.urls import reverse
 from django.utils import timezone
 from django_dynamic_fixture import get
@@ -26,6 +28,7 @@ from ..constants import COMMUNITY_CAMPAIGN
 from ..constants import HOUSE_CAMPAIGN
 from ..constants import PAID_CAMPAIGN
 from ..constants import VIEWS
+from ..models import AdImpression
 from ..models import AdType
 from ..models import Advertisement
 from ..models import Advertiser
@@ -36,6 +39,7 @@ from ..models import Offer
 from ..models import Publisher
 from ..models import PublisherGroup
 from ..models import View
+from ..tasks import record_offers as record_offers_task
 from ..utils import GeolocationData
 
 
@@ -784,6 +788,123 @@ class AdDecisionApiTests(BaseApiTest):
         cache.clear()
 
 
+class AdBatchDecisionApiTests(BaseApiTest):
+    def setUp(self):
+        super().setUp()
+
+        self.url = reverse("api:decision-batch")
+        self.ad2 = get(
+            Advertisement,
+            slug="ad2-slug",
+            name="ad2",
+            link="http://example.com",
+            image=None,
+            live=True,
+            flight=self.flight,
+        )
+        self.ad2.ad_types.add(self.ad_type)
+
+        self.data["placements"] = [
+            {"div_id": "a", "ad_type": self.ad_type.slug},
+            {"div_id": "b", "ad_type": self.ad_type.slug},
+            {"div_id": "c", "ad_type": self.ad_type.slug},
+        ]
+
+    def test_post_request(self):
+        resp = self.client.post(
+            self.url, json.dumps(self.data), content_type="application/json"
+        )
+        self.assertEqual(resp.status_code, 200, resp.content)
+        decisions = resp.json()["decisions"]
+        self.assertEqual([d["div_id"] for d in decisions], ["a", "b", "c"])
+
+        # Each ad is only chosen once and the third placement gets nothing
+        self.assertEqual(
+            sorted(d["id"] for d in decisions[:2]), ["ad-slug", "ad2-slug"]
+        )
+        self.assertEqual(decisions[2], {"div_id": "c"})
+        self.assertNotEqual(decisions[0]["nonce"], decisions[1]["nonce"])
+
+        # All the offers and decisions are recorded
+        self.assertEqual(Offer.objects.filter(publisher=self.publisher).count(), 3)
+        self.assertEqual(
+            Offer.objects.filter(advertisement=None, div_id="c").count(), 1
+        )
+        for ad in (self.ad, self.ad2):
+            impression = ad.impressions.get(publisher=self.publisher)
+            self.assertEqual(impression.offers, 1)
+            self.assertEqual(impression.decisions, 1)
+        null_impression = AdImpression.objects.get(
+            publisher=self.publisher, advertisement=None
+        )
+        self.assertEqual(null_impression.offers, 0)
+        self.assertEqual(null_impression.decisions, 1)
+
+        # Counts are added to the existing impressions
+        resp = self.client.post(
+            self.url, json.dumps(self.data), content_type="application/json"
+        )
+        self.assertEqual(resp.status_code, 200, resp.content)
+        self.assertEqual(self.ad.impressions.get(publisher=self.publisher).offers, 2)
+        null_impression.refresh_from_db()
+        self.assertEqual(null_impression.decisions, 2)
+
+    @override_settings(ADSERVER_STICKY_DECISION_DURATION=5)
+    def test_sticky_placements(self):
+        self.publisher.cache_ads = True
+        self.publisher.save()
+        self.addCleanup(cache.clear)
+
+        data = dict(self.data, placements=self.data["placements"][:1])
+        resp = self.client.post(
+            self.url, json.dumps(data), content_type="application/json"
+        )
+        self.assertEqual(resp.status_code, 200, resp.content)
+        sticky_decision = resp.json()["decisions"][0]
+        self.assertIn(sticky_decision["id"], ("ad-slug", "ad2-slug"))
+
+        # One sticky placement and one new placement
+        data = dict(self.data, placements=self.data["placements"][:2])
+        resp = self.client.post(
+            self.url, json.dumps(data), content_type="application/json"
+        )
+        self.assertEqual(resp.status_code, 200, resp.content)
+        decisions = resp.json()["decisions"]
+
+        # The sticky placement gets the same ad and offer
+        self.assertEqual(decisions[0], sticky_decision)
+
+        # The new placement doesn't repeat the sticky ad
+        self.assertIn(decisions[1]["id"], ("ad-slug", "ad2-slug"))
+        self.assertNotEqual(decisions[1]["id"], sticky_decision["id"])
+        self.assertEqual(Offer.objects.filter(publisher=self.publisher).count(), 2)
+
+    def test_get_request(self):
+        self.query_params["div_ids"] = "a|b"
+        self.query_params["ad_types"] = f"{self.ad_type.slug}|{self.ad_type.slug}"
+        resp = self.client.get(self.url, self.query_params)
+        self.assertEqual(resp.status_code, 200, resp.content)
+        decisions = resp.json()["decisions"]
+        self.assertEqual(
+            sorted(d["id"] for d in decisions), ["ad-slug", "ad2-slug"], decisions
+        )
+
+    def test_too_many_placements(self):
+        self.data["placements"] = [
+            {"div_id": f"div-{i}", "ad_type": self.ad_type.slug} for i in range(11)
+        ]
+        resp = self.client.post(
+            self.url, json.dumps(self.data), content_type="application/json"
+        )
+        self.assertEqual(resp.status_code, 400)
+
+    def test_invalid_auth(self):
+        resp = self.unauth_client.post(
+            self.url, json.dumps(self.data), content_type="application/json"
+        )
+        self.assertEqual(resp.status_code, 401)
+
+
 class AdvertiserApiTests(BaseApiTest):
     def setUp(self):
         super().setUp()
@@ -1455,6 +1576,140 @@ class AdvertisingIntegrationTests(BaseApiTest):
             1,
         )
 
+    @override_settings(ADSERVER_OFFER_WRITE_BEHIND=True)
+    @mock.patch("adserver.tasks.record_offers.delay")
+    def test_offer_write_behind(self, record_offers):
+        data = {
+            "placements": self.placements,
+            "publisher": self.publisher1.slug,
+            "user_ip": self.ip_address,
+            "user_ua": self.user_agent,
+        }
+        resp = self.client.post(
+            self.url, json.dumps(data), content_type="application/json"
+        )
+        self.assertEqual(resp.status_code, 200, resp.content)
+        nonce = resp.json()["nonce"]
+
+        # Nothing is written during the decision
+        self.assertFalse(Offer.objects.filter(publisher=self.publisher1).exists())
+        self.assertFalse(self.ad.impressions.filter(publisher=self.publisher1).exists())
+        self.assertEqual(record_offers.call_count, 1)
+        (offers,), kwargs = record_offers.call_args
+        self.assertEqual(len(offers), 1)
+        self.assertEqual(str(offers[0]["id"]), nonce)
+
+        # A view before the offer is written still counts (exactly once)
+        view_url = reverse(
+            "view-proxy", kwargs={"advertisement_id": self.ad.pk, "nonce": nonce}
+        )
+        resp = self.proxy_client.get(view_url)
+        self.assertEqual(resp["X-Adserver-Reason"], "Billed view")
+        resp = self.proxy_client.get(view_url)
+        self.assertEqual(resp["X-Adserver-Reason"], "Old/Invalid nonce")
+
+        # The worker writes the offers in bulk without overwriting the view
+        record_offers_task(offers, **kwargs)
+        offer = Offer.objects.get(pk=nonce)
+        self.assertTrue(offer.viewed)
+        impression = self.ad.impressions.get(publisher=self.publisher1)
+        self.assertEqual(impression.decisions, 1)
+        self.assertEqual(impression.offers, 1)
+        self.assertEqual(impression.views, 1)
+
+        # Null offers are written later too
+        self.ad.live = False
+        self.ad.save()
+        resp = self.client.post(
+            self.url, json.dumps(data), content_type="application/json"
+        )
+        self.assertEqual(resp.json(), {})
+        (offers,), kwargs = record_offers.call_args
+        record_offers_task(offers, **kwargs)
+        self.assertEqual(
+            Offer.objects.filter(advertisement=None, publisher=self.publisher1).count(),
+            1,
+        )
+
+    @override_settings(ADSERVER_NONCE_CACHE=True)
+    def test_nonce_cache(self):
+        cache.clear()
+        data = {
+            "placements": self.placements,
+            "publisher": self.publisher1.slug,
+            "user_ip": self.ip_address,
+            "user_ua": self.user_agent,
+        }
+        resp = self.client.post(
+            self.url, json.dumps(data), content_type="application/json"
+        )
+        self.assertEqual(resp.status_code, 200, resp.content)
+        nonce = resp.json()["nonce"]
+
+        offer = Offer.load_nonce(nonce)
+        self.assertIsNotNone(offer)
+        self.assertEqual(offer.advertisement_id, self.ad.pk)
+        self.assertEqual(offer.publisher_id, self.publisher1.pk)
+        self.assertFalse(offer.viewed)
+
+        # The view is validated from the cache without reading the offers table
+        view_url = reverse(
+            "view-proxy", kwargs={"advertisement_id": self.ad.pk, "nonce": nonce}
+        )
+        with CaptureQueriesContext(connection) as queries:
+            resp = self.proxy_client.get(view_url)
+        self.assertEqual(resp["X-Adserver-Reason"], "Billed view")
+        self.assertFalse(
+            any(
+                query["sql"].startswith("SELECT")
+                and (
+                    Offer._meta.db_table in query["sql"]
+                    or Publisher._meta.db_table in query["sql"]
+                )
+                for query in queries
+            )
+        )
+
+        # The view is written to the database and the cache
+        self.assertTrue(Offer.objects.get(pk=nonce).viewed)
+        self.assertTrue(Offer.load_nonce(nonce).viewed)
+        resp = self.proxy_client.get(view_url)
+        self.assertEqual(resp["X-Adserver-Reason"], "Old/Invalid nonce")
+
+        view_time_url = (
+            reverse(
+                "view-time-proxy",
+                kwargs={"advertisement_id": self.ad.pk, "nonce": nonce},
+            )
+            + "?view_time=10"
+        )
+        resp = self.proxy_client.get(view_time_url)
+        self.assertEqual(resp["X-Adserver-Reason"], "Updated view time")
+        self.assertEqual(Offer.objects.get(pk=nonce).view_time, 10)
+        self.assertEqual(Offer.load_nonce(nonce).view_time, 10)
+
+        click_url = reverse(
+            "click-proxy", kwargs={"advertisement_id": self.ad.pk, "nonce": nonce}
+        )
+        resp = self.proxy_client.get(click_url)
+        self.assertEqual(resp["X-Adserver-Reason"], "Billed click")
+        self.assertTrue(Offer.objects.get(pk=nonce).clicked)
+        self.assertTrue(Click.objects.filter(advertisement=self.ad).exists())
+
+        # Offers that aren't cached fall back to the database
+        # The publisher is loaded with the offer
+        cache.clear()
+        with CaptureQueriesContext(connection) as queries:
+            resp = self.proxy_client.get(click_url)
+        self.assertEqual(resp["X-Adserver-Reason"], "Old/Invalid nonce")
+        self.assertFalse(
+            any(
+                query["sql"].startswith("SELECT")
+                and f'FROM "{Publisher._meta.db_table}"' in query["sql"]
+                for query in queries
+            )
+        )
+
     def test_offer_url(self):
         referrer_url = "http://example.com/path.html"
         post_url = "http://example.com/altpath.html"
@@ -1610,6 +1865,19 @@ class TestProxyViews(BaseApiTest):
         self.assertEqual(resp.status_code, 200)
         self.assertEqual(resp["X-Adserver-Reason"], "Billed view")
 
+    def test_view_tracking_concurrent(self):
+        # Both requests load the offer before either of them invalidates the nonce
+        offer = Offer.objects.get(pk=self.nonce)
+        with mock.patch("adserver.views.BaseProxyView.get_offer", return_value=offer):
+            resp = self.client.get(self.url)
+            self.assertEqual(resp["X-Adserver-Reason"], "Billed view")
+            resp = self.client.get(self.url)
+            self.assertEqual(resp["X-Adserver-Reason"], "Old/Invalid nonce")
+
+        # The view was only counted once
+        impression = self.ad.impressions.get(publisher=self.publisher)
+        self.assertEqual(impression.views, 1)
+
     def test_view_tracking_invalid_nonce(self):
         url = reverse(
             "view-proxy",
@@ -1768,6 +2036,22 @@ class TestProxyViews(BaseApiTest):
         )
         self.assertEqual(resp["X-Adserver-Reason"], "Old/Invalid nonce")
 
+    def test_click_tracking_old_offer(self):
+        # The offer is older than the nonce cache keeps it
+        Offer.objects.filter(id=self.offer["nonce"]).update(
+            viewed=True, date=timezone.now() - datetime.timedelta(hours=5)
+        )
+        cache.delete(Offer.NONCE_CACHE_KEY.format(self.offer["nonce"]))
+        resp = self.client.get(self.click_url)
+
+        # Old offers are still attributed to the publisher but aren't billed
+        self.assertEqual(resp.status_code, 302)
+        self.assertEqual(
+            resp["Location"], self.ad.link + "?ea-publisher=test-publisher"
+        )
+        self.assertEqual(resp["X-Adserver-Reason"], "Old/Invalid nonce")
+        self.assertFalse(Offer.objects.get(id=self.offer["nonce"]).clicked)
+
     @override_settings(ADSERVER_CLICK_RATELIMITS=["1/s", "1/m"])
     def test_click_tracking_ratelimit(self):
         Offer.objects.filter(id=self.offer["nonce"]).update(viewed=True)
@@ -1827,21 +2111,21 @@ class TestProxyViews(BaseApiTest):
         }
         self.ad.flight.save()
 
-        with mock.patch("adserver.views.get_geolocation") as get_geo:
+        with mock.patch("adserver.fraud.get_geolocation") as get_geo:
             get_geo.return_value = GeolocationData("US", "ID", 757)  # Boise, ID
             resp = self.client.get(self.click_url)
 
         self.assertEqual(resp.status_code, 302)
         self.assertEqual(resp["X-Adserver-Reason"], "Invalid targeting impression")
 
-        with mock.patch("adserver.views.get_geolocation") as get_geo:
+        with mock.patch("adserver.fraud.get_geolocation") as get_geo:
             get_geo.return_value = GeolocationData("US", "CA", 807)  # Bay Area
             resp = self.client.get(self.click_url)
 
         self.assertEqual(resp.status_code, 302)
         self.assertEqual(resp["X-Adserver-Reason"], "Invalid targeting impression")
 
-        with mock.patch("adserver.views.get_geolocation") as get_geo:
+        with mock.patch("adserver.fraud.get_geolocation") as get_geo:
             get_geo.return_value = GeolocationData("US", "CA", 825)  # San Diego, CA
             resp = self.client.get(self.click_url)
 
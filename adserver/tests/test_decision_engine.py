@@ -1,6 +1,7 @@
 import datetime
 from unittest import mock
 
+from django.db.models.signals import post_delete
 from django.test import override_settings
 from django.test import TestCase
 from django.test.client import RequestFactory
@@ -9,6 +10,7 @@ from user_agents import parse
 
 from ..analyzer.models import AnalyzedUrl
 from ..constants import AFFILIATE_CAMPAIGN
+from ..constants import ALL_CAMPAIGN_TYPES
 from ..constants import CLICKS
 from ..constants import COMMUNITY_CAMPAIGN
 from ..constants import HOUSE_CAMPAIGN
@@ -18,11 +20,19 @@ from ..decisionengine import get_ad_decision_backend
 from ..decisionengine.backends import AdvertisingDisabledBackend
 from ..decisionengine.backends import AdvertisingEnabledBackend
 from ..decisionengine.backends import ProbabilisticFlightBackend
+from ..decisionengine.index import FlightIndex
+from ..decisionengine.pacing import PacingSnapshot
+from ..decisionengine.sampling import WeightedSampler
 from ..models import AdType
 from ..models import Advertisement
 from ..models import Campaign
+from ..models import CountryRegion
 from ..models import Flight
+from ..models import Keyword
 from ..models import Publisher
+from ..models import PublisherGroup
+from ..models import Region
+from ..models import Topic
 from ..utils import GeolocationData
 from ..utils import get_ad_day
 
@@ -344,27 +354,198 @@ class DecisionEngineTests(TestCase):
 
     def test_database_queries_made(self):
         with self.assertNumQueries(1):
-            flights = list(self.probabilistic_backend.get_candidate_flights())
+            flights = list(self.backend.get_candidate_flights())
+            self.assertEqual(len(flights), 3)
+
+        with self.assertNumQueries(6):
+            # Build the flight index
+            # 1. Get all the live flights and their campaigns
+            # 2. Get the live ads for those flights
+            # 3. Prefetch the ad types for all the ads
+            # 4-6. Get the campaign publishers, publisher groups and excluded publishers
+            flights = self.probabilistic_backend.get_candidate_flights()
             self.assertEqual(len(flights), 3)
 
         with self.assertNumQueries(1):
-            # This should just be the same query from `get_candidate_flights` above
+            # Candidate flights come from the flight index
+            # 1. Get the flight totals for the pacing snapshot
             flight = self.probabilistic_backend.select_flight()
 
-        with self.assertNumQueries(2):
-            # One query to get the specific ad for the chosen flight
-            # One to prefetch all the ad types
+        with self.assertNumQueries(0):
+            # Ads and their ad types come from the flight index
             ad = self.probabilistic_backend.select_ad_for_flight(flight)
             self.assertTrue(ad in self.possible_ads, ad)
 
-        with self.assertNumQueries(3):
-            # Three total queries to get an ad placement
-            # 1. Get all the candidate flights
-            # 2. Choose the specific ad for the chosen flight
-            # 3. Prefetch the ad types for all the ads in the chosen flight
-            ad, _ = self.probabilistic_backend.get_ad_and_placement()
+        backend = ProbabilisticFlightBackend(
+            request=self.request, placements=self.placements, publisher=self.publisher
+        )
+        with self.assertNumQueries(0):
+            # A new decision uses the cached flight index and pacing snapshot
+            ad, _ = backend.get_ad_and_placement()
             self.assertTrue(ad in self.possible_ads, ad)
 
+    def test_flight_index(self):
+        index = FlightIndex.load()
+        self.assertEqual(
+            index.get_flights(
+                publisher=self.publisher,
+                ad_types=["z"],
+                campaign_types=ALL_CAMPAIGN_TYPES,
+                day=get_ad_day().date(),
+            ),
+            # The CPM flight has no ads so it isn't indexed
+            list(
+                Flight.objects.filter(
+                    pk__in=(
+                        self.include_flight.pk,
+                        self.exclude_flight.pk,
+                        self.basic_flight.pk,
+                    )
+                )
+            ),
+        )
+        self.assertEqual(
+            index.get_ads(self.include_flight, ["z"]), [self.advertisement1]
+        )
+        self.assertEqual(index.get_ads(self.include_flight, ["unknown"]), [])
+
+        # The index is cached until something changes
+        self.assertIs(FlightIndex.load(), index)
+
+        # Changing the ad type invalidates the index
+        other_ad_type = get(AdType, slug="other")
+        self.advertisement1.ad_types.set([other_ad_type])
+        index = FlightIndex.load()
+        self.assertEqual(index.get_ads(self.include_flight, ["z"]), [])
+        self.assertEqual(
+            index.get_ads(self.include_flight, ["other"]), [self.advertisement1]
+        )
+
+        # Other publishers and campaign types aren't eligible
+        other_publisher = get(Publisher, slug="other-publisher")
+        self.assertEqual(
+            index.get_flights(
+                publisher=other_publisher,
+                ad_types=["z"],
+                campaign_types=ALL_CAMPAIGN_TYPES,
+                day=get_ad_day().date(),
+            ),
+            [],
+        )
+        self.assertEqual(
+            index.get_flights(
+                publisher=self.publisher,
+                ad_types=["z"],
+                campaign_types=[HOUSE_CAMPAIGN],
+                day=get_ad_day().date(),
+            ),
+            [],
+        )
+
+        # Publishers in targeted publisher groups are eligible
+        group = get(PublisherGroup, publishers=[other_publisher])
+        self.campaign.publisher_groups.add(group)
+        index = FlightIndex.load()
+        self.assertEqual(
+            len(
+                index.get_flights(
+                    publisher=other_publisher,
+                    ad_types=["z"],
+                    campaign_types=ALL_CAMPAIGN_TYPES,
+                    day=get_ad_day().date(),
+                )
+            ),
+            2,
+        )
+
+        # Non-live flights aren't indexed
+        self.exclude_flight.live = False
+        self.exclude_flight.save()
+        index = FlightIndex.load()
+        self.assertNotIn(self.exclude_flight, index.flights)
+
+        # Deleting an ad (eg. a raw delete which skips ``IndestructibleModel``)
+        # invalidates the index
+        index = FlightIndex.load()
+        post_delete.send(sender=Advertisement, instance=self.advertisement1)
+        self.assertIsNot(FlightIndex.load(), index)
+
+    def test_flight_index_targeting(self):
+        region = get(Region, slug="test-region")
+        get(CountryRegion, region=region, country="FR")
+        topic = get(Topic, slug="test-topic")
+        get(Keyword, slug="test-keyword", topics=[topic])
+        self.include_flight.targeting_parameters = {
+            "include_regions": ["test-region"],
+            "include_topics": ["test-topic"],
+        }
+        self.include_flight.save()
+
+        def get_targeting():
+            index = FlightIndex.load()
+            flight = index.flights[index.flights.index(self.include_flight)]
+            return flight.targeting
+
+        targeting = get_targeting()
+        self.assertEqual(targeting.included_region_countries, {"FR"})
+        self.assertEqual(targeting.included_topic_keywords, {"test-keyword"})
+
+        # Changing a region's countries or a topic's keywords
+        # recompiles the targeting of the indexed flights
+        get(CountryRegion, region=region, country="DE")
+        keyword = get(Keyword, slug="other-keyword")
+        keyword.topics.add(topic)
+
+        targeting = get_targeting()
+        self.assertEqual(targeting.included_region_countries, {"FR", "DE"})
+        self.assertEqual(
+            targeting.included_topic_keywords, {"test-keyword", "other-keyword"}
+        )
+
+    def test_pacing_snapshot(self):
+        index = FlightIndex.load()
+        snapshot = PacingSnapshot.load(index)
+        self.assertIs(PacingSnapshot.load(index), snapshot)
+
+        pacing = snapshot.get_pacing(self.include_flight)
+        self.assertEqual(
+            pacing.clicks_needed, self.include_flight.clicks_needed_today()
+        )
+        self.assertEqual(pacing.views_needed, 0)
+        self.assertEqual(
+            pacing.weighted_clicks_needed(self.publisher),
+            self.include_flight.weighted_clicks_needed_today(self.publisher),
+        )
+
+        # Clicks and views in this process update the snapshot without a query
+        clicks_needed = pacing.clicks_needed
+        self.advertisement1.incr(CLICKS, self.publisher)
+        with self.assertNumQueries(0):
+            pacing = PacingSnapshot.load(index).get_pacing(self.include_flight)
+        self.assertEqual(pacing.flight.total_clicks, 1)
+        self.assertEqual(pacing.clicks_needed, clicks_needed - 1)
+
+        # Totals updated elsewhere are picked up when the snapshot refreshes
+        Flight.objects.filter(pk=self.include_flight.pk).update(
+            total_clicks=self.include_flight.sold_clicks
+        )
+        self.assertEqual(
+            PacingSnapshot.load(index).get_pacing(self.include_flight).clicks_needed,
+            clicks_needed - 1,
+        )
+        snapshot.expires = 0
+        pacing = PacingSnapshot.load(index).get_pacing(self.include_flight)
+        self.assertEqual(pacing.clicks_needed, 0)
+        self.assertEqual(pacing.weighted_clicks_needed(self.publisher), 0)
+        self.assertFalse(self.probabilistic_backend.filter_flight(self.include_flight))
+
+        # A new flight index always gets a new snapshot
+        self.include_flight.sold_clicks = 2000
+        self.include_flight.save()
+        index = FlightIndex.load()
+        pacing = PacingSnapshot.load(index).get_pacing(self.include_flight)
+        self.assertGreater(pacing.clicks_needed, 0)
+
     def test_click_probability(self):
         # Remove existing flights
         for flight in Flight.objects.all():
@@ -393,39 +574,34 @@ class DecisionEngineTests(TestCase):
                 flight2_prob = flight2.weighted_clicks_needed_today()
                 total = flight1_prob + flight2_prob
 
-                with mock.patch("random.randint") as randint:
-
-                    randint.return_value = -1
-                    ad, _ = self.probabilistic_backend.get_ad_and_placement()
-                    self.assertEqual(ad, None)
-
-                    randint.return_value = 0
-                    ad, _ = self.probabilistic_backend.get_ad_and_placement()
-                    self.assertEqual(ad, self.advertisement1)
-
-                    randint.return_value = flight1_prob - 1
-                    ad, _ = self.probabilistic_backend.get_ad_and_placement()
-                    self.assertEqual(ad, self.advertisement1)
-
-                    randint.return_value = flight1_prob
-                    ad, _ = self.probabilistic_backend.get_ad_and_placement()
-                    self.assertEqual(ad, self.advertisement1)
-
-                    randint.return_value = flight1_prob + 1
-                    ad, _ = self.probabilistic_backend.get_ad_and_placement()
-                    self.assertEqual(ad, self.advertisement2)
-
-                    randint.return_value = total - 1
-                    ad, _ = self.probabilistic_backend.get_ad_and_placement()
-                    self.assertEqual(ad, self.advertisement2)
-
-                    randint.return_value = total
-                    ad, _ = self.probabilistic_backend.get_ad_and_placement()
-                    self.assertEqual(ad, self.advertisement2)
+                # Choosing the flight and then the (only) ad in that flight
+                for value, expected_ad in (
+                    (-1, None),
+                    (0, self.advertisement1),
+                    (flight1_prob - 1, self.advertisement1),
+                    (flight1_prob, self.advertisement2),
+                    (flight1_prob + 1, self.advertisement2),
+                    (total - 1, self.advertisement2),
+                    (total, None),
+                ):
+                    with mock.patch("random.randrange") as randrange:
+                        randrange.side_effect = [value, 0]
+                        ad, _ = self.probabilistic_backend.get_ad_and_placement()
+                        self.assertEqual(ad, expected_ad, value)
+
+    def test_weighted_sampler(self):
+        sampler = WeightedSampler([("a", 2), ("b", 0), ("c", 3), ("d", -1)])
+        self.assertEqual(len(sampler), 4)
+        self.assertEqual(sampler.total_weight, 5)
+        self.assertEqual(
+            [sampler.get(value) for value in range(-1, 6)],
+            [None, "a", "a", "c", "c", "c", None],
+        )
+        self.assertIn(sampler.choose(), ("a", "c"))
 
-                    randint.return_value = total + 1
-                    ad, _ = self.probabilistic_backend.get_ad_and_placement()
-                    self.assertEqual(ad, None)
+        # Nothing to choose from
+        self.assertIsNone(WeightedSampler([]).choose())
+        self.assertIsNone(WeightedSampler([("a", 0)]).choose())
 
     def test_publisher_campaign_type_restrictions(self):
         self.campaign.campaign_type = PAID_CAMPAIGN
@@ -486,7 +662,7 @@ class DecisionEngineTests(TestCase):
             flight.save()
 
         flights = self.probabilistic_backend.get_candidate_flights()
-        self.assertFalse(flights.exists())
+        self.assertFalse(flights)
 
         self.publisher.allow_affiliate_campaigns = True
         self.publisher.save()
@@ -645,13 +821,16 @@ class DecisionEngineTests(TestCase):
 
     def test_publisher_excluded(self):
         flights = self.probabilistic_backend.get_candidate_flights()
-        self.assertTrue(flights.exists())
+        self.assertTrue(flights)
 
         # Exclude the one and only publisher
         self.campaign.exclude_publishers.add(self.publisher)
 
-        flights = self.probabilistic_backend.get_candidate_flights()
-        self.assertFalse(flights.exists())
+        backend = ProbabilisticFlightBackend(
+            request=self.request, placements=self.placements, publisher=self.publisher
+        )
+        flights = backend.get_candidate_flights()
+        self.assertFalse(flights)
 
     def test_ctr_weighting(self):
         # Remove existing flights
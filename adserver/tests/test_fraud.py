@@ -0,0 +1,134 @@
+from types import SimpleNamespace
+from unittest.mock import patch
+
+from django.core.exceptions import ImproperlyConfigured
+from django.test import RequestFactory
+from django.test import TestCase
+
+from ..constants import VIEWS
+from ..fraud import BaseFraudRule
+from ..fraud import BotRule
+from ..fraud import FraudContext
+from ..fraud import FraudRulePipeline
+from ..fraud import get_fraud_rule_pipeline
+from ..fraud import InvalidNonceRule
+from ..fraud import KnownUserRule
+from ..fraud import MismatchedOsRule
+from ..fraud import UnknownOfferRule
+
+
+class ExpensiveRule(BaseFraudRule):
+    name = "expensive"
+    reason = "Expensive"
+    cost = 500
+
+    def is_fraud(self, context):
+        return False
+
+
+class ExpensiveMatchingRule(BaseFraudRule):
+    name = "expensive-matching"
+    reason = "Expensive matching"
+    cost = 500
+
+    def is_fraud(self, context):
+        return True
+
+
+class CheapDependentRule(BaseFraudRule):
+    name = "cheap-dependent"
+    reason = "Cheap dependent"
+    cost = 0
+    depends_on = ("expensive",)
+
+    def is_fraud(self, context):
+        return False
+
+
+class TestFraudRules(TestCase):
+    def setUp(self):
+        self.factory = RequestFactory()
+        self.bot_ua = (
+            "Mozilla/5.0 (compatible; Googlebot/2.1; +http://www.google.com/bot.html)"
+        )
+        self.mac_chrome_ua = (
+            "Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) "
+            "AppleWebKit/537.36 (KHTML, like Gecko) Chrome/100.0.4896.127 Safari/537.36"
+        )
+
+    def test_rule_order(self):
+        pipeline = FraudRulePipeline(
+            [CheapDependentRule(), BotRule(), ExpensiveRule(), UnknownOfferRule()]
+        )
+        self.assertEqual(
+            [rule.name for rule in pipeline.rules],
+            ["unknown-offer", "bot", "expensive", "cheap-dependent"],
+        )
+
+        # Dependencies must be enabled
+        with self.assertRaises(ImproperlyConfigured):
+            FraudRulePipeline([CheapDependentRule()])
+        with self.assertRaises(ImproperlyConfigured):
+            FraudRulePipeline([InvalidNonceRule()])
+
+    def test_pipeline_stats(self):
+        pipeline = FraudRulePipeline([BotRule(), ExpensiveRule()])
+
+        request = self.factory.get("/", HTTP_USER_AGENT=self.bot_ua)
+        context = FraudContext(request, None, None, VIEWS)
+        self.assertIsInstance(pipeline.check(context), BotRule)
+
+        request = self.factory.get("/", HTTP_USER_AGENT="Mozilla/5.0")
+        context = FraudContext(request, None, None, VIEWS)
+        self.assertIsNone(pipeline.check(context))
+
+        stats = pipeline.get_stats()
+        self.assertEqual(list(stats), ["bot", "expensive"])
+        self.assertEqual(stats["bot"]["checks"], 2)
+        self.assertEqual(stats["bot"]["hits"], 1)
+        # The expensive rule isn't checked after the bot rule matches
+        self.assertEqual(stats["expensive"]["checks"], 1)
+        self.assertEqual(stats["expensive"]["hits"], 0)
+        self.assertGreaterEqual(stats["expensive"]["seconds"], 0)
+
+    def test_rule_precedence(self):
+        request = self.factory.get("/", HTTP_USER_AGENT=self.bot_ua)
+
+        # The expensive rule is configured first so it is still checked
+        # and its reason is used even though the cheaper rule matched first
+        pipeline = FraudRulePipeline([ExpensiveMatchingRule(), BotRule()])
+        self.assertEqual(
+            [rule.name for rule in pipeline.rules], ["bot", "expensive-matching"]
+        )
+        context = FraudContext(request, None, None, VIEWS)
+        self.assertIsInstance(pipeline.check(context), ExpensiveMatchingRule)
+
+        # Rules configured after a match aren't checked
+        pipeline = FraudRulePipeline([BotRule(), ExpensiveMatchingRule()])
+        context = FraudContext(request, None, None, VIEWS)
+        self.assertIsInstance(pipeline.check(context), BotRule)
+        self.assertEqual(pipeline.get_stats()["expensive-matching"]["checks"], 0)
+
+    def test_configured_precedence(self):
+        pipeline = get_fraud_rule_pipeline()
+        advertisement = SimpleNamespace(
+            is_valid_offer=lambda impression_type, offer: True,
+            flight=SimpleNamespace(show_to_geo=lambda geo_data: True),
+        )
+        offer = SimpleNamespace(
+            os_family="Windows", browser_family="Firefox", publisher="publisher"
+        )
+
+        # A known user with a mismatched OS is recorded as a known user
+        request = self.factory.get(
+            "/", HTTP_USER_AGENT=self.mac_chrome_ua, REMOTE_ADDR="8.8.8.8"
+        )
+        request.user = SimpleNamespace(is_anonymous=False)
+        context = FraudContext(request, advertisement, offer, VIEWS)
+        self.assertIsInstance(pipeline.check(context), KnownUserRule)
+
+        # A mismatched OS and browser is recorded as the OS
+        request.user = SimpleNamespace(is_anonymous=True)
+        with patch("adserver.fraud.is_view_ratelimited", return_value=False):
+            context = FraudContext(request, advertisement, offer, VIEWS)
+            self.assertIsInstance(pipeline.check(context), MismatchedOsRule)
@@ -1,20 +1,33 @@
+import bz2
+import datetime
 import io
 import os
+from hashlib import md5
 from unittest.mock import patch
+from unittest.mock import PropertyMock
 
+from django.conf import settings
 from django.contrib.auth import get_user_model
 from django.core import management
 from django.db import models
 from django.test import override_settings
 from django.test import TestCase
+from django.utils import timezone
+from django_dynamic_fixture import get
 
+from ..management.commands.archive_offers import StreamingCompressor
 from ..models import AdImpression
 from ..models import Advertisement
 from ..models import Advertiser
 from ..models import Campaign
 from ..models import Click
 from ..models import Flight
+from ..models import GeoImpression
+from ..models import Offer
 from ..models import Publisher
+from ..models import RegionImpression
+from ..partitions import get_create_partition_sql
+from .common import BaseAdModelsTestCase
 
 
 User = get_user_model()
@@ -110,7 +123,7 @@ class TestArchiveOffers(TestCase):
                 stderr=self.err,
             )
 
-    @patch("django.db.connections")
+    @patch("adserver.management.commands.archive_offers.connections")
     def test_archive_offers(self, conn_mock):
         management.call_command(
             "archive_offers",
@@ -134,9 +147,146 @@ class TestArchiveOffers(TestCase):
         output = self.out.getvalue()
         self.assertTrue("Skipping deleting archived offers" in output)
 
+    def test_streaming_compressor(self):
+        data = b"".join(b"line %d\n" % i for i in range(1000))
+
+        output = io.BytesIO()
+        with patch.object(StreamingCompressor, "BLOCK_SIZE", 1000):
+            compressor = StreamingCompressor(output, threads=3)
+            compressor.write(data[:2500])
+            compressor.write(data[2500:].decode("utf-8"))
+            compressor.close()
+
+        self.assertEqual(compressor.lines, 1000)
+        self.assertEqual(compressor.md5.hexdigest(), md5(output.getvalue()).hexdigest())
+        # The blocks are compressed separately but decompress to the original
+        self.assertEqual(bz2.decompress(output.getvalue()), data)
+
+    @override_settings(BACKUPS_STORAGE="django.core.files.storage.FileSystemStorage")
+    @patch("adserver.management.commands.archive_offers.connections")
+    def test_archive_offers_stream(self, conn_mock):
+        def copy_expert(query, fd):
+            fd.write(b"id,date\n1,2022-01-01\n2,2022-01-01\n")
+
+        cursor = conn_mock.__getitem__().cursor().__enter__()
+        cursor.copy_expert.side_effect = copy_expert
+
+        management.call_command(
+            "archive_offers",
+            "--stream",
+            "-w",
+            "2",
+            "-s",
+            "2022-01-01",
+            "-e",
+            "2022-01-03",
+            stdout=self.out,
+            stderr=self.err,
+        )
+
+        output = self.out.getvalue()
+        self.assertEqual(output.count("Successfully archived"), 3)
+        self.assertEqual(output.count("Successfully copied"), 3)
+        self.assertTrue("2022-01-02-offers.csv.bz2: 3 lines" in output)
+        self.assertEqual(cursor.copy_expert.call_count, 3)
+
+        # The offers are uploaded without being written to the output dir
+        self.assertTrue("Archiving 2022-01-02 to backups" in output)
+        self.assertFalse(".csv.bz2..." in output)
+
+    @patch("adserver.management.commands.archive_offers.connections")
+    def test_archive_offers_stream_no_storage(self, conn_mock):
+        def copy_expert(query, fd):
+            fd.write(b"id,date\n1,2022-01-01\n")
+
+        cursor = conn_mock.__getitem__().cursor().__enter__()
+        cursor.copy_expert.side_effect = copy_expert
+
+        with override_settings():
+            del settings.BACKUPS_STORAGE
+            management.call_command(
+                "archive_offers",
+                "--stream",
+                "-s",
+                "2022-01-01",
+                "-e",
+                "2022-01-02",
+                stdout=self.out,
+                stderr=self.err,
+            )
+
+        # Without backups storage, the offers are kept in the output dir
+        output = self.out.getvalue()
+        self.assertEqual(output.count("Successfully archived"), 2)
+        self.assertEqual(output.count("Successfully copied"), 0)
+        self.assertTrue("Skipping copying offers to backups" in output)
+        self.assertTrue("2022-01-01-offers.csv.bz2..." in output)
+
+    @override_settings(
+        ADSERVER_OFFER_DB_TABLE="adserver_offer",
+        BACKUPS_STORAGE="django.core.files.storage.FileSystemStorage",
+    )
+    @patch("adserver.management.commands.archive_offers.connections")
+    def test_archive_offers_delete_batches(self, conn_mock):
+        cursor = conn_mock.__getitem__().cursor().__enter__()
+        # Batches are deleted until there are none left
+        # even if a batch is short because some offers were locked
+        type(cursor).rowcount = PropertyMock(side_effect=[2, 1, 0])
+        cursor.fetchone.return_value = (1,)
+
+        with patch(
+            "adserver.management.commands.archive_offers.Command.get_partitions",
+            return_value={"adserver_offer_2022_02", "adserver_offer_2022_03"},
+        ):
+            management.call_command(
+                "archive_offers",
+                "-d",
+                "--drop-partitions",
+                "--delete-batch-size",
+                "2",
+                "--delete-sleep",
+                "0",
+                "-s",
+                "2022-02-01",
+                "-e",
+                "2022-03-01",
+                stdout=self.out,
+                stderr=self.err,
+            )
+
+        output = self.out.getvalue()
+
+        # All of February was archived so its partition is dropped
+        self.assertTrue("Successfully dropped adserver_offer_2022_02" in output)
+        self.assertFalse("adserver_offer_2022_03" in output)
+        queries = [c[0][0] for c in cursor.execute.call_args_list]
+        self.assertIn(
+            "ALTER TABLE adserver_offer DETACH PARTITION adserver_offer_2022_02",
+            queries,
+        )
+
+        # Only part of March was archived so those offers are deleted in batches
+        self.assertEqual(output.count("Deleting archived offers"), 1)
+        self.assertTrue("Successfully removed 3 offers" in output)
+        self.assertTrue("1 locked offers for 2022-03-01 were not deleted" in output)
+        # The date range stays on the delete so only the day's partition is scanned
+        day = datetime.date(2022, 3, 1)
+        end_day = datetime.date(2022, 3, 2)
+        self.assertEqual(
+            cursor.execute.call_args_list[-3][0],
+            (
+                "DELETE FROM adserver_offer WHERE date >= %s AND date < %s AND id IN ("
+                "SELECT id FROM adserver_offer WHERE date >= %s AND date < %s LIMIT %s"
+                " FOR UPDATE SKIP LOCKED)",
+                [day, end_day, day, end_day, 2],
+            ),
+        )
+
     @override_settings(BACKUPS_STORAGE="django.core.files.storage.FileSystemStorage")
-    @patch("django.db.connections")
+    @patch("adserver.management.commands.archive_offers.connections")
     def test_archive_offers_storage(self, conn_mock):
+        conn_mock.__getitem__().cursor().__enter__().rowcount = 0
+
         management.call_command(
             "archive_offers",
             "-d",
@@ -160,3 +310,127 @@ class TestArchiveOffers(TestCase):
 
         output = self.out.getvalue()
         self.assertTrue("already exists in backups" in output)
+
+
+class TestBackfillReports(BaseAdModelsTestCase):
+    def setUp(self):
+        super().setUp()
+
+        self.out = io.StringIO()
+        self.err = io.StringIO()
+
+        for day in ("2022-03-01", "2022-03-02", "2022-03-02", "2022-03-04"):
+            get(
+                Offer,
+                date=timezone.make_aware(datetime.datetime.fromisoformat(day)),
+                advertisement=self.ad1,
+                publisher=self.publisher,
+                country="CA",
+                viewed=True,
+            )
+
+    def test_backfill_reports_errors(self):
+        with self.assertRaises(management.CommandError):
+            management.call_command(
+                "backfill_reports",
+                "-s",
+                "2022-03-04",
+                "-e",
+                "2022-03-01",
+                stdout=self.out,
+                stderr=self.err,
+            )
+
+        with self.assertRaises(management.CommandError):
+            management.call_command(
+                "backfill_reports",
+                "-s",
+                "2022-03-01",
+                "-e",
+                "2022-03-04",
+                "-i",
+                "not-an-index",
+                stdout=self.out,
+                stderr=self.err,
+            )
+
+    def test_backfill_reports(self):
+        management.call_command(
+            "backfill_reports",
+            "-s",
+            "2022-03-01",
+            "-e",
+            "2022-03-04",
+            "-i",
+            "geos",
+            "-c",
+            "3",
+            stdout=self.out,
+            stderr=self.err,
+        )
+
+        output = self.out.getvalue()
+        self.assertTrue("[4/4]" in output)
+        self.assertTrue("2022-03-02: 2 offers" in output)
+        self.assertTrue("Successfully backfilled 4 days (4 offers)" in output)
+
+        self.assertEqual(
+            list(GeoImpression.objects.order_by("date").values_list("date", "views")),
+            [
+                (datetime.date(2022, 3, 1), 1),
+                (datetime.date(2022, 3, 2), 2),
+                (datetime.date(2022, 3, 4), 1),
+            ],
+        )
+        # Only the requested index is backfilled
+        self.assertFalse(RegionImpression.objects.exists())
+
+
+class TestOfferPartitions(TestCase):
+    def setUp(self):
+        self.out = io.StringIO()
+        self.err = io.StringIO()
+
+    def test_create_partition_sql(self):
+        self.assertEqual(
+            get_create_partition_sql("adserver_offer", datetime.date(2022, 12, 1)),
+            "CREATE TABLE IF NOT EXISTS adserver_offer_2022_12 PARTITION OF adserver_offer "
+            "FOR VALUES FROM ('2022-12-01') TO ('2023-01-01')",
+        )
+
+    def test_offer_partitions_errors(self):
+        # SQLite tables are never partitioned
+        with self.assertRaises(management.CommandError):
+            management.call_command(
+                "offer_partitions", stdout=self.out, stderr=self.err
+            )
+
+    @patch("adserver.partitions.datetime")
+    def test_offer_partitions_dry_run(self, datetime_mock):
+        datetime_mock.date.today.return_value = datetime.date(2022, 11, 15)
+        datetime_mock.date.side_effect = datetime.date
+        datetime_mock.timedelta = datetime.timedelta
+
+        management.call_command(
+            "offer_partitions",
+            "--table",
+            "adserver_offer_partitioned",
+            "--create-like",
+            "adserver_offer",
+            "--start-date",
+            "2022-10-20",
+            "--months-ahead",
+            "2",
+            "--dry-run",
+            stdout=self.out,
+            stderr=self.err,
+        )
+
+        output = self.out.getvalue()
+        self.assertTrue("PARTITION BY RANGE (date)" in output)
+        for month in ("2022_10", "2022_11", "2022_12", "2023_01"):
+            self.assertTrue(
+                f"Would create partition adserver_offer_partitioned_{month}" in output
+            )
+        self.assertFalse("adserver_offer_partitioned_2023_02" in output)
+        self.assertTrue("Successfully created 4 partitions" in output)
@@ -1,15 +1,21 @@
 import datetime
+from unittest import mock
 
+from django.db import connection
 from django.db import IntegrityError
+from django.db import transaction
 from django.test import override_settings
+from django.test.utils import CaptureQueriesContext
 from django.utils import timezone
 from django_dynamic_fixture import get
 
 from ..constants import CLICKS
+from ..constants import DECISIONS
 from ..constants import FLIGHT_STATE_CURRENT
 from ..constants import FLIGHT_STATE_PAST
 from ..constants import FLIGHT_STATE_UPCOMING
 from ..constants import VIEWS
+from ..counters import impression_counter
 from ..models import AdImpression
 from ..models import AdType
 from ..models import Advertisement
@@ -184,6 +190,41 @@ class TestAdModels(BaseAdModelsTestCase):
             self.flight.show_on_domain("https://example.com/path/to/resource")
         )
 
+    def test_compiled_targeting(self):
+        self.flight.targeting_parameters = {
+            "include_countries": ["US", "CA"],
+            "include_regions": ["us-ca", "unknown-region"],
+            "exclude_keywords": ["rails"],
+            "include_topics": ["backend-web", "unknown-topic"],
+        }
+        self.flight.save()
+
+        targeting = self.flight.targeting
+        self.assertEqual(targeting.included_countries, {"US", "CA"})
+        self.assertEqual(targeting.included_region_countries, {"US", "CA"})
+        self.assertEqual(targeting.excluded_region_countries, None)
+        self.assertEqual(targeting.excluded_keywords, {"rails"})
+        self.assertIn("django", targeting.included_topic_keywords)
+        self.assertNotIn("javascript", targeting.included_topic_keywords)
+
+        # Compiled only once while the targeting is unchanged
+        self.assertIs(self.flight.targeting, targeting)
+        self.assertTrue(targeting.show_to_keywords({"django"}))
+        self.assertFalse(targeting.show_to_keywords({"django", "rails"}))
+
+        # Changing the targeting in place recompiles it
+        self.flight.targeting_parameters["include_countries"].append("DE")
+        self.assertIsNot(self.flight.targeting, targeting)
+        self.assertEqual(self.flight.targeting.included_countries, {"US", "CA", "DE"})
+
+        # Only unknown regions or topics match nothing
+        self.flight.targeting_parameters = {
+            "include_regions": ["unknown-region"],
+            "include_topics": ["unknown-topic"],
+        }
+        self.assertFalse(self.flight.show_to_geo(GeolocationData("US")))
+        self.assertFalse(self.flight.show_to_keywords(["django"]))
+
     def test_start_date_math(self):
         self.flight.start_date = get_ad_day().date() - datetime.timedelta(days=14)
         self.flight.end_date = self.flight.start_date + datetime.timedelta(days=30)
@@ -535,6 +576,174 @@ class TestAdModels(BaseAdModelsTestCase):
         offer = Offer.objects.get(pk=output["nonce"])
         self.assertIsNotNone(offer.user_agent)
 
+    @override_settings(ADSERVER_COUNTER_FLUSH_INTERVAL=60)
+    def test_impression_counter(self):
+        # Counts are added once the request's transaction commits
+        with self.captureOnCommitCallbacks(execute=True):
+            self.ad1.incr(VIEWS, self.publisher)
+            self.ad1.incr(VIEWS, self.publisher)
+            self.ad1.incr(CLICKS, self.publisher)
+            Advertisement.incr(
+                self=None, impression_type=DECISIONS, publisher=self.publisher
+            )
+
+        # Nothing is written until the counts are flushed
+        self.assertFalse(AdImpression.objects.filter(publisher=self.publisher).exists())
+        self.flight.refresh_from_db()
+        self.assertEqual(self.flight.total_views, 0)
+
+        # Counts that haven't been written are included
+        self.assertEqual(self.flight.views_today(), 2)
+        self.assertEqual(self.flight.clicks_today(), 1)
+        self.assertEqual(
+            impression_counter.get_pending_flight_totals(self.flight.pk), (1, 2)
+        )
+
+        impression_counter.flush()
+        impression = self.ad1.impressions.get(publisher=self.publisher)
+        self.assertEqual(impression.views, 2)
+        self.assertEqual(impression.clicks, 1)
+        null_impression = AdImpression.objects.get(
+            publisher=self.publisher, advertisement=None
+        )
+        self.assertEqual(null_impression.decisions, 1)
+        self.flight.refresh_from_db()
+        self.assertEqual(self.flight.total_views, 2)
+        self.assertEqual(self.flight.total_clicks, 1)
+        self.assertEqual(self.flight.views_today(), 2)
+
+        # Counts are added to the existing impressions when they're due
+        with self.captureOnCommitCallbacks(execute=True):
+            self.ad1.incr(VIEWS, self.publisher)
+        impression_counter.started -= 60
+        impression_counter.flush_if_needed()
+        impression.refresh_from_db()
+        self.assertEqual(impression.views, 3)
+        self.assertEqual(
+            impression_counter.get_pending_flight_totals(self.flight.pk), (0, 0)
+        )
+
+        # Counting doesn't write anything during the request
+        # The counts are flushed by a background thread
+        self.assertTrue(impression_counter.thread.is_alive())
+
+    @override_settings(ADSERVER_COUNTER_FLUSH_INTERVAL=60)
+    def test_impression_counter_failed_flush(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            self.ad1.incr(VIEWS, self.publisher)
+            self.ad1.incr(CLICKS, self.publisher)
+
+        def bulk_upsert(*args, **kwargs):
+            # The counts being written are still pending for pacing
+            self.assertEqual(
+                impression_counter.get_pending_flight_totals(self.flight.pk), (1, 1)
+            )
+            self.assertEqual(self.flight.views_today(), 1)
+            raise IntegrityError
+
+        with mock.patch.object(
+            AdImpression, "bulk_upsert", side_effect=bulk_upsert
+        ), self.assertRaises(IntegrityError):
+            impression_counter.flush()
+
+        # The counts are kept to be written with the next flush
+        self.assertEqual(
+            impression_counter.get_pending_flight_totals(self.flight.pk), (1, 1)
+        )
+        self.assertFalse(AdImpression.objects.filter(publisher=self.publisher).exists())
+
+        impression_counter.flush()
+        impression = self.ad1.impressions.get(publisher=self.publisher)
+        self.assertEqual(impression.views, 1)
+        self.assertEqual(impression.clicks, 1)
+        self.flight.refresh_from_db()
+        self.assertEqual(self.flight.total_views, 1)
+
+    @override_settings(ADSERVER_COUNTER_FLUSH_INTERVAL=60)
+    def test_impression_counter_rollback(self):
+        # Impressions from a request that is rolled back aren't counted
+        with self.captureOnCommitCallbacks(execute=True):
+            with self.assertRaises(IntegrityError), transaction.atomic():
+                self.ad1.incr(VIEWS, self.publisher)
+                raise IntegrityError
+
+        self.assertEqual(
+            impression_counter.get_pending_flight_totals(self.flight.pk), (0, 0)
+        )
+
+    def test_impression_bulk_upsert(self):
+        day = get_ad_day().date()
+        fields = ("publisher_id", "advertisement_id", "date")
+        rows = [
+            {
+                "publisher_id": self.publisher.pk,
+                "advertisement_id": ad_id,
+                "date": day,
+                "decisions": 1,
+                "offers": 1 if ad_id else 0,
+                "views": 1,
+                "clicks": 0,
+            }
+            for ad_id in (self.ad1.pk, self.ad1.pk, None)
+        ]
+
+        # Duplicate rows are added together when incrementing
+        AdImpression.bulk_upsert(rows, fields, ("decisions", "offers", "views"), True)
+        impression = self.ad1.impressions.get(publisher=self.publisher, date=day)
+        self.assertEqual(impression.decisions, 2)
+        self.assertEqual(impression.views, 2)
+        null_impression = AdImpression.objects.get(
+            publisher=self.publisher, advertisement=None, date=day
+        )
+        self.assertEqual(null_impression.decisions, 1)
+        self.assertEqual(null_impression.offers, 0)
+
+        # Existing impressions are incremented
+        AdImpression.bulk_upsert(rows, fields, ("decisions", "offers", "views"), True)
+        impression.refresh_from_db()
+        self.assertEqual(impression.decisions, 4)
+        null_impression.refresh_from_db()
+        self.assertEqual(null_impression.decisions, 2)
+
+        # Or replaced
+        AdImpression.bulk_upsert(rows[1:], fields, ("decisions", "clicks"))
+        impression.refresh_from_db()
+        self.assertEqual(impression.decisions, 1)
+        self.assertEqual(impression.views, 4)
+        null_impression.refresh_from_db()
+        self.assertEqual(null_impression.decisions, 1)
+        self.assertEqual(AdImpression.objects.filter(date=day).count(), 2)
+
+    def test_impression_bulk_upsert_null_advertisement(self):
+        day = get_ad_day().date()
+        fields = ("publisher_id", "advertisement_id", "date")
+        rows = [
+            {
+                "publisher_id": self.publisher.pk,
+                "advertisement_id": None,
+                "date": day,
+                "decisions": 1,
+            }
+        ]
+
+        # Impressions without an ad are upserted on the partial unique constraint
+        self.assertTrue(
+            AdImpression._has_null_constraint(fields, ("advertisement_id",))
+        )
+        self.assertFalse(AdImpression._has_null_constraint(fields, ("publisher_id",)))
+
+        for _ in range(2):
+            with CaptureQueriesContext(connection) as queries:
+                AdImpression.bulk_upsert(rows, fields, ("decisions",), True)
+            self.assertEqual(len(queries), 1)
+            self.assertIn("ON CONFLICT", queries[0]["sql"])
+
+        null_impression = AdImpression.objects.get(
+            publisher=self.publisher, advertisement=None, date=day
+        )
+        self.assertEqual(null_impression.decisions, 2)
+        self.assertEqual(AdImpression.objects.filter(date=day).count(), 1)
+
     def test_refund(self):
         request = self.factory.get("/")
 
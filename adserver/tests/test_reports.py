@@ -4,11 +4,13 @@ from unittest.mock import patch
 from django.contrib.auth import get_user_model
 from django.contrib.auth.models import Permission
 from django.contrib.contenttypes.models import ContentType
+from django.test import override_settings
 from django.test import TestCase
 from django.test.client import RequestFactory
 from django.urls import reverse
 from django_dynamic_fixture import get
 
+from ..aggregation import DAILY_AGGREGATORS
 from ..constants import CLICKS
 from ..constants import COMMUNITY_CAMPAIGN
 from ..constants import HOUSE_CAMPAIGN
@@ -22,8 +24,13 @@ from ..models import Campaign
 from ..models import Flight
 from ..models import Offer
 from ..models import Publisher
+from ..models import RegionTopicImpression
+from ..reports import AdvertiserPublisherReport
 from ..reports import AdvertiserReport
+from ..reports import invalidate_report_cache
+from ..reports import PublisherAdvertiserReport
 from ..reports import PublisherGeoReport
+from ..reports import PublisherRegionTopicReport
 from ..reports import PublisherReport
 from ..tasks import daily_update_geos
 from ..tasks import daily_update_impressions
@@ -999,22 +1006,129 @@ class TestReportClasses(TestReportsBase):
         self.assertAlmostEqual(report.total["ctr"], 100 * 1 / 4)
         self.assertAlmostEqual(report.total["ecpm"], calculate_ecpm(2.0, 4))
 
+    def test_reports_aggregated_in_database(self):
+        Publisher.objects.filter(pk=self.publisher1.pk).update(
+            revenue_share_percentage=70.0
+        )
+        Publisher.objects.filter(pk=self.publisher2.pk).update(
+            revenue_share_percentage=50.0
+        )
+        self.ad1.incr(VIEWS, self.publisher2)
+        self.ad1.incr(CLICKS, self.publisher2)
+
+        # One query for the sums by index and one for the indexed objects
+        report = PublisherAdvertiserReport(AdImpression.objects.all())
+        with self.assertNumQueries(2):
+            report.generate()
+
+        self.assertEqual(len(report.results), 1)
+        result = report.results[0]
+        self.assertEqual(result["index"], self.advertiser1)
+        self.assertEqual(
+            result["advertisement.flight.campaign.advertiser"], self.advertiser1
+        )
+        self.assertEqual(result["views"], 5)
+        self.assertEqual(result["clicks"], 2)
+        self.assertEqual(result["paid_offers"], 0)
+        self.assertAlmostEqual(result["revenue"], 4.0)
+        # Each publisher's revenue share applies to their own revenue
+        self.assertAlmostEqual(result["revenue_share"], 2.0 * 0.7 + 2.0 * 0.5)
+        self.assertAlmostEqual(result["our_revenue"], 4.0 - 2.4)
+        self.assertAlmostEqual(result["ctr"], 40.0)
+        self.assertAlmostEqual(report.total["revenue_share"], 2.4)
+
+        report = PublisherReport(AdImpression.objects.all(), force_revshare=60)
+        report.generate()
+        self.assertAlmostEqual(report.total["revenue_share"], 4.0 * 0.6)
+
+        report = AdvertiserPublisherReport(AdImpression.objects.all())
+        report.generate()
+        self.assertEqual(
+            [(result["publisher"], result["views"]) for result in report.results],
+            [(self.publisher1, 4), (self.publisher2, 1)],
+        )
+        self.assertAlmostEqual(report.total["cost"], 4.0)
+
+    def test_region_topic_report_revshare(self):
+        get(
+            RegionTopicImpression,
+            region="us-ca",
+            topic="python",
+            advertisement=self.ad1,
+            date=get_ad_day().date(),
+            views=1000,
+            clicks=1,
+        )
+
+        # Region/topic impressions have no publisher so the default revshare applies
+        report = PublisherRegionTopicReport(RegionTopicImpression.objects.all())
+        report.generate()
+        self.assertEqual(report.results[0]["index"], "us-ca:python")
+        self.assertGreater(report.total["revenue"], 0)
+        self.assertAlmostEqual(
+            report.total["revenue_share"], report.total["revenue"] * 0.7
+        )
+
+        report = PublisherRegionTopicReport(
+            RegionTopicImpression.objects.all(), force_revshare=60
+        )
+        report.generate()
+        self.assertAlmostEqual(
+            report.total["revenue_share"], report.total["revenue"] * 0.6
+        )
+
+    @override_settings(ADSERVER_REPORT_CACHE_TIMEOUT=60 * 60)
+    def test_report_cache(self):
+        yesterday = get_ad_day().date() - datetime.timedelta(days=1)
+        AdImpression.objects.filter(advertisement=self.ad1).update(date=yesterday)
+        queryset = AdImpression.objects.filter(
+            publisher=self.publisher1, date__lte=yesterday
+        )
+        invalidate_report_cache()
+
+        report = PublisherReport(queryset)
+        with self.assertNumQueries(1):
+            report.generate()
+        self.assertEqual(report.total["views"], 4)
+
+        # Past days are served from the cache
+        AdImpression.objects.filter(advertisement=self.ad1).update(views=10)
+        report = PublisherReport(queryset)
+        with self.assertNumQueries(0):
+            report.generate()
+        self.assertEqual(report.total["views"], 4)
+
+        # A different index, order or revshare are different results
+        report = PublisherReport(queryset, index="publisher")
+        with self.assertNumQueries(2):
+            report.generate()
+        self.assertEqual(report.total["views"], 10)
+
+        # Refunds and aggregating the indexes invalidate cached reports
+        invalidate_report_cache()
+        report = PublisherReport(queryset)
+        report.generate()
+        self.assertEqual(report.total["views"], 10)
+
+        # Anything including today is only cached briefly
+        with patch("adserver.reports.cache.set") as cache_set:
+            report = PublisherReport(AdImpression.objects.filter(date__lte=yesterday))
+            report.generate()
+            self.assertEqual(cache_set.call_args[0][2], 60 * 60)
+
+            self.ad1.incr(VIEWS, self.publisher1)
+            report = PublisherReport(AdImpression.objects.all())
+            report.generate()
+            self.assertEqual(
+                cache_set.call_args[0][2], PublisherReport.CACHE_TIMEOUT_TODAY
+            )
+
 
 class TestReportTasks(TestReportsBase):
     def test_index_all_reports(self):
-        with patch("adserver.tasks.daily_update_geos") as patched_geos, patch(
-            "adserver.tasks.daily_update_keywords"
-        ) as patched_keywords, patch(
-            "adserver.tasks.daily_update_placements"
-        ) as patched_placements, patch(
-            "adserver.tasks.daily_update_uplift"
-        ) as patched_uplift:
+        with patch("adserver.tasks.aggregate_offers") as patched_aggregate:
             update_previous_day_reports()
 
+            # All the indexes are updated with a single pass over the offers
             yesterday = get_ad_day() - datetime.timedelta(days=1)
-            patched_geos.assert_called_with(yesterday)
-
-            self.assertTrue(patched_geos.called)
-            self.assertTrue(patched_keywords.called)
-            self.assertTrue(patched_placements.called)
-            self.assertTrue(patched_uplift.called)
+            patched_aggregate.assert_called_once_with(yesterday, DAILY_AGGREGATORS)
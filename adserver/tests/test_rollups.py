@@ -0,0 +1,65 @@
+import datetime
+import tempfile
+
+from django.core.files.storage import FileSystemStorage
+from django_dynamic_fixture import get
+
+from ..aggregation import AGGREGATORS_BY_NAME
+from ..models import GeoImpression
+from ..rollups import RollupStore
+from .common import BaseAdModelsTestCase
+
+
+class TestRollups(BaseAdModelsTestCase):
+    def setUp(self):
+        super().setUp()
+
+        self.tempdir = tempfile.TemporaryDirectory()
+        self.store = RollupStore(FileSystemStorage(location=self.tempdir.name))
+
+        self.day1 = datetime.date(2022, 3, 1)
+        self.day2 = datetime.date(2022, 3, 2)
+        for day, country, ad, views in (
+            (self.day1, "US", self.ad1, 10),
+            (self.day1, "CA", self.ad1, 5),
+            (self.day1, "US", self.ad2, 1),
+            (self.day2, "US", self.ad1, 20),
+        ):
+            get(
+                GeoImpression,
+                date=day,
+                publisher=self.publisher,
+                advertisement=ad,
+                country=country,
+                decisions=views,
+                offers=views,
+                views=views,
+                clicks=1,
+            )
+
+    def tearDown(self):
+        self.tempdir.cleanup()
+
+    def test_write_day(self):
+        paths = self.store.write_day(self.day1, indexes=["geos"])
+        self.assertEqual(paths, ["rollups/geos/2022-03-01.json.gz"])
+
+        columns = self.store.read_day("geos", self.day1)
+        self.assertEqual(sorted(columns["country"]), ["CA", "US", "US"])
+        self.assertEqual(sum(columns["views"]), 16)
+        self.assertEqual(set(columns["advertisement_id"]), {self.ad1.pk, self.ad2.pk})
+
+        # Every index is written by default
+        paths = self.store.write_day(self.day2)
+        self.assertEqual(len(paths), len(AGGREGATORS_BY_NAME))
+        self.assertEqual(self.store.read_day("geos", self.day2)["views"], [20])
+
+        # Writing a day again replaces its rollups
+        GeoImpression.objects.filter(date=self.day2).update(views=30)
+        self.store.write_day(self.day2, indexes=["geos"])
+        self.assertEqual(self.store.read_day("geos", self.day2)["views"], [30])
+
+        # Days without impressions still have a rollup
+        day3 = self.day2 + datetime.timedelta(days=1)
+        self.store.write_day(day3, indexes=["geos"])
+        self.assertEqual(self.store.read_day("geos", day3)["views"], [])
@@ -2,8 +2,11 @@ from datetime import timedelta
 from unittest.mock import patch
 
 from django.contrib.auth import get_user_model
+from django.core.cache import cache
+from django.db import connection
 from django.test import override_settings
 from django.test import TestCase
+from django.test.utils import CaptureQueriesContext
 from django.urls import reverse
 from django.utils import timezone
 from django_dynamic_fixture import get
@@ -15,6 +18,8 @@ from ..models import Offer
 from ..models import Publisher
 from ..models import PublisherGroup
 from ..models import PublisherPayout
+from ..payouts import generate_publisher_payout_data
+from ..payouts import generate_publishers_payout_data
 from ..staff.forms import CreateAdvertiserForm
 from ..staff.forms import CreatePublisherForm
 from ..staff.forms import StartPublisherPayoutForm
@@ -285,6 +290,55 @@ class PublisherPayoutTests(TestCase):
         self.assertContains(list_response, "<td>$70.00</td>")
         self.assertContains(list_response, f"{self.publisher1.name}</a></td>")
 
+    def test_bulk_payout_data(self):
+        self.addCleanup(cache.clear)
+        get(
+            PublisherPayout,
+            amount=10,
+            publisher=self.publisher2,
+            status="paid",
+            date=timezone.now() - timedelta(days=70),
+        )
+        publishers = [self.publisher1, self.publisher2]
+
+        data = generate_publishers_payout_data(publishers)
+        for publisher in publishers:
+            expected = generate_publisher_payout_data(
+                publisher, include_current_report=False
+            )
+            # These are the time the data was generated
+            for field in ("today", "end_date"):
+                data[publisher].pop(field)
+                expected.pop(field)
+            self.assertEqual(data[publisher], expected)
+        self.assertEqual(
+            data[self.publisher1]["due_report"]["total"]["revenue_share"], 70
+        )
+
+        # The number of queries doesn't depend on the number of publishers
+        url = reverse("staff-publisher-payouts")
+        self.client.force_login(self.staff_user)
+        cache.clear()
+        with CaptureQueriesContext(connection) as queries:
+            self.client.get(url)
+        for _ in range(3):
+            get(
+                PublisherPayout,
+                amount=10,
+                publisher=get(Publisher, skip_payouts=False),
+                status="paid",
+                date=timezone.now() - timedelta(days=40),
+            )
+        cache.clear()
+        with CaptureQueriesContext(connection) as more_publisher_queries:
+            self.client.get(url)
+        self.assertEqual(len(more_publisher_queries), len(queries))
+
+        # The balances due are cached so payouts can be finished
+        with CaptureQueriesContext(connection) as cached_queries:
+            self.client.get(url)
+        self.assertLess(len(cached_queries), len(queries))
+
     @override_settings(FRONT_TOKEN="test", FRONT_CHANNEL="test", FRONT_AUTHOR="test")
     @patch("adserver.staff.forms.requests.request")
     def test_create_view(self, mock_request):
@@ -1,19 +1,30 @@
 import datetime
+from unittest import mock
 
 from django.contrib.auth.models import AnonymousUser
 from django.core import mail
+from django.core.cache import cache
 from django.test import override_settings
+from django.utils import timezone
 from django_dynamic_fixture import get
 from django_slack.utils import get_backend
 
+from ..aggregation import aggregate_offers
+from ..aggregation import HIGH_WATER_MARK_CACHE_KEY
+from ..aggregation import update_rollups
+from ..constants import PAID_CAMPAIGN
 from ..models import AdImpression
+from ..models import Flight
+from ..models import FlightImpression
 from ..models import GeoImpression
 from ..models import KeywordImpression
 from ..models import Offer
 from ..models import PlacementImpression
+from ..models import PublisherMonthlyImpression
 from ..models import RegionImpression
 from ..models import RegionTopicImpression
 from ..models import UpliftImpression
+from ..reports import PublisherMonthlyReport
 from ..tasks import calculate_publisher_ctrs
 from ..tasks import daily_update_geos
 from ..tasks import daily_update_impressions
@@ -24,6 +35,7 @@ from ..tasks import daily_update_uplift
 from ..tasks import notify_of_completed_flights
 from ..tasks import notify_of_publisher_changes
 from ..tasks import remove_old_client_ids
+from ..tasks import update_today_reports
 from .common import BaseAdModelsTestCase
 
 
@@ -59,6 +71,7 @@ class TasksTest(BaseAdModelsTestCase):
         self.assertIsNone(offer.client_id)
 
     def test_calculate_publisher_ctrs(self):
+        self.addCleanup(cache.delete, Flight.SAMPLED_CTRS_CACHE_KEY)
         calculate_publisher_ctrs()
 
         self.publisher.refresh_from_db()
@@ -78,10 +91,33 @@ class TasksTest(BaseAdModelsTestCase):
         )
 
         daily_update_impressions()
+        history_count = self.publisher.history.count()
         calculate_publisher_ctrs()
 
         self.publisher.refresh_from_db()
         self.assertEqual(self.publisher.sampled_ctr, 20)
+        # Only ``sampled_ctr`` is updated without a history record
+        self.assertEqual(self.publisher.history.count(), history_count)
+
+        # Not enough views to sample the flight CTRs
+        self.assertEqual(Flight.get_sampled_ctrs(), {})
+
+        calculate_publisher_ctrs(min_views=5, record_history=True)
+        self.assertEqual(
+            Flight.get_sampled_ctrs(),
+            {self.flight.pk: 20, (self.publisher.pk, self.flight.pk): 20},
+        )
+        # The CTR didn't change so there's nothing to update
+        self.assertEqual(self.publisher.history.count(), history_count)
+
+        # The flight's CTR on the publisher is preferred over the publisher's CTR
+        self.flight.cpc = 0.01
+        self.publisher.sampled_ctr = 0.05
+        self.assertAlmostEqual(self.flight.price_priority_value(self.publisher), 1.0)
+        self.assertAlmostEqual(
+            self.flight.price_priority_value(self.publisher, Flight.get_sampled_ctrs()),
+            2.0,
+        )
 
     @override_settings(
         # Use the memory email backend instead of front for testing
@@ -308,6 +344,84 @@ class AggregationTaskTests(BaseAdModelsTestCase):
         self.assertEqual(ai2.clicks, 0)
         self.assertEqual(ai2.view_time, 8)
 
+    def test_update_rollups(self):
+        daily_update_impressions()
+
+        # Running it again for the day doesn't count anything twice
+        update_rollups()
+
+        today = timezone.now().date()
+        monthly = PublisherMonthlyImpression.objects.get(
+            publisher=self.publisher, campaign_type=PAID_CAMPAIGN
+        )
+        self.assertEqual(monthly.date, today.replace(day=1))
+        self.assertEqual(monthly.decisions, 6)
+        self.assertEqual(monthly.offers, 6)
+        self.assertEqual(monthly.views, 5)
+        self.assertEqual(monthly.clicks, 1)
+        self.assertAlmostEqual(monthly.revenue, 2.0)
+
+        daily = FlightImpression.objects.get(flight=self.flight)
+        self.assertEqual(daily.date, today)
+        self.assertEqual(daily.offers, 6)
+        self.assertEqual(daily.views, 5)
+        self.assertEqual(daily.clicks, 1)
+        self.assertAlmostEqual(daily.revenue, 2.0)
+
+        report = PublisherMonthlyReport(
+            PublisherMonthlyImpression.objects.filter(publisher=self.publisher)
+        )
+        report.generate()
+        self.assertEqual(report.total["views"], 5)
+        self.assertAlmostEqual(report.total["revenue"], 2.0)
+        self.assertAlmostEqual(
+            report.total["revenue_share"],
+            2.0 * self.publisher.revenue_share_percentage / 100.0,
+        )
+
+        # Refunds are taken out of the rollups
+        self.flight.total_views = 5
+        self.flight.total_clicks = 1
+        self.flight.save()
+        Offer.objects.get(clicked=True).refund()
+        monthly.refresh_from_db()
+        self.assertEqual(monthly.offers, 5)
+        self.assertEqual(monthly.views, 4)
+        self.assertEqual(monthly.clicks, 0)
+        self.assertAlmostEqual(monthly.revenue, 0)
+        daily.refresh_from_db()
+        self.assertEqual(daily.views, 4)
+        self.assertAlmostEqual(daily.revenue, 0)
+
+    @override_settings(ADSERVER_REPORT_CACHE_TIMEOUT=60 * 60)
+    def test_update_rollups_report_cache(self):
+        def get_monthly_views():
+            report = PublisherMonthlyReport(
+                PublisherMonthlyImpression.objects.filter(publisher=self.publisher)
+            )
+            report.generate()
+            return report.total["views"]
+
+        def read_report_and_update_rollups(day=None):
+            # A report read after the index is aggregated but before it is rolled up
+            self.assertEqual(get_monthly_views(), 0)
+            update_rollups(day)
+
+        with mock.patch(
+            "adserver.tasks.update_rollups", side_effect=read_report_and_update_rollups
+        ):
+            daily_update_impressions()
+
+        # Cached reports are invalidated after the rollups are written
+        self.assertEqual(get_monthly_views(), 5)
+
+        # Refunds invalidate them once the rollups are committed
+        self.flight.total_views = 5
+        self.flight.save()
+        with self.captureOnCommitCallbacks(execute=True):
+            Offer.objects.filter(viewed=True, clicked=False).first().refund()
+        self.assertEqual(get_monthly_views(), 4)
+
     def test_daily_update_keywords(self):
         # Ad1 - offered/decision=4, views=3, clicks=1
         # Ad2 - offered/decisions=2, views=2, clicks=0
@@ -485,3 +599,82 @@ class AggregationTaskTests(BaseAdModelsTestCase):
         self.assertEqual(pi2_ad2.offers, 2)
         self.assertEqual(pi2_ad2.views, 2)
         self.assertEqual(pi2_ad2.clicks, 0)
+
+    def test_aggregate_offers(self):
+        # Every index is updated from a single pass over the offers
+        # and running the aggregation again doesn't double count
+        aggregate_offers()
+        aggregate_offers()
+
+        ai1 = AdImpression.objects.get(publisher=self.publisher, advertisement=self.ad1)
+        self.assertEqual(ai1.offers, 4)
+        self.assertEqual(ai1.view_time, 16)
+
+        ki1 = KeywordImpression.objects.get(advertisement=self.ad1, keyword="backend")
+        self.assertEqual(ki1.offers, 4)
+        self.assertEqual(ki1.views, 3)
+
+        reg_ca_ad1 = RegionImpression.objects.get(
+            region="us-ca", advertisement=self.ad1
+        )
+        self.assertEqual(reg_ca_ad1.offers, 3)
+
+        self.assertEqual(
+            GeoImpression.objects.get(country="MX", advertisement=self.ad2).views, 2
+        )
+        self.assertEqual(
+            PlacementImpression.objects.get(
+                advertisement=self.ad1, div_id="id_1"
+            ).clicks,
+            1,
+        )
+        self.assertEqual(UpliftImpression.objects.get(advertisement=self.ad2).offers, 2)
+        self.assertEqual(
+            RegionTopicImpression.objects.get(
+                region="latin-america", topic="security-privacy", advertisement=self.ad2
+            ).offers,
+            2,
+        )
+
+    @override_settings(ADSERVER_AGGREGATION_DELAY=0)
+    def test_update_today_reports(self):
+        cache.delete(HIGH_WATER_MARK_CACHE_KEY)
+
+        # The first run of the day aggregates today so far
+        update_today_reports()
+        self.assertEqual(
+            GeoImpression.objects.get(country="CA", advertisement=self.ad1).offers, 3
+        )
+        self.assertEqual(
+            KeywordImpression.objects.get(advertisement=self.ad1).offers, 4
+        )
+        # AdImpressions are counted as offers happen rather than aggregated
+        self.assertFalse(AdImpression.objects.exists())
+
+        # Later runs only add the new offers
+        get(
+            Offer,
+            date=timezone.now(),
+            advertisement=self.ad1,
+            publisher=self.publisher,
+            country="CA",
+            viewed=True,
+            keywords=["backend"],
+            div_id="id_1",
+            ad_type_slug=self.text_ad_type.slug,
+        )
+        update_today_reports()
+        update_today_reports()
+
+        geo = GeoImpression.objects.get(country="CA", advertisement=self.ad1)
+        self.assertEqual(geo.offers, 4)
+        self.assertEqual(geo.views, 3)
+        self.assertEqual(
+            KeywordImpression.objects.get(advertisement=self.ad1).offers, 5
+        )
+        self.assertEqual(
+            PlacementImpression.objects.get(
+                advertisement=self.ad1, div_id="id_1"
+            ).offers,
+            4,
+        )
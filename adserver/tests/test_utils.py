@@ -1,5 +1,7 @@
 import datetime
+import os
 import re
+import tempfile
 from unittest import mock
 
 import pytz
@@ -16,15 +18,19 @@ from ..utils import calculate_ecpm
 from ..utils import generate_client_id
 from ..utils import get_ad_day
 from ..utils import get_client_id
+from ..utils import get_client_parsed_user_agent
 from ..utils import get_client_user_agent
 from ..utils import get_geoipdb_geolocation
 from ..utils import get_geolocation
+from ..utils import get_user_agent_cache_stats
 from ..utils import is_blocklisted_ip
 from ..utils import is_blocklisted_referrer
 from ..utils import is_blocklisted_user_agent
 from ..utils import is_click_ratelimited
 from ..utils import is_view_ratelimited
 from ..utils import parse_date_string
+from ..utils import parse_user_agent
+from ..utils import RegexBlocklist
 
 
 class UtilsTest(TestCase):
@@ -92,6 +98,61 @@ class UtilsTest(TestCase):
         regexes = [re.compile("this isn't found"), re.compile("neither is this")]
         self.assertFalse(is_blocklisted_referrer(referrer, regexes))
 
+    def test_parse_user_agent(self):
+        ua = (
+            "Mozilla/5.0 (Macintosh; Intel Mac OS X 10_13_6) "
+            "AppleWebKit/537.36 (KHTML, like Gecko) "
+            "Chrome/69.0.3497.100 Safari/537.36"
+        )
+        parse_user_agent.cache_clear()
+
+        request = self.factory.get("/", HTTP_USER_AGENT=ua)
+        parsed = get_client_parsed_user_agent(request)
+        self.assertEqual(parsed.browser.family, "Chrome")
+        self.assertEqual(parsed.os.family, "Mac OS X")
+        self.assertIs(get_client_parsed_user_agent(request), parsed)
+
+        # Parsed at most once per request and cached across requests
+        stats = get_user_agent_cache_stats()
+        self.assertEqual(stats["misses"], 1)
+        self.assertEqual(stats["hits"], 0)
+        request = self.factory.get("/", HTTP_USER_AGENT=ua)
+        self.assertIs(get_client_parsed_user_agent(request), parsed)
+        self.assertEqual(get_user_agent_cache_stats()["hits"], 1)
+
+        # The user agent can be overridden (eg. in the ad decision API)
+        request.user_agent = "Unrecognized UA"
+        self.assertEqual(get_client_parsed_user_agent(request).browser.family, "Other")
+
+    def test_regex_blocklist(self):
+        blocklist = RegexBlocklist(
+            ["Googlebot", re.compile(r"Headless\w+"), r"(?i)curl", r"(a)\1"]
+        )
+        self.assertEqual(blocklist.match("Mozilla/5.0 HeadlessChrome"), r"Headless\w+")
+        self.assertEqual(blocklist.match("compatible; Googlebot/2.1"), "Googlebot")
+        # Patterns that can't be combined are still matched
+        self.assertEqual(blocklist.match("CURL/7.1"), "(?i)curl")
+        self.assertEqual(blocklist.match("baa"), r"(a)\1")
+        self.assertIsNone(blocklist.match("Mozilla/5.0 Firefox"))
+        self.assertIsNone(blocklist.match(None))
+
+        with tempfile.NamedTemporaryFile("w", suffix=".txt") as fd:
+            fd.write("# Comment\n\nBadReferrer\n")
+            fd.flush()
+
+            blocklist = RegexBlocklist(["google.com"], filepath=fd.name)
+            self.assertEqual(blocklist.match("http://google.com"), "google.com")
+            self.assertEqual(blocklist.match("BadReferrer.com"), "BadReferrer")
+
+            # Changes to the file are reloaded
+            fd.write("AnotherReferrer\n")
+            fd.flush()
+            os.utime(fd.name, (0, 0))
+            self.assertIsNone(blocklist.match("AnotherReferrer.com"))
+            blocklist.reload_if_changed(force=True)
+            self.assertEqual(blocklist.match("AnotherReferrer.com"), "AnotherReferrer")
+            self.assertEqual(blocklist.match("BadReferrer.com"), "BadReferrer")
+
     def test_blocklisted_ip(self):
         ip = "1.1.1.1"
         self.assertFalse(is_blocklisted_ip(ip))
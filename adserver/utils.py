@@ -1,9 +1,12 @@
 """Ad server utilities."""
+import functools
 import hashlib
 import ipaddress
 import logging
 import os
 import re
+import threading
+import time
 from dataclasses import dataclass
 from datetime import date
 from datetime import datetime
@@ -16,12 +19,10 @@ from django.conf import settings
 from django.contrib.gis.geoip2 import GeoIP2
 from django.contrib.gis.geoip2 import GeoIP2Exception
 from django.contrib.sites.shortcuts import get_current_site
-from django.urls import reverse
 from django.utils import timezone
 from django.utils.crypto import get_random_string
 from django.utils.encoding import force_bytes
 from django.utils.encoding import force_str
-from django.utils.http import urlencode
 from django.utils.timezone import is_naive
 from django.utils.timezone import utc
 from django_countries import countries
@@ -29,9 +30,6 @@ from geoip2.errors import AddressNotFoundError
 from ratelimit.utils import is_ratelimited
 from user_agents import parse
 
-from .constants import PAID
-from .constants import PAID_CAMPAIGN
-
 
 log = logging.getLogger(__name__)  # noqa
 
@@ -55,6 +53,122 @@ class GeolocationData:
     lng: float = None
 
 
+class RegexBlocklist:
+
+    """
+    Regular expressions matched against a string (eg. a user agent) in a single pass.
+
+    The patterns are compiled into a single alternation with a named group per pattern
+    so the pattern that matched can be reported.
+    Patterns that can't be combined (eg. with groups or inline flags) are checked one at a time.
+
+    When ``filepath`` is set, the patterns in the file (one per line) are added to ``patterns``.
+    The file is checked for changes at most every ``reload_interval`` seconds
+    so the blocklist can be updated without restarting the server.
+    """
+
+    reload_interval = 60  # seconds
+
+    def __init__(self, patterns=(), filepath=None):
+        # Patterns may be strings or compiled regular expressions
+        self.patterns = [getattr(pattern, "pattern", pattern) for pattern in patterns]
+        self.filepath = filepath
+        self.file_mtime = None
+        self.last_checked = None
+        self.lock = threading.Lock()
+        self.compile(self.patterns)
+        self.reload_if_changed()
+
+    def compile(self, patterns):
+        regexes = [re.compile(pattern) for pattern in patterns]
+        default_flags = re.compile("").flags
+        combined = [
+            regex
+            for regex in regexes
+            if not regex.groups and regex.flags == default_flags
+        ]
+
+        group_patterns = {f"_p{i}": regex.pattern for i, regex in enumerate(combined)}
+        combined_regex = None
+        if combined:
+            combined_regex = re.compile(
+                "|".join(
+                    f"(?P<{group}>{pattern})"
+                    for group, pattern in group_patterns.items()
+                )
+            )
+
+        # Replace the compiled patterns at once for any concurrent matches
+        self.compiled = (
+            combined_regex,
+            group_patterns,
+            [regex for regex in regexes if regex not in combined],
+        )
+
+    def reload_if_changed(self, force=False):
+        """Reload the patterns from ``filepath`` if it changed since it was last read."""
+        if not self.filepath:
+            return
+
+        now = time.monotonic()
+        if (
+            not force
+            and self.last_checked is not None
+            and now - self.last_checked < self.reload_interval
+        ):
+            return
+
+        with self.lock:
+            self.last_checked = now
+            try:
+                mtime = os.stat(self.filepath).st_mtime
+            except OSError:
+                mtime = None
+
+            if mtime == self.file_mtime:
+                return
+
+            file_patterns = []
+            if mtime is not None:
+                with open(self.filepath, "r", encoding="utf-8") as fd:
+                    for line in fd:
+                        line = line.strip()
+                        if line and not line.startswith("#"):
+                            file_patterns.append(line)
+
+            try:
+                self.compile(self.patterns + file_patterns)
+            except re.error:
+                log.exception("Invalid pattern in blocklist %s", self.filepath)
+                return
+
+            log.info(
+                "Loaded %s patterns from blocklist %s",
+                len(file_patterns),
+                self.filepath,
+            )
+            self.file_mtime = mtime
+
+    def match(self, value):
+        """Returns the pattern that matches ``value`` or ``None``."""
+        if not value:
+            return None
+
+        self.reload_if_changed()
+        combined_regex, group_patterns, regexes = self.compiled
+
+        if combined_regex:
+            match = combined_regex.search(value)
+            if match:
+                return group_patterns[match.lastgroup]
+
+        for regex in regexes:
+            if regex.search(value):
+                return regex.pattern
+
+        return None
+
+
 def get_ad_day():
     """Return a datetime that is the start of the current UTC day."""
     return timezone.now().replace(hour=0, minute=0, second=0, microsecond=0)
@@ -146,6 +260,40 @@ def get_client_user_agent(request):
     return request.META.get("HTTP_USER_AGENT", "")
 
 
+@functools.lru_cache(maxsize=settings.ADSERVER_USER_AGENT_CACHE_SIZE)
+def parse_user_agent(user_agent):
+    """
+    Parse a user agent string (see ``user_agents.parse``).
+
+    Parsing is slow (many regular expressions) but the same user agents are seen constantly
+    so the most recently parsed user agents are cached in each process.
+    The parsed user agents are shared and must not be modified.
+    """
+    return parse(user_agent or "")
+
+
+def get_user_agent_cache_stats():
+    """Get the hits, misses and size of the user agent parsing cache in this process."""
+    info = parse_user_agent.cache_info()
+    return {
+        "hits": info.hits,
+        "misses": info.misses,
+        "size": info.currsize,
+        "maxsize": info.maxsize,
+    }
+
+
+def get_client_parsed_user_agent(request):
+    """Gets the users parsed user agent, parsing it at most once per request."""
+    user_agent = get_client_user_agent(request)
+    parsed = getattr(request, "_parsed_user_agent", None)
+    if parsed is None or parsed[0] != user_agent:
+        parsed = (user_agent, parse_user_agent(user_agent))
+        request._parsed_user_agent = parsed
+
+    return parsed[1]
+
+
 def get_client_id(request):
     """Gets the user advertising client ID based on the request."""
     client_id = getattr(request, "advertising_client_id", None)
@@ -196,7 +344,7 @@ def anonymize_ip_address(ip_address):
 def anonymize_user_agent(user_agent):
     """Anonymizes rare user agents."""
     # If the browser family is not recognized, this is a rare user agent
-    parsed_ua = parse(user_agent)
+    parsed_ua = parse_user_agent(user_agent)
     if parsed_ua.browser.family == "Other" or parsed_ua.os.family == "Other":
         return "Rare user agent"
 
@@ -243,30 +391,38 @@ def is_click_ratelimited(request, ratelimits=None):
     return False
 
 
-def is_blocklisted_user_agent(user_agent, blocklist_regexes=None):
-    """Returns ``True`` if the UA is blocklisted and ``False`` otherwise."""
+def _get_blocklist_match(value, blocklist):
+    if not isinstance(blocklist, RegexBlocklist):
+        # A list of patterns or compiled regular expressions
+        blocklist = RegexBlocklist(blocklist)
+
+    return blocklist.match(value)
+
+
+def get_blocklisted_user_agent_pattern(user_agent, blocklist_regexes=None):
+    """Returns the blocklist pattern matching the UA or ``None`` if it isn't blocklisted."""
     if blocklist_regexes is None:
         blocklist_regexes = BLOCKLISTED_UA_REGEXES
 
-    if user_agent:
-        for regex in blocklist_regexes:
-            if regex.search(user_agent):
-                return True
+    return _get_blocklist_match(user_agent, blocklist_regexes)
 
-    return False
 
+def is_blocklisted_user_agent(user_agent, blocklist_regexes=None):
+    """Returns ``True`` if the UA is blocklisted and ``False`` otherwise."""
+    return get_blocklisted_user_agent_pattern(user_agent, blocklist_regexes) is not None
 
-def is_blocklisted_referrer(referrer, blocklist_regexes=None):
-    """Returns ``True`` if the Referrer is blocklisted and ``False`` otherwise."""
+
+def get_blocklisted_referrer_pattern(referrer, blocklist_regexes=None):
+    """Returns the blocklist pattern matching the Referrer or ``None`` if it isn't blocklisted."""
     if blocklist_regexes is None:
         blocklist_regexes = BLOCKLISTED_REFERRERS_REGEXES
 
-    if referrer:
-        for regex in blocklist_regexes:
-            if regex.search(referrer):
-                return True
+    return _get_blocklist_match(referrer, blocklist_regexes)
 
-    return False
+
+def is_blocklisted_referrer(referrer, blocklist_regexes=None):
+    """Returns ``True`` if the Referrer is blocklisted and ``False`` otherwise."""
+    return get_blocklisted_referrer_pattern(referrer, blocklist_regexes) is not None
 
 
 def is_blocklisted_ip(ip, blocked_ips=None):
@@ -406,125 +562,15 @@ def generate_absolute_url(url):
     return url
 
 
-def generate_publisher_payout_data(
-    publisher, include_current_report=True, include_due_report=True
-):
-    """
-    Generate the amount due at next payout and current month payout data.
-
-    TODO: Break this function up and move it out of utils.
-    """
-    # pylint: disable=cyclic-import
-    # pylint: disable=import-outside-toplevel
-    from .reports import PublisherReport
-
-    today = timezone.now()
-    end_date = today.replace(day=1) - timedelta(days=1)
-    last_payout = publisher.payouts.filter(status=PAID).last()
-
-    if last_payout:
-        first = False
-        # First of the month of the month the payout was for.
-        # TODO: Store this data on the model, instead of hacking it.
-        start_date = last_payout.date.replace(day=1)
-    else:
-        first = True
-        # Fake a payout to make the logic work.
-        start_date = publisher.created
-
-    report_url = generate_absolute_url(
-        reverse("publisher_report", kwargs={"publisher_slug": publisher.slug})
-    )
-
-    current_report = None
-    current_report_url = None
-    due_report = None
-    due_report_url = None
-
-    if include_current_report:
-        current_queryset = publisher.adimpression_set.filter(
-            date__gte=today.replace(day=1),
-            date__lte=today,
-            advertisement__flight__campaign__campaign_type=PAID_CAMPAIGN,
-        )
-        current_report = PublisherReport(current_queryset)
-        current_report.generate()
-
-        current_report_url = (
-            report_url
-            + "?"
-            + urlencode(
-                {
-                    "start_date": today.strftime("%Y-%m-01"),
-                    "end_date": today.strftime("%Y-%m-%d"),
-                    "campaign_type": PAID_CAMPAIGN,
-                }
-            )
-        )
-
-    # Handle cases where a publisher has just joined this month
-    if include_due_report and start_date < today.replace(
-        day=1, hour=0, minute=0, second=0, microsecond=0
-    ):
-        due_queryset = publisher.adimpression_set.filter(
-            date__gte=start_date,
-            date__lte=end_date,
-            advertisement__flight__campaign__campaign_type=PAID_CAMPAIGN,
-        )
-        due_report = PublisherReport(due_queryset)
-        due_report.generate()
-
-        due_report_url = (
-            report_url
-            + "?"
-            + urlencode(
-                {
-                    "start_date": start_date.strftime("%Y-%m-%d"),
-                    "end_date": end_date.strftime("%Y-%m-%d"),
-                    "campaign_type": PAID_CAMPAIGN,
-                }
-            )
-        )
-
-    payouts_url = generate_absolute_url(
-        reverse("publisher_payouts", kwargs={"publisher_slug": publisher.slug})
-    )
-    settings_url = generate_absolute_url(
-        reverse("publisher_settings", kwargs={"publisher_slug": publisher.slug})
-    )
-
-    return dict(
-        first=first,
-        start_date=start_date,
-        end_date=end_date,
-        today=today,
-        due_report={
-            "total": due_report.total,
-            "results": due_report.results,
-        }
-        if due_report
-        else None,
-        due_report_url=due_report_url,
-        current_report={
-            "total": current_report.total,
-            "results": current_report.results,
-        }
-        if current_report
-        else None,
-        current_report_url=current_report_url,
-        payouts_url=payouts_url,
-        settings_url=settings_url,
-        publisher=publisher,
-    )
-
-
 # Compile these regular expressions at startup time for performance purposes
-BLOCKLISTED_UA_REGEXES = [
-    re.compile(s) for s in settings.ADSERVER_BLOCKLISTED_USER_AGENTS
-]
-BLOCKLISTED_REFERRERS_REGEXES = [
-    re.compile(s) for s in settings.ADSERVER_BLOCKLISTED_REFERRERS
-]
+BLOCKLISTED_UA_REGEXES = RegexBlocklist(
+    settings.ADSERVER_BLOCKLISTED_USER_AGENTS,
+    filepath=settings.ADSERVER_BLOCKLISTED_USER_AGENTS_FILE,
+)
+BLOCKLISTED_REFERRERS_REGEXES = RegexBlocklist(
+    settings.ADSERVER_BLOCKLISTED_REFERRERS,
+    filepath=settings.ADSERVER_BLOCKLISTED_REFERRERS_FILE,
+)
 BLOCKLISTED_IPS = build_blocked_ip_set()
 
 try:
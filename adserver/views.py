@@ -41,7 +41,6 @@ from django.views.generic.base import RedirectView
 from djstripe.enums import InvoiceStatus
 from djstripe.models import Invoice
 from rest_framework.authtoken.models import Token
-from user_agents import parse as parse_user_agent
 
 from .constants import CAMPAIGN_TYPES
 from .constants import CLICKS
@@ -58,6 +57,8 @@ from .forms import FlightRenewForm
 from .forms import InviteUserForm
 from .forms import PublisherSettingsForm
 from .forms import SupportForm
+from .fraud import FraudContext
+from .fraud import get_fraud_rule_pipeline
 from .mixins import AdvertisementValidateLinkMixin
 from .mixins import AdvertiserAccessMixin
 from .mixins import AllReportMixin
@@ -81,6 +82,7 @@ from .models import RegionImpression
 from .models import RegionTopicImpression
 from .models import Topic
 from .models import UpliftImpression
+from .payouts import generate_publisher_payout_data
 from .reports import AdvertiserPublisherReport
 from .reports import AdvertiserReport
 from .reports import PublisherAdvertiserReport
@@ -94,16 +96,7 @@ from .reports import PublisherUpliftReport
 from .utils import anonymize_ip_address
 from .utils import calculate_ctr
 from .utils import calculate_ecpm
-from .utils import generate_publisher_payout_data
 from .utils import get_ad_day
-from .utils import get_client_ip
-from .utils import get_client_user_agent
-from .utils import get_geolocation
-from .utils import is_blocklisted_ip
-from .utils import is_blocklisted_referrer
-from .utils import is_blocklisted_user_agent
-from .utils import is_click_ratelimited
-from .utils import is_view_ratelimited
 
 
 log = logging.getLogger(__name__)  # noqa
@@ -668,113 +661,16 @@ class BaseProxyView(View):
 
     def ignore_tracking_reason(self, request, advertisement, offer):
         """Returns a reason this impression should not be tracked or `None` if this *should* be tracked."""
-        # pylint: disable=too-many-branches
-        reason = None
-
-        ip_address = get_client_ip(request)
-        user_agent = get_client_user_agent(request)
-        parsed_ua = parse_user_agent(user_agent)
-        referrer = request.META.get("HTTP_REFERER")
-
-        # One or more of country/region/etc. may be None which is OK
-        # Ads targeting countries/regions/metros will never match None
-        geo_data = get_geolocation(request)
-
-        if not offer:
-            log.log(self.log_level, "Ad impression for unknown offer")
-            reason = "Unknown offer"
-        elif not advertisement.is_valid_offer(self.impression_type, offer):
-            log.log(self.log_level, "Old or nonexistent impression nonce")
-            reason = "Old/Invalid nonce"
-        elif parsed_ua.is_bot:
-            log.log(self.log_level, "Bot impression. User Agent: [%s]", user_agent)
-            reason = "Bot impression"
-        elif not settings.DEBUG and ip_address in settings.INTERNAL_IPS:
-            # Ignore internal IPs except in DEBUG where all IPs are probably internal
-            log.log(
-                self.log_level, "Internal IP impression. User Agent: [%s]", user_agent
-            )
-            reason = "Internal IP"
-        elif parsed_ua.os.family == "Other" or parsed_ua.browser.family == "Other":
-            # This is probably a bot/proxy server/prefetcher/etc.
-            log.log(self.log_level, "Unknown user agent impression [%s]", user_agent)
-            reason = "Unrecognized user agent"
-        elif not request.user.is_anonymous:
-            log.log(self.log_level, "Ignored known user ad impression")
-            reason = "Known user impression"
-        elif is_blocklisted_user_agent(user_agent):
-            log.log(self.log_level, "Blocked user agent impression [%s]", user_agent)
-            reason = "Blocked UA impression"
-        elif is_blocklisted_referrer(referrer):
-            log.log(
-                self.log_level,
-                "Blocklisted referrer [%s], Publisher: [%s], UA: [%s]",
-                referrer,
-                offer.publisher,
-                user_agent,
-            )
-            reason = "Blocked referrer impression"
-        elif is_blocklisted_ip(ip_address):
-            log.log(
-                self.log_level,
-                "Blocked IP impression, Publisher: [%s]",
-                offer.publisher,
-            )
-            reason = "Blocked IP impression"
-        elif not offer.publisher:
-            log.log(self.log_level, "Ad impression for unknown publisher")
-            reason = "Unknown publisher"
-        elif not advertisement.flight.show_to_geo(geo_data):
-            # This is very rare but it is visible in ad reports
-            # I believe the most common cause for this is somebody uses a VPN and is served an ad
-            # Then they turn off their VPN and click on the ad
-            log.log(
-                self.log_security_level,
-                "Invalid geo targeting for ad [%s]. Country: [%s], Region: [%s], Metro: [%s]",
-                advertisement,
-                geo_data.country,
-                geo_data.region,
-                geo_data.metro,
-            )
-            reason = "Invalid targeting impression"
-        elif self.impression_type == CLICKS and is_click_ratelimited(request):
-            log.log(
-                self.log_level,
-                "User has clicked too many ads recently, Publisher: [%s], UA: [%s]",
-                offer.publisher,
-                user_agent,
-            )
-            reason = "Ratelimited click impression"
-        elif self.impression_type == VIEWS and is_view_ratelimited(request):
-            log.log(
-                self.log_level,
-                "User has viewed too many ads recently, Publisher: [%s], UA: [%s]",
-                offer.publisher,
-                user_agent,
-            )
-            reason = "Ratelimited view impression"
-        elif offer and offer.os_family != parsed_ua.os.family:
-            log.log(
-                self.log_security_level,
-                "Mismatched OS between offer and impression. Publisher: [%s], Offer OS: [%s], User agent: [%s]",
-                offer.publisher,
-                offer.os_family,
-                user_agent,
-            )
-            reason = "Mismatched OS"
-        elif offer and offer.browser_family != parsed_ua.browser.family:
-            log.log(
-                self.log_security_level,
-                "Mismatched browser between offer and impression. Publisher: [%s], Offer Browser: [%s], User agent: [%s]",
-                offer.publisher,
-                offer.browser_family,
-                user_agent,
-            )
-            reason = "Mismatched browser"
+        context = FraudContext(request, advertisement, offer, self.impression_type)
+        rule = get_fraud_rule_pipeline().check(
+            context,
+            log_level=self.log_level,
+            log_security_level=self.log_security_level,
+        )
 
-        # This is out of the elif block and will be run everytime
-        if offer and offer.ip != anonymize_ip_address(ip_address):
-            # Because this block doesn't set a reason, it will only log mismatches. Not stop them.
+        # This is checked even when a rule matched
+        if offer and offer.ip != anonymize_ip_address(context.ip_address):
+            # Because this doesn't set a reason, it will only log mismatches. Not stop them.
             log.log(
                 self.log_level,
                 "Mismatched IP between offer and impression. Publisher: [%s], Offer IP (anon): [%s]",
@@ -782,12 +678,26 @@ class BaseProxyView(View):
                 offer.ip,
             )
 
-        return reason
+        return rule.reason if rule else None
 
     def get_offer(self, nonce):
+        # Recent offers are cached so views and clicks don't have to query the offers table
+        offer = Offer.load_nonce(nonce)
+        if offer:
+            return offer
+
         try:
-            offer = Offer.objects.get(id=nonce)
-        except (ValidationError, Offer.DoesNotExist) as exception:
+            # Old offers are still looked up so clicks are attributed to the publisher
+            # Their views and clicks are rejected by the fraud rules (``InvalidNonceRule``)
+            offer = Offer.objects.select_related("publisher").get(id=nonce)
+        except Offer.DoesNotExist as exception:
+            # The offer may not have been written yet
+            offer = None
+            if settings.ADSERVER_OFFER_WRITE_BEHIND:
+                offer = Offer.load_pending(nonce)
+            if not offer:
+                log.debug("Invalid Offer. exception=%s", exception)
+        except ValidationError as exception:
             log.debug("Invalid Offer. exception=%s", exception)
             offer = None
 
@@ -797,9 +707,15 @@ class BaseProxyView(View):
         """Handle the view or click and return a reason if it was ignored."""
         ignore_reason = self.ignore_tracking_reason(request, advertisement, offer)
 
+        # Only one of any concurrent requests with the same nonce can invalidate it
+        if not ignore_reason and not advertisement.invalidate_nonce(
+            self.impression_type, offer.pk
+        ):
+            log.log(self.log_level, "Impression nonce was already used")
+            ignore_reason = "Old/Invalid nonce"
+
         if not ignore_reason:
             log.log(self.log_level, self.success_message)
-            advertisement.invalidate_nonce(self.impression_type, offer.pk)
             advertisement.track_impression(
                 request, self.impression_type, publisher=publisher, offer=offer
             )
@@ -814,7 +730,9 @@ class BaseProxyView(View):
 
     def get(self, request, advertisement_id, nonce):
         """Handles proxying ad views and clicks and collecting metrics on them."""
-        advertisement = get_object_or_404(Advertisement, pk=advertisement_id)
+        advertisement = get_object_or_404(
+            Advertisement.objects.select_related("flight"), pk=advertisement_id
+        )
         offer = self.get_offer(nonce)
         publisher = None
 
@@ -128,26 +128,21 @@ DATABASES = {
 DATABASES["default"]["ATOMIC_REQUESTS"] = True
 DEFAULT_AUTO_FIELD = "django.db.models.AutoField"
 
-# If you plan to roll the Offer table, you should take the following steps:
-# * Update the ADSERVER_OFFER_DB_TABLE env with the correct table name
-# * Run the following SQL:
-# ```
-# CREATE TABLE "adserver_offer_2022_07" ("created" timestamp with time zone NOT NULL, "modified" timestamp with time zone NOT NULL, "date" timestamp with time zone NOT NULL, "ip" inet NOT NULL, "user_agent" varchar(1000) NULL, "client_id" varchar(1000) NULL, "country" varchar(2) NULL, "url" varchar(10000) NULL, "browser_family" varchar(1000) NULL, "os_family" varchar(1000) NULL, "keywords" text NULL, "div_id" varchar(100) NULL, "ad_type_slug" varchar(100) NULL, "is_bot" boolean NOT NULL, "is_mobile" boolean NOT NULL, "is_refunded" boolean NOT NULL, "id" uuid NOT NULL PRIMARY KEY, "viewed" boolean NOT NULL, "clicked" boolean NOT NULL, "uplifted" boolean NULL, "view_time" integer NULL CHECK ("view_time" >= 0), "advertisement_id" integer NULL, "publisher_id" integer NULL);
-# ALTER TABLE "adserver_offer_2022_07" ADD CONSTRAINT "adserver_offer_2022_07__advertisement_id_154ae817_fk_adserver_" FOREIGN KEY ("advertisement_id") REFERENCES "adserver_advertisement" ("id") DEFERRABLE INITIALLY DEFERRED;
-# ALTER TABLE "adserver_offer_2022_07" ADD CONSTRAINT "adserver_offer_2022_07__publisher_id_d9abea3b_fk_adserver_" FOREIGN KEY ("publisher_id") REFERENCES "adserver_publisher" ("id") DEFERRABLE INITIALLY DEFERRED;
-# CREATE INDEX "adserver_offer_2022_07_date_cc145c38" ON "adserver_offer_2022_07" ("date");
-# CREATE INDEX "adserver_offer_2022_07_advertisement_id_154ae817" ON "adserver_offer_2022_07" ("advertisement_id");
-# CREATE INDEX "adserver_offer_2022_07_publisher_id_d9abea3b" ON "adserver_offer_2022_07" ("publisher_id");
-# ```
+# On PostgreSQL, the Offer table can be partitioned by month on the offer date
+# rather than rolled manually. To switch to a partitioned table:
+# * Create it: django-admin offer_partitions --table adserver_offer_partitioned --create-like adserver_offer
+# * Update the ADSERVER_OFFER_DB_TABLE env with the new table name
 # * Re-run the nightly tasks against the old table:
 # ```
-# ADSERVER_OFFER_DB_TABLE=adserver_offer_2021_11 django-admin shell
+# ADSERVER_OFFER_DB_TABLE=adserver_offer django-admin shell
 # ```
 # from adserver import tasks
 # tasks.update_previous_day_reports()
 # ```
 # * Then backup & truncate the old offers table:
 # django-admin archive_offers --start-date 2021-11-01 --end-date 2022-07-01
+# Future partitions are created by the ``maintain_offer_partitions`` task
+# and archived months can be dropped with ``archive_offers --drop-partitions``.
 ADSERVER_OFFER_DB_TABLE = env("ADSERVER_OFFER_DB_TABLE", default=None)
 
 
@@ -493,11 +488,52 @@ ADSERVER_BLOCKLISTED_USER_AGENTS = env.list(
     "ADSERVER_BLOCKLISTED_USER_AGENTS", default=[]
 )
 ADSERVER_BLOCKLISTED_REFERRERS = env.list("ADSERVER_BLOCKLISTED_REFERRERS", default=[])
+# Files with more blocklist patterns (one per line) which are reloaded when they change
+ADSERVER_BLOCKLISTED_USER_AGENTS_FILE = env(
+    "ADSERVER_BLOCKLISTED_USER_AGENTS_FILE", default=None
+)
+ADSERVER_BLOCKLISTED_REFERRERS_FILE = env(
+    "ADSERVER_BLOCKLISTED_REFERRERS_FILE", default=None
+)
+# Rules to ignore invalid views and clicks. They run from the cheapest to the most expensive
+# The order of the rules is their precedence when an impression matches more than one rule
+# The pipeline checks them from the cheapest to the most expensive (see ``adserver.fraud``)
+ADSERVER_FRAUD_RULES = [
+    "adserver.fraud.UnknownOfferRule",
+    "adserver.fraud.InvalidNonceRule",
+    "adserver.fraud.BotRule",
+    "adserver.fraud.InternalIpRule",
+    "adserver.fraud.UnknownUserAgentRule",
+    "adserver.fraud.KnownUserRule",
+    "adserver.fraud.BlockedUserAgentRule",
+    "adserver.fraud.BlockedReferrerRule",
+    "adserver.fraud.BlockedIpRule",
+    "adserver.fraud.UnknownPublisherRule",
+    "adserver.fraud.InvalidTargetingRule",
+    "adserver.fraud.ClickRatelimitRule",
+    "adserver.fraud.ViewRatelimitRule",
+    "adserver.fraud.MismatchedOsRule",
+    "adserver.fraud.MismatchedBrowserRule",
+]
 ADSERVER_MINIMUM_PAYOUT = env.int("ADSERVER_MINIMUM_PAYOUT", default=50)
 # Recording views is highly discouraged in production but useful in development
 ADSERVER_RECORD_VIEWS = True
 ADSERVER_HTTPS = False  # Should be True in most production setups
 ADSERVER_STICKY_DECISION_DURATION = 0
+# Write offers from ad decisions asynchronously (in a Celery task)
+ADSERVER_OFFER_WRITE_BEHIND = env.bool("ADSERVER_OFFER_WRITE_BEHIND", default=False)
+# Cache recent offers by nonce to validate views and clicks without querying the offers table
+ADSERVER_NONCE_CACHE = env.bool("ADSERVER_NONCE_CACHE", default=False)
+# Sum impression counts in memory and write them at most every X seconds (0 to disable)
+ADSERVER_COUNTER_FLUSH_INTERVAL = env.int("ADSERVER_COUNTER_FLUSH_INTERVAL", default=0)
+# Number of parsed user agents cached in each process
+ADSERVER_USER_AGENT_CACHE_SIZE = env.int(
+    "ADSERVER_USER_AGENT_CACHE_SIZE", default=10000
+)
+# Only aggregate offers into today's reports once they are at least X seconds old
+ADSERVER_AGGREGATION_DELAY = env.int("ADSERVER_AGGREGATION_DELAY", default=5 * 60)
+# Cache report results for up to X seconds (0 to disable)
+ADSERVER_REPORT_CACHE_TIMEOUT = env.int("ADSERVER_REPORT_CACHE_TIMEOUT", default=0)
 
 # For customer support emails
 ADSERVER_SUPPORT_TO_EMAIL = env("ADSERVER_SUPPORT_TO_EMAIL", default=None)
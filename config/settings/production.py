@@ -135,6 +135,16 @@ CELERY_BEAT_SCHEDULE = {
         "task": "adserver.tasks.update_previous_day_reports",
         "schedule": crontab(hour="2", minute="0"),
     },
+    # Add the latest offers to today's reports
+    "every-fifteen-minutes-update-today-reports": {
+        "task": "adserver.tasks.update_today_reports",
+        "schedule": crontab(minute="*/15"),
+    },
+    # Create the next months' partitions of the offers table (if it is partitioned)
+    "every-day-maintain-offer-partitions": {
+        "task": "adserver.tasks.maintain_offer_partitions",
+        "schedule": crontab(hour="5", minute="30"),
+    },
     "every-day-calculate-publisher-ctrs": {
         "task": "adserver.tasks.calculate_publisher_ctrs",
         "schedule": crontab(hour="3", minute="30"),
@@ -194,6 +204,9 @@ ADSERVER_CLICK_RATELIMITS = env.list(
     "ADSERVER_CLICK_RATELIMITS", default=["1/m", "3/10m", "10/h", "25/d"]
 )
 ADSERVER_VIEW_RATELIMITS = env.list("ADSERVER_VIEW_RATELIMITS", default=["5/5m"])
+ADSERVER_REPORT_CACHE_TIMEOUT = env.int(
+    "ADSERVER_REPORT_CACHE_TIMEOUT", default=60 * 60 * 24
+)
 ADSERVER_STICKY_DECISION_DURATION = env.int(
     "ADSERVER_STICKY_DECISION_DURATION", default=5
 )